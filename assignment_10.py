@@ -117,40 +117,14 @@ class UnemploymentScale:
         """
         self._width = END_X_UNEMPLOYMENT - START_X_UNEMPLOYMENT
 
-        def get_max_gender_unemployment(query):
-            query.set_female(True)
-            female_unemployment = dataset.get_unemp(query)
+        occupation_cells = dataset.group_by(['docc03', 'female'], ['unemp'])
+        group_cells = dataset.group_by(['wbhaom', 'female'], ['unemp'])
 
-            query.set_female(False)
-            male_unemployment = dataset.get_unemp(query)
-            return max([female_unemployment, male_unemployment])
-
-        def get_unemployment_for_occupation(occupation):
-            query = data_model.Query()
-            query.set_docc03(occupation)
-            return get_max_gender_unemployment(query)
-
-        def get_unemployment_for_race_ethnicity(group):
-            query = data_model.Query()
-            query.set_wbhaom(group)
-            return get_max_gender_unemployment(query)
-
-        occupations = dataset.get_docc03_vals()
-        occupation_unemployments = map(
-            get_unemployment_for_occupation,
-            occupations
-        )
-
-        groups = dataset.get_wbhaom_vals()
-        group_unemployments = map(
-            get_unemployment_for_race_ethnicity,
-            groups
-        )
-
-        unemployments = itertools.chain(
-            occupation_unemployments,
-            group_unemployments
+        cells = itertools.chain(
+            occupation_cells.values(),
+            group_cells.values()
         )
+        unemployments = map(lambda x: x['unemp'], cells)
 
         self._max_unemployment = math.ceil(max(unemployments))
 
@@ -272,6 +246,7 @@ class ParticipationRateByGenderPresenter:
         self._dataset = dataset
         self._vert_scale = vert_scale
         self._width = END_X_GENDER_PARTICIPATION - START_X_GENDER_PARTICIPATION
+        self._cells = dataset.group_by(['docc03', 'female'], ['size'])
 
     def draw(self):
         """Draw this subgraphic."""
@@ -346,14 +321,8 @@ class ParticipationRateByGenderPresenter:
         y = self._vert_scale.get_position(occupation)
         self._sketch.translate(0, y)
 
-        query = data_model.Query()
-        query.set_docc03(occupation)
-
-        query.set_female(True)
-        num_female = self._dataset.get_size(query)
-
-        query.set_female(False)
-        num_male = self._dataset.get_size(query)
+        num_female = self._cells[(occupation, True)]['size']
+        num_male = self._cells[(occupation, False)]['size']
 
         total_count = num_male + num_female
         percent_female = num_female / total_count
@@ -415,6 +384,7 @@ class UnemploymentByGenderPresenter:
         self._vert_scale = vert_scale
         self._width = END_X_UNEMPLOYMENT - START_X_UNEMPLOYMENT
         self._height = END_Y_UNEMPLOYMENT - START_Y_UNEMPLOYMENT
+        self._cells = dataset.group_by(['docc03', 'female'], ['unemp'])
 
     def draw(self):
         """Draw this subgraphic."""
@@ -506,14 +476,8 @@ class UnemploymentByGenderPresenter:
         self._sketch.set_stroke(OCCUPATION_AXIS_COLOR)
         self._sketch.draw_line(0, 0, self._width, 0)
 
-        query = data_model.Query()
-        query.set_docc03(occupation)
-
-        query.set_female(True)
-        female_unemployment = self._dataset.get_unemp(query)
-
-        query.set_female(False)
-        male_unemployment = self._dataset.get_unemp(query)
+        female_unemployment = self._cells[(occupation, True)]['unemp']
+        male_unemployment = self._cells[(occupation, False)]['unemp']
 
         female_x = self._horiz_scale.get_position(female_unemployment)
         male_x = self._horiz_scale.get_position(male_unemployment)
@@ -568,6 +532,7 @@ class RaceEthnicityUnemploymentPresenter:
         self._groups = sorted(dataset.get_wbhaom_vals())
         self._width = END_X_RACE_ETHNICITY - START_X_RACE_ETHNICITY
         self._height = END_Y_RACE_ETHNICITY - START_Y_RACE_ETHNICITY
+        self._cells = dataset.group_by(['wbhaom', 'female'], ['unemp'])
 
     def draw(self):
         """Draw the right-side race / ethnicity plot."""
@@ -595,15 +560,10 @@ class RaceEthnicityUnemploymentPresenter:
         self._sketch.push_transform()
         self._sketch.push_style()
 
-        query = data_model.Query()
-        query.set_wbhaom(group)
-
-        query.set_female(True)
-        female_unemployment = self._dataset.get_unemp(query)
+        female_unemployment = self._cells[(group, True)]['unemp']
         female_x = self._horiz_scale.get_position(female_unemployment)
 
-        query.set_female(False)
-        male_unemployment = self._dataset.get_unemp(query)
+        male_unemployment = self._cells[(group, False)]['unemp']
         male_x = self._horiz_scale.get_position(male_unemployment)
 
         y = self._get_group_position(group)
@@ -671,21 +631,9 @@ class GenderIncomePresenter:
         self._width = END_X_INCOME - START_X_INCOME
         self._height = END_Y_INCOME - START_Y_INCOME
 
-        occupations = self._dataset.get_docc03_vals()
-
-        def get_occupation_max_income(occupation):
-            query = data_model.Query()
-            query.set_docc03(occupation)
-
-            query.set_female(True)
-            female_income = dataset.get_wageotc(query)
+        self._cells = dataset.group_by(['docc03', 'female'], ['wageotc'])
 
-            query.set_female(False)
-            male_income = dataset.get_wageotc(query)
-
-            return max([female_income, male_income])
-
-        occupation_wages = map(get_occupation_max_income, occupations)
+        occupation_wages = map(lambda x: x['wageotc'], self._cells.values())
         max_income_unrounded = max(occupation_wages)
         self._max_income = round(max_income_unrounded)
 
@@ -767,14 +715,8 @@ class GenderIncomePresenter:
         y = self._vert_scale.get_position(occupation)
         self._sketch.translate(0, y)
 
-        query = data_model.Query()
-        query.set_docc03(occupation)
-
-        query.set_female(True)
-        female_income = self._dataset.get_wageotc(query)
-
-        query.set_female(False)
-        male_income = self._dataset.get_wageotc(query)
+        female_income = self._cells[(occupation, True)]['wageotc']
+        male_income = self._cells[(occupation, False)]['wageotc']
 
         female_width = self._get_bar_width(female_income)
         male_width = self._get_bar_width(male_income)
@@ -0,0 +1,206 @@
+"""Benchmarks for the data model used by the visualizations.
+
+Times median wage calculation across subpopulations of different sizes for
+each median strategy offered by data_model.Dataset and columnar_model,
+measures memory used per record, and compares load times of parallel_load
+across numbers of worker processes. Run with python benchmark.py and optionally
+provide the path to the CSV file as the first argument.
+
+Author: A Samuel Pottinger
+License: BSD-3-Clause
+"""
+import csv
+import functools
+import sys
+import time
+import tracemalloc
+
+import columnar_model
+import data_model
+import parallel_load
+
+DATA_LOC = 'data.csv'
+REPETITIONS = 5
+LOAD_WORKERS = [1, 2, 4]
+
+
+def time_calls(target, query):
+    """Time repeated calls to a query method.
+
+    Args:
+        target (callable): The method like get_wageotc to call.
+        query (data_model.Query): The query to pass to the method.
+
+    Returns:
+        float: Average seconds per call.
+    """
+    start = time.perf_counter()
+
+    for i in range(REPETITIONS):
+        target(query)
+
+    return (time.perf_counter() - start) / REPETITIONS
+
+
+def get_benchmark_queries(dataset):
+    """Get queries describing subpopulations of decreasing size.
+
+    Args:
+        dataset: The dataset whose values should be used in the queries.
+
+    Returns:
+        list: Tuples of description and data_model.Query.
+    """
+    occupation = dataset.get_docc03_vals()[0]
+    group = dataset.get_wbhaom_vals()[0]
+
+    query_all = data_model.Query()
+
+    query_female = data_model.Query()
+    query_female.set_female(True)
+
+    query_occupation = data_model.Query()
+    query_occupation.set_docc03(occupation)
+    query_occupation.set_female(True)
+
+    query_group = data_model.Query()
+    query_group.set_docc03(occupation)
+    query_group.set_female(True)
+    query_group.set_wbhaom(group)
+
+    return [
+        ('all', query_all),
+        ('female', query_female),
+        ('docc03 x female', query_occupation),
+        ('docc03 x female x wbhaom', query_group)
+    ]
+
+
+def benchmark_median_strategies(loc):
+    """Compare median strategies across subpopulation sizes.
+
+    Args:
+        loc (str): Path to the CSV file to load.
+    """
+    datasets = []
+    for strategy in data_model.MEDIAN_STRATEGIES:
+        datasets.append((
+            'Dataset %s' % strategy,
+            data_model.load_from_file(
+                loc,
+                dataset_factory=functools.partial(
+                    data_model.Dataset,
+                    median_strategy=strategy
+                )
+            )
+        ))
+        datasets.append((
+            'ColumnarDataset %s' % strategy,
+            data_model.load_from_file(
+                loc,
+                dataset_factory=functools.partial(
+                    columnar_model.make_dataset,
+                    median_strategy=strategy
+                )
+            )
+        ))
+
+    queries = get_benchmark_queries(datasets[0][1])
+    reference = datasets[0][1]
+
+    print('Median wage (ms per call)')
+    for description, query in queries:
+        size = reference.get_size(query)
+        print('  %s (weight %.0f)' % (description, size))
+
+        for name, dataset in datasets:
+            duration = time_calls(dataset.get_wageotc, query)
+            print('    %-30s %10.3f' % (name, duration * 1000))
+
+
+def measure_memory(load):
+    """Measure memory held by the result of a loading function.
+
+    Args:
+        load (callable): Function without arguments which returns the loaded
+            records or dataset.
+
+    Returns:
+        tuple: The value returned by load and the bytes of memory allocated by
+            it which are still in use.
+    """
+    tracemalloc.start()
+    result = load()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (result, current)
+
+
+def benchmark_memory(loc):
+    """Report memory used per record by the object per record model.
+
+    Args:
+        loc (str): Path to the CSV file to load.
+    """
+    def load_records():
+        with open(loc) as f:
+            return list(map(data_model.parse_record, csv.DictReader(f)))
+
+    def load_dataset():
+        return data_model.load_from_file(
+            loc,
+            dataset_factory=functools.partial(data_model.Dataset, cache_size=0)
+        )
+
+    records, records_memory = measure_memory(load_records)
+    num_records = len(records)
+    del records
+
+    dataset, dataset_memory = measure_memory(load_dataset)
+    del dataset
+
+    print('Memory per record (bytes)')
+    print('  %-30s %10.0f' % ('InputRecord', records_memory / num_records))
+    print('  %-30s %10.0f' % ('Dataset', dataset_memory / num_records))
+
+
+def benchmark_parallel_load(loc):
+    """Report load time and speedup of parallel_load by number of workers.
+
+    Speedup is relative to the single process data_model.load_from_file and
+    is limited by the number of cores available.
+
+    Args:
+        loc (str): Path to the CSV file to load.
+    """
+    def time_load(load):
+        start = time.perf_counter()
+        load()
+        return time.perf_counter() - start
+
+    serial_duration = time_load(lambda: data_model.load_from_file(loc))
+
+    print('Load time (seconds, speedup)')
+    print('  %-30s %10.3f' % ('load_from_file', serial_duration))
+
+    for workers in LOAD_WORKERS:
+        duration = time_load(
+            lambda: parallel_load.load_from_file(loc, workers=workers)
+        )
+        print('  %-30s %10.3f %6.2fx' % (
+            'parallel_load %d workers' % workers,
+            duration,
+            serial_duration / duration
+        ))
+
+
+def main():
+    """Run all benchmarks."""
+    loc = sys.argv[1] if len(sys.argv) > 1 else DATA_LOC
+    benchmark_median_strategies(loc)
+    benchmark_memory(loc)
+    benchmark_parallel_load(loc)
+
+
+if __name__ == '__main__':
+    main()
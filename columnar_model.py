@@ -0,0 +1,1391 @@
+"""Columnar storage engine for calculations on preprocessed EPI data.
+
+Alternative to data_model.Dataset which stores each dimension and measure as a
+contiguous NumPy array instead of one InputRecord object per row. This answers
+the same queries through vectorized kernels so that presenters may use either.
+
+Author: A Samuel Pottinger
+License: MIT License
+"""
+import array
+import csv
+import hashlib
+import json
+import numbers
+import os
+import uuid
+
+import numpy
+
+import data_model
+
+DEFAULT_CHUNK_SIZE = 1000
+
+SNAPSHOT_VERSION = 2
+SNAPSHOT_FINGERPRINT_FILE = 'fingerprint.json'
+SNAPSHOT_CATALOGS_FILE = 'catalogs.json'
+HASH_BLOCK_SIZE = 2 ** 20
+
+
+class Columns:
+    """Collection of typed arrays representing a full dataset."""
+
+    def __init__(self, index, codes, catalogs, unemp, wage_count, unemp_count,
+            wages, weights, wage_offsets):
+        """Create a new set of columns.
+
+        Args:
+            index (numpy.ndarray): Unique integer ID for each record.
+            codes (dict): Mapping from dimension name (like docc03) to an
+                integer array where each value is the position of the record's
+                value within that dimension's catalog.
+            catalogs (dict): Mapping from dimension name to sorted list of the
+                distinct values found for that dimension.
+            unemp (numpy.ndarray): Percent unemployment (0-100) per record.
+            wage_count (numpy.ndarray): Sum of weights for wage information per
+                record.
+            unemp_count (numpy.ndarray): Sum of weights for unemployment
+                information per record.
+            wages (numpy.ndarray): Flat array of hourly wages across all
+                records.
+            weights (numpy.ndarray): Flat array of population weights matching
+                wages.
+            wage_offsets (numpy.ndarray): Array of length one more than the
+                number of records where the wages for record i are found from
+                wage_offsets[i] up to but not including wage_offsets[i + 1].
+        """
+        self._index = index
+        self._codes = codes
+        self._catalogs = catalogs
+        self._unemp = unemp
+        self._wage_count = wage_count
+        self._unemp_count = unemp_count
+        self._wages = wages
+        self._weights = weights
+        self._wage_offsets = wage_offsets
+
+    def get_size(self):
+        """Get the number of records represented.
+
+        Returns:
+            int: Count of records (rows) in these columns.
+        """
+        return self._index.shape[0]
+
+    def get_index(self):
+        """Get the unique integer IDs of the records.
+
+        Returns:
+            numpy.ndarray: Integer ID for each record.
+        """
+        return self._index
+
+    def get_codes(self, dimension):
+        """Get the encoded values for a dimension.
+
+        Args:
+            dimension (str): Name of the dimension like docc03.
+
+        Returns:
+            numpy.ndarray: Integer codes indexing into the dimension's catalog.
+        """
+        return self._codes[dimension]
+
+    def get_catalog(self, dimension):
+        """Get the distinct values for a dimension.
+
+        Args:
+            dimension (str): Name of the dimension like docc03.
+
+        Returns:
+            list: Sorted distinct values where position is the value's code.
+        """
+        return self._catalogs[dimension]
+
+    def get_unemp(self):
+        """Get unemployment percentages.
+
+        Returns:
+            numpy.ndarray: Percent unemployment (0-100) per record.
+        """
+        return self._unemp
+
+    def get_wage_count(self):
+        """Get wage population weights.
+
+        Returns:
+            numpy.ndarray: Sum of weights for wage information per record.
+        """
+        return self._wage_count
+
+    def get_unemp_count(self):
+        """Get unemployment population weights.
+
+        Returns:
+            numpy.ndarray: Sum of weights for unemployment information per
+                record.
+        """
+        return self._unemp_count
+
+    def get_wages(self):
+        """Get the flat array of wages across all records.
+
+        Returns:
+            numpy.ndarray: Hourly wages in USD.
+        """
+        return self._wages
+
+    def get_weights(self):
+        """Get the flat array of population weights for get_wages.
+
+        Returns:
+            numpy.ndarray: Weights proportional to population size.
+        """
+        return self._weights
+
+    def get_wage_offsets(self):
+        """Get the offsets into the flat wage arrays for each record.
+
+        Returns:
+            numpy.ndarray: Array of length get_size() + 1 with start offsets.
+        """
+        return self._wage_offsets
+
+
+class ColumnsBuilder:
+    """Utility to accumulate records before converting them to Columns.
+
+    Values are appended to compact typed arrays as records arrive such that
+    data may be streamed in without keeping intermediate objects.
+    """
+
+    def __init__(self):
+        """Create a new empty builder."""
+        self._index = array.array('q')
+        self._codes = dict(map(
+            lambda x: (x, array.array('l')),
+            data_model.DIMENSIONS
+        ))
+        self._code_by_value = dict(
+            map(lambda x: (x, {}), data_model.DIMENSIONS)
+        )
+        self._unemp = array.array('d')
+        self._wage_count = array.array('d')
+        self._unemp_count = array.array('d')
+        self._wages = array.array('d')
+        self._weights = array.array('d')
+        self._wage_offsets = array.array('q', [0])
+
+    def add_record(self, record):
+        """Add a single record to the columns under construction.
+
+        Args:
+            record (data_model.InputRecord): The record to append.
+        """
+        self._index.append(record.get_index())
+
+        for dimension in data_model.DIMENSIONS:
+            value = getattr(record, 'get_' + dimension)()
+            self._add_dimension_value(dimension, value)
+
+        self._unemp.append(record.get_unemp())
+        self._wage_count.append(record.get_wage_count())
+        self._unemp_count.append(record.get_unemp_count())
+
+        wageotc = record.get_wageotc()
+        self._wages.extend(map(lambda x: x.get_wage(), wageotc))
+        self._weights.extend(map(lambda x: x.get_weight(), wageotc))
+        self._wage_offsets.append(self._wage_offsets[-1] + len(wageotc))
+
+    def add_raw_chunk(self, records_raw):
+        """Add rows read from the CSV file without creating InputRecords.
+
+        Args:
+            records_raw (list): Rows as dictionaries like from csv.DictReader
+                which are parsed like data_model.parse_record.
+        """
+        for record_raw in records_raw:
+            self._index.append(int(record_raw['index']))
+
+            for dimension in data_model.DIMENSIONS:
+                value = data_model.parse_dimension(record_raw, dimension)
+                self._add_dimension_value(dimension, value)
+
+            self._unemp.append(float(record_raw['unemp']))
+            self._wage_count.append(float(record_raw['wageCount']))
+            self._unemp_count.append(float(record_raw['unempCount']))
+
+        wages, weights, offsets = data_model.parse_wage_otc_column(
+            map(lambda x: x['wageotc'], records_raw)
+        )
+        self._wages.extend(wages)
+        self._weights.extend(weights)
+
+        base_offset = self._wage_offsets[-1]
+        self._wage_offsets.extend(map(lambda x: x + base_offset, offsets[1:]))
+
+    def build(self):
+        """Convert the records added so far into typed arrays.
+
+        The resulting arrays share memory with this builder so no further
+        records should be added after calling build.
+
+        Returns:
+            Columns: Columns representing all records added.
+        """
+        codes = {}
+        catalogs = {}
+        for dimension in data_model.DIMENSIONS:
+            code_by_value = self._code_by_value[dimension]
+            catalog = sorted(code_by_value.keys())
+            dtype = get_code_dtype(len(catalog))
+
+            remap = numpy.zeros(len(catalog), dtype=dtype)
+            for new_code, value in enumerate(catalog):
+                remap[code_by_value[value]] = new_code
+
+            raw_codes = numpy.asarray(self._codes[dimension])
+            codes[dimension] = remap[raw_codes]
+            catalogs[dimension] = catalog
+
+        return Columns(
+            numpy.frombuffer(self._index, dtype=numpy.int64),
+            codes,
+            catalogs,
+            numpy.frombuffer(self._unemp, dtype=numpy.float64),
+            numpy.frombuffer(self._wage_count, dtype=numpy.float64),
+            numpy.frombuffer(self._unemp_count, dtype=numpy.float64),
+            numpy.frombuffer(self._wages, dtype=numpy.float64),
+            numpy.frombuffer(self._weights, dtype=numpy.float64),
+            numpy.frombuffer(self._wage_offsets, dtype=numpy.int64)
+        )
+
+    def _add_dimension_value(self, dimension, value):
+        """Record the value of a dimension for the record being added.
+
+        Args:
+            dimension (str): Name of the dimension like docc03.
+            value: The value as it appears on InputRecord.
+        """
+        code_by_value = self._code_by_value[dimension]
+        code = code_by_value.setdefault(value, len(code_by_value))
+        self._codes[dimension].append(code)
+
+
+class BitmapIndex:
+    """Packed bitmaps identifying which records have each dimension value.
+
+    Each value within a dimension gets one bit per record, packed into 64 bit
+    words such that queries can be combined with word-level AND operations.
+    """
+
+    def __init__(self, words):
+        """Create a new bitmap index for a dimension.
+
+        Args:
+            words (numpy.ndarray): Two dimensional array of uint64 with one row
+                per code in the dimension's catalog as made by pack_mask. See
+                make_bitmap_index.
+        """
+        self._words = words
+
+    def get_words(self):
+        """Get the bitmaps for all values in this dimension.
+
+        Returns:
+            numpy.ndarray: Two dimensional array with one row per code.
+        """
+        return self._words
+
+    def get_bitmap(self, code):
+        """Get the packed bitmap of records with a value.
+
+        Args:
+            code (int): The code of the value within the dimension's catalog.
+
+        Returns:
+            numpy.ndarray: Array of uint64 words where bit i (little endian) is
+                set if record i has the value.
+        """
+        return self._words[code]
+
+
+class ColumnarDataset:
+    """Class to query a dataset stored as Columns.
+
+    Offers the same query interface as data_model.Dataset but evaluates
+    filters and aggregates with vectorized NumPy operations.
+    """
+
+    def __init__(self, columns, use_bitmaps=False, median_strategy='select',
+            derived_arrays=None):
+        """Create a new columnar dataset.
+
+        Args:
+            columns (Columns): The arrays holding the records to query.
+            use_bitmaps (bool): Flag indicating if packed bitmap indexes should
+                be built for each dimension value such that filters are
+                evaluated through word-level AND instead of comparing codes for
+                every record. Defaults to False.
+            median_strategy (str): One of data_model.MEDIAN_STRATEGIES. Use
+                select to order the subpopulation's wages per query or
+                presorted to sort all wages once at load time and then scan
+                them with a mask of the subpopulation's records. Defaults to
+                select.
+            derived_arrays (dict): Optional indexes previously returned by
+                get_derived_arrays for the same columns like from a snapshot.
+                Those needed are reused instead of being rebuilt. Defaults to
+                None in which case all indexes are built.
+        """
+        if median_strategy not in data_model.MEDIAN_STRATEGIES:
+            message = 'Unknown median strategy: %s' % median_strategy
+            raise RuntimeError(message)
+
+        self._columns = columns
+        self._code_by_value = dict(map(
+            lambda x: (
+                x,
+                dict(map(
+                    lambda y: (y[1], y[0]),
+                    enumerate(columns.get_catalog(x))
+                ))
+            ),
+            data_model.DIMENSIONS
+        ))
+        self._wage_lengths = numpy.diff(columns.get_wage_offsets())
+
+        if derived_arrays is None:
+            derived_arrays = {}
+
+        if use_bitmaps:
+            def get_bitmap_index(dimension):
+                key = 'bitmap_' + dimension
+                if key in derived_arrays:
+                    return BitmapIndex(derived_arrays[key])
+                else:
+                    return make_bitmap_index(
+                        columns.get_codes(dimension),
+                        len(columns.get_catalog(dimension))
+                    )
+
+            self._bitmap_by_dimension = dict(map(
+                lambda x: (x, get_bitmap_index(x)),
+                data_model.DIMENSIONS
+            ))
+        else:
+            self._bitmap_by_dimension = None
+
+        self._median_strategy = median_strategy
+        if median_strategy == 'presorted':
+            if 'sorted_wages' in derived_arrays:
+                self._sorted_wages = derived_arrays['sorted_wages']
+                self._sorted_weights = derived_arrays['sorted_weights']
+                self._sorted_positions = derived_arrays['sorted_positions']
+            else:
+                self._build_presorted_wages()
+
+    def get_derived_arrays(self):
+        """Get the indexes built from the columns for this dataset.
+
+        Returns:
+            dict: Mapping from name to array for bitmap indexes and presorted
+                wages if built which may be passed back to the constructor.
+        """
+        derived_arrays = {}
+
+        if self._bitmap_by_dimension is not None:
+            for dimension, index in self._bitmap_by_dimension.items():
+                derived_arrays['bitmap_' + dimension] = index.get_words()
+
+        if self._median_strategy == 'presorted':
+            derived_arrays['sorted_wages'] = self._sorted_wages
+            derived_arrays['sorted_weights'] = self._sorted_weights
+            derived_arrays['sorted_positions'] = self._sorted_positions
+
+        return derived_arrays
+
+    def get_columns(self):
+        """Get the underlying arrays for this dataset.
+
+        Returns:
+            Columns: The columns queried by this dataset.
+        """
+        return self._columns
+
+    def get_wageotc(self, query):
+        """Get median wage for a group with overtime, tips, and comissions.
+
+        Args:
+            query (data_model.Query): A Query object describing the population
+                for which the median wage should be returned.
+
+        Returns:
+            float: The estimated median wage for the given population in USD.
+        """
+        mask = self._get_mask(query)
+        wages, weights, total_weight = self._get_sorted_wages(mask)
+
+        if wages.shape[0] == 0:
+            raise RuntimeError('Unable to get median wage.')
+
+        medians = find_weighted_quantiles(wages, weights, total_weight, [0.5])
+        return float(medians[0])
+
+    def get_wage_quantiles(self, query, quantiles):
+        """Get multiple weighted wage quantiles from a single ordered pass.
+
+        Args:
+            query (data_model.Query): A Query object describing the population
+                for which the quantiles should be returned.
+            quantiles (list): The quantiles to find as numbers from 0 to 1 like
+                [0.1, 0.25, 0.5, 0.75, 0.9].
+
+        Returns:
+            list: Wage in USD (float) for each quantile in the order given
+                where 0.5 matches get_wageotc.
+        """
+        data_model.check_quantiles(quantiles)
+
+        mask = self._get_mask(query)
+        wages, weights, total_weight = self._get_sorted_wages(mask)
+
+        if wages.shape[0] == 0:
+            raise RuntimeError('Unable to get wage quantiles.')
+
+        results = find_weighted_quantiles(
+            wages,
+            weights,
+            total_weight,
+            quantiles
+        )
+        return list(map(float, results))
+
+    def get_wage_histogram(self, query, bins):
+        """Get the weighted distribution of wages for a group.
+
+        Args:
+            query (data_model.Query): A Query object describing the population
+                for which the histogram should be returned.
+            bins: Either the number of equally sized bins (int) spanning the
+                population's minimum to maximum wage or a list of ascending bin
+                edges in USD.
+
+        Returns:
+            list: data_model.HistogramBin for each bin in ascending order where
+                each bin includes its start and excludes its end except for the
+                last bin which includes both.
+        """
+        mask = self._get_mask(query)
+        wage_mask = numpy.repeat(mask, self._wage_lengths)
+        wages = self._columns.get_wages()[wage_mask]
+        weights = self._columns.get_weights()[wage_mask]
+
+        if isinstance(bins, numbers.Integral):
+            if bins < 1:
+                raise RuntimeError('Histogram requires at least one bin.')
+
+            if wages.shape[0] == 0:
+                raise RuntimeError('Unable to get histogram for empty group.')
+
+            bins = data_model.get_histogram_edges(
+                float(wages.min()),
+                float(wages.max()),
+                bins
+            )
+        elif len(bins) < 2:
+            raise RuntimeError('Histogram requires at least two edges.')
+
+        counts, edges = numpy.histogram(wages, bins=bins, weights=weights)
+
+        return list(map(
+            lambda x: data_model.HistogramBin(
+                float(edges[x]),
+                float(edges[x + 1]),
+                float(counts[x])
+            ),
+            range(counts.shape[0])
+        ))
+
+    def get_unemp(self, query):
+        """Get the overall unemployment rate for a group.
+
+        Args:
+            query (data_model.Query): A Query object describing the population
+                for which the unemployemnt rate should be returned.
+
+        Returns:
+            float: The estimated unemployment rate for the specified group as
+                a percentage between 0 and 100.
+        """
+        mask = self._get_mask(query)
+        unemp_counts = self._columns.get_unemp_count()[mask]
+
+        if unemp_counts.shape[0] == 0:
+            raise RuntimeError('Unable to get unemployment for empty group.')
+
+        unemps = self._columns.get_unemp()[mask]
+        weighted = float(numpy.dot(unemp_counts, unemps))
+        return weighted / float(unemp_counts.sum())
+
+    def get_size(self, query):
+        """Get the size of a population as summed census weight.
+
+        Args:
+            query (data_model.Query): A Query object describing the population
+                for which the size should be returned.
+
+        Returns:
+            float: Estimated size of this population as a weight using the
+                wage count like data_model.Dataset.
+        """
+        mask = self._get_mask(query)
+        return float(self._columns.get_wage_count()[mask].sum())
+
+    def group_by(self, dimensions, metrics, base_query=None):
+        """Calculate metrics for every combination of values in dimensions.
+
+        Assigns each record matching base_query a group ID from its codes such
+        that sums come from a single weighted bincount and medians from a
+        single sort of wages by group and then wage.
+
+        Args:
+            dimensions (list): Names of the dimensions by which to group like
+                ['docc03', 'female'].
+            metrics (list): Names of the metrics to calculate per group where
+                each is one of data_model.METRICS.
+            base_query (data_model.Query): Optional query describing the
+                population to group. Defaults to None in which case all records
+                are grouped.
+
+        Returns:
+            dict: Mapping from tuple of dimension values (in the order given by
+                dimensions) to a dict from metric name to its value. Only
+                combinations with at least one record are included.
+        """
+        for dimension in dimensions:
+            data_model.get_dimension_getter(dimension)
+
+        for metric in metrics:
+            if metric not in data_model.METRICS:
+                raise RuntimeError('Unknown metric: %s' % metric)
+
+        if base_query is None:
+            base_query = data_model.Query()
+
+        mask = self._get_mask(base_query)
+        catalogs = list(map(
+            lambda x: self._columns.get_catalog(x),
+            dimensions
+        ))
+
+        shape = tuple(map(lambda x: max(len(x), 1), catalogs))
+        codes = tuple(map(
+            lambda x: self._columns.get_codes(x)[mask].astype(numpy.int64),
+            dimensions
+        ))
+
+        if dimensions:
+            group_ids = numpy.ravel_multi_index(codes, shape)
+        else:
+            group_ids = numpy.zeros(int(mask.sum()), dtype=numpy.int64)
+
+        unique_ids, inverse = numpy.unique(group_ids, return_inverse=True)
+        num_groups = unique_ids.shape[0]
+
+        results = {}
+        if 'size' in metrics:
+            results['size'] = numpy.bincount(
+                inverse,
+                weights=self._columns.get_wage_count()[mask],
+                minlength=num_groups
+            )
+
+        if 'unemp' in metrics:
+            unemp_counts = self._columns.get_unemp_count()[mask]
+            unemps = self._columns.get_unemp()[mask]
+            totals = numpy.bincount(
+                inverse,
+                weights=unemp_counts,
+                minlength=num_groups
+            )
+            weighted = numpy.bincount(
+                inverse,
+                weights=unemp_counts * unemps,
+                minlength=num_groups
+            )
+            results['unemp'] = list(map(
+                lambda x: float(x[0]) / float(x[1]),
+                zip(weighted, totals)
+            ))
+
+        if 'wageotc' in metrics:
+            results['wageotc'] = self._get_grouped_wageotc(
+                mask,
+                inverse,
+                num_groups
+            )
+
+        if dimensions:
+            codes_by_group = numpy.unravel_index(unique_ids, shape)
+        else:
+            codes_by_group = ()
+
+        def get_key(group):
+            return tuple(map(
+                lambda x: x[1][int(codes_by_group[x[0]][group])],
+                enumerate(catalogs)
+            ))
+
+        return dict(map(
+            lambda x: (
+                get_key(x),
+                dict(map(lambda y: (y, float(results[y][x])), metrics))
+            ),
+            range(num_groups)
+        ))
+
+    def get_max_wage(self):
+        """Get the maximum wage value across all records in the dataset.
+
+        Returns:
+            float: The maximum hourly wage value in USD found in the dataset.
+        """
+        return float(self._columns.get_wages().max())
+
+    def get_max_unemployment(self):
+        """Get the maximum unemployment rate across all records in the dataset.
+
+        Returns:
+            float: The maximum unemployment rate as a percentage (0-100)
+                found in the dataset.
+        """
+        return float(self._columns.get_unemp().max())
+
+    def get_educ_vals(self):
+        """Get all unique education level values in the dataset.
+
+        Returns:
+            list: Sorted list of education level labels.
+        """
+        return list(self._columns.get_catalog('educ'))
+
+    def get_docc03_vals(self):
+        """Get all unique occupation classification values in the dataset.
+
+        Returns:
+            list: Sorted list of occupation classification labels.
+        """
+        return list(self._columns.get_catalog('docc03'))
+
+    def get_wbhaom_vals(self):
+        """Get all unique race and ethnicity values in the dataset.
+
+        Returns:
+            list: Sorted list of race and ethnicity labels.
+        """
+        return list(self._columns.get_catalog('wbhaom'))
+
+    def get_female_vals(self):
+        """Get all unique gender values in the dataset.
+
+        Returns:
+            list: Sorted list of gender values (typically [False, True]).
+        """
+        return list(self._columns.get_catalog('female'))
+
+    def get_region_vals(self):
+        """Get all unique geographic region values in the dataset.
+
+        Returns:
+            list: Sorted list of region labels.
+        """
+        return list(self._columns.get_catalog('region'))
+
+    def get_age_vals(self):
+        """Get all unique age group values in the dataset.
+
+        Returns:
+            list: Sorted list of age group labels.
+        """
+        return list(self._columns.get_catalog('age'))
+
+    def get_hoursuint_vals(self):
+        """Get all unique hours worked category values in the dataset.
+
+        Returns:
+            list: Sorted list of hours worked category labels.
+        """
+        return list(self._columns.get_catalog('hoursuint'))
+
+    def get_citistat_vals(self):
+        """Get all unique citizenship status values in the dataset.
+
+        Returns:
+            list: Sorted list of citizenship status labels.
+        """
+        return list(self._columns.get_catalog('citistat'))
+
+    def _build_presorted_wages(self):
+        """Sort all wages across all records for the presorted strategy."""
+        wages = self._columns.get_wages()
+        order = numpy.argsort(wages, kind='stable')
+        positions = numpy.repeat(
+            numpy.arange(self._columns.get_size()),
+            self._wage_lengths
+        )
+        self._sorted_wages = wages[order]
+        self._sorted_weights = self._columns.get_weights()[order]
+        self._sorted_positions = positions[order]
+
+    def _get_sorted_wages(self, mask):
+        """Get the wages of the records in a mask in ascending order.
+
+        Args:
+            mask (numpy.ndarray): Boolean array indicating which records are
+                included.
+
+        Returns:
+            tuple: Arrays of wages and their weights sorted by wage followed
+                by the total weight (float) summed in record order like
+                data_model.Dataset.
+        """
+        wage_mask = numpy.repeat(mask, self._wage_lengths)
+        weights_unsorted = self._columns.get_weights()[wage_mask]
+        total_weight = sum_in_order(weights_unsorted)
+
+        if self._median_strategy == 'presorted':
+            selected = mask[self._sorted_positions]
+            wages = self._sorted_wages[selected]
+            weights = self._sorted_weights[selected]
+        else:
+            wages_unsorted = self._columns.get_wages()[wage_mask]
+            order = numpy.argsort(wages_unsorted, kind='stable')
+            wages = wages_unsorted[order]
+            weights = weights_unsorted[order]
+
+        return (wages, weights, total_weight)
+
+    def _get_grouped_wageotc(self, mask, inverse, num_groups):
+        """Calculate median wage per group in a single sort.
+
+        Args:
+            mask (numpy.ndarray): Boolean array indicating which records are
+                included.
+            inverse (numpy.ndarray): Group number for each included record.
+            num_groups (int): The number of groups.
+
+        Returns:
+            list: Median wage (float) for each group in order.
+        """
+        masked_lengths = self._wage_lengths[mask]
+        wage_mask = numpy.repeat(mask, self._wage_lengths)
+        wages = self._columns.get_wages()[wage_mask]
+        weights = self._columns.get_weights()[wage_mask]
+        wage_groups = numpy.repeat(inverse, masked_lengths)
+
+        order = numpy.lexsort((wages, wage_groups))
+        wages_sorted = wages[order]
+        weights_sorted = weights[order]
+
+        group_counts = numpy.bincount(wage_groups, minlength=num_groups)
+        group_ends = numpy.cumsum(group_counts)
+        group_starts = group_ends - group_counts
+        group_weights = numpy.bincount(
+            wage_groups,
+            weights=weights,
+            minlength=num_groups
+        )
+
+        def get_median(group):
+            start = group_starts[group]
+            end = group_ends[group]
+
+            if start == end:
+                raise RuntimeError('Unable to get median wage.')
+
+            return find_weighted_quantiles(
+                wages_sorted[start:end],
+                weights_sorted[start:end],
+                group_weights[group],
+                [0.5]
+            )[0]
+
+        return list(map(get_median, range(num_groups)))
+
+    def _get_codes(self, dimension, value):
+        """Get the integer codes matched by a query filter.
+
+        Args:
+            dimension (str): Name of the dimension like docc03.
+            value: The value as it appears on InputRecord or a
+                data_model.Predicate.
+
+        Returns:
+            list: Positions of the matched values within the dimension's
+                catalog.
+        """
+        return data_model.resolve_filter(
+            dimension,
+            value,
+            self._columns.get_catalog(dimension),
+            self._code_by_value[dimension]
+        )
+
+    def _get_mask(self, query):
+        """Determine which records match the given query filters.
+
+        Args:
+            query (data_model.Query): A Query object containing the filter
+                settings for each dimension. Each filter can be set to None to
+                imply no filtering on that dimension.
+
+        Returns:
+            numpy.ndarray: Boolean array which is True for records matching all
+                of the filter criteria.
+        """
+        if self._bitmap_by_dimension is not None:
+            return self._get_mask_bitmap(query)
+
+        mask = numpy.ones(self._columns.get_size(), dtype=bool)
+
+        for dimension in data_model.DIMENSIONS:
+            value = getattr(query, 'get_' + dimension)()
+            if value is None:
+                continue
+
+            codes = self._get_codes(dimension, value)
+            record_codes = self._columns.get_codes(dimension)
+            if len(codes) == 1:
+                mask &= record_codes == codes[0]
+            else:
+                mask &= numpy.isin(record_codes, codes)
+
+        return mask
+
+    def _get_mask_bitmap(self, query):
+        """Determine which records match a query using bitmap indexes.
+
+        Args:
+            query (data_model.Query): A Query object containing the filter
+                settings for each dimension.
+
+        Returns:
+            numpy.ndarray: Boolean array which is True for records matching all
+                of the filter criteria.
+        """
+        num_records = self._columns.get_size()
+        words = None
+
+        for dimension in data_model.DIMENSIONS:
+            value = getattr(query, 'get_' + dimension)()
+            if value is None:
+                continue
+
+            codes = self._get_codes(dimension, value)
+            bitmap_index = self._bitmap_by_dimension[dimension]
+            if len(codes) == 1:
+                bitmap = bitmap_index.get_bitmap(codes[0])
+            else:
+                bitmap = numpy.bitwise_or.reduce(
+                    bitmap_index.get_words()[codes],
+                    axis=0
+                )
+
+            if words is None:
+                words = bitmap.copy()
+            else:
+                numpy.bitwise_and(words, bitmap, out=words)
+
+        if words is None:
+            return numpy.ones(num_records, dtype=bool)
+
+        return unpack_mask(words, num_records)
+
+
+def find_weighted_quantiles(wages, weights, total_weight, quantiles):
+    """Find weighted quantiles within wages sorted in ascending order.
+
+    Like data_model.find_weighted_quantiles, the total is given separately
+    as it is summed in record order while cumulative weight is summed in wage
+    order. Both sums being taken in the same order as data_model.Dataset keeps
+    results equal even when a cumulative weight is within rounding error of
+    a quantile's share of the total.
+
+    Args:
+        wages (numpy.ndarray): Non-empty array of wages sorted ascending.
+        weights (numpy.ndarray): Population weights for each wage.
+        total_weight (float): The sum of weights.
+        quantiles (list): The quantiles to find as numbers from 0 to 1.
+
+    Returns:
+        numpy.ndarray: For each quantile in the order given, the smallest wage
+            at which cumulative weight reaches that share of total_weight or
+            the largest wage if rounding leaves the cumulative weight just
+            short.
+    """
+    weights_acc = numpy.cumsum(weights)
+    targets = total_weight * numpy.array(quantiles, dtype=numpy.float64)
+    positions = numpy.searchsorted(weights_acc, targets, side='left')
+    return wages[numpy.minimum(positions, wages.shape[0] - 1)]
+
+
+def sum_in_order(values):
+    """Sum values one after another like the built-in sum.
+
+    Unlike numpy.sum, which adds pairwise, this gives the same floating point
+    result as summing in a Python loop.
+
+    Args:
+        values (numpy.ndarray): The values to sum.
+
+    Returns:
+        float: The sum or zero if values is empty.
+    """
+    if values.shape[0] == 0:
+        return 0.0
+
+    return float(numpy.cumsum(values)[-1])
+
+
+def make_bitmap_index(codes, catalog_size):
+    """Build bitmaps for every value in a dimension.
+
+    Args:
+        codes (numpy.ndarray): Integer code for each record in the dimension to
+            index.
+        catalog_size (int): The number of distinct values (codes) in the
+            dimension.
+
+    Returns:
+        BitmapIndex: Index with one packed bitmap per code.
+    """
+    num_words = (codes.shape[0] + 63) // 64
+    words = numpy.zeros((catalog_size, num_words), dtype=numpy.uint64)
+
+    for code in range(catalog_size):
+        words[code] = pack_mask(codes == code)
+
+    return BitmapIndex(words)
+
+
+def pack_mask(mask):
+    """Pack a boolean mask into 64 bit words.
+
+    Args:
+        mask (numpy.ndarray): Boolean array with one element per record.
+
+    Returns:
+        numpy.ndarray: Array of uint64 where bit i (little endian) within the
+            flattened words is set if mask[i] is True.
+    """
+    num_words = (mask.shape[0] + 63) // 64
+    packed = numpy.zeros(num_words * 8, dtype=numpy.uint8)
+    packed_bits = numpy.packbits(mask, bitorder='little')
+    packed[:packed_bits.shape[0]] = packed_bits
+    return packed.view(numpy.uint64)
+
+
+def unpack_mask(words, num_records):
+    """Unpack 64 bit words from pack_mask into a boolean mask.
+
+    Args:
+        words (numpy.ndarray): The uint64 words to unpack.
+        num_records (int): The number of records (bits) represented.
+
+    Returns:
+        numpy.ndarray: Boolean array with one element per record.
+    """
+    bits = numpy.unpackbits(
+        words.view(numpy.uint8),
+        count=num_records,
+        bitorder='little'
+    )
+    return bits.view(bool)
+
+
+def get_code_dtype(catalog_size):
+    """Get the smallest unsigned integer type able to hold catalog codes.
+
+    Args:
+        catalog_size (int): The number of distinct values in a dimension.
+
+    Returns:
+        numpy.dtype: Type to use for the codes array.
+    """
+    if catalog_size <= 2 ** 8:
+        return numpy.uint8
+    elif catalog_size <= 2 ** 16:
+        return numpy.uint16
+    else:
+        return numpy.uint32
+
+
+def make_dataset(input_records_iter, **options):
+    """Create a columnar dataset from InputRecords.
+
+    Args:
+        input_records_iter: Iterable over data_model.InputRecord to represent.
+        **options: Keyword arguments like use_bitmaps passed to
+            ColumnarDataset.
+
+    Returns:
+        ColumnarDataset: Dataset holding the given records as arrays.
+    """
+    builder = ColumnsBuilder()
+
+    for record in input_records_iter:
+        builder.add_record(record)
+
+    return ColumnarDataset(builder.build(), **options)
+
+
+def get_file_hash(loc):
+    """Get a hash of the contents of a file.
+
+    Args:
+        loc (str): Path to the file to hash.
+
+    Returns:
+        str: Hex digest of the SHA-256 hash of the file.
+    """
+    digest = hashlib.sha256()
+
+    with open(loc, 'rb') as f:
+        block = f.read(HASH_BLOCK_SIZE)
+        while block:
+            digest.update(block)
+            block = f.read(HASH_BLOCK_SIZE)
+
+    return digest.hexdigest()
+
+
+def get_file_fingerprint(loc):
+    """Describe the current version of a file for snapshot invalidation.
+
+    Args:
+        loc (str): Path to the file.
+
+    Returns:
+        dict: Size in bytes, modification time in nanoseconds, and hash of
+            the file's contents.
+    """
+    stat = os.stat(loc)
+    return {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': get_file_hash(loc)
+    }
+
+
+def save_snapshot(snapshot_dir, dataset, fingerprint):
+    """Write a binary snapshot of a columnar dataset and its indexes.
+
+    Each array is written as its own .npy file such that it may be memory
+    mapped when loaded. Files are named with a new generation such that
+    existing files, which other datasets may have memory mapped, are never
+    modified. The fingerprint naming the generation is then atomically
+    replaced so that an incomplete snapshot is never considered current before
+    files from prior generations are removed.
+
+    Args:
+        snapshot_dir (str): Directory in which to write the snapshot which is
+            created if needed.
+        dataset (ColumnarDataset): The dataset to save.
+        fingerprint (dict): Description of the source CSV from
+            get_file_fingerprint taken before it was parsed.
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+
+    generation = uuid.uuid4().hex
+
+    arrays = get_named_arrays(dataset)
+    for name, values in arrays.items():
+        path = get_snapshot_path(snapshot_dir, name + '.npy', generation)
+        numpy.save(path, values)
+
+    catalogs = get_catalogs(dataset.get_columns())
+    catalogs_path = get_snapshot_path(
+        snapshot_dir,
+        SNAPSHOT_CATALOGS_FILE,
+        generation
+    )
+    write_json_atomic(catalogs_path, catalogs)
+
+    manifest = dict(fingerprint)
+    manifest['version'] = SNAPSHOT_VERSION
+    manifest['generation'] = generation
+    manifest['derived'] = sorted(dataset.get_derived_arrays().keys())
+
+    fingerprint_path = os.path.join(snapshot_dir, SNAPSHOT_FINGERPRINT_FILE)
+    write_json_atomic(fingerprint_path, manifest)
+
+    remove_stale_snapshot_files(snapshot_dir, generation)
+
+
+def load_snapshot(snapshot_dir, loc):
+    """Load a snapshot written by save_snapshot if still current.
+
+    The snapshot is current if the CSV's size matches and either its
+    modification time or content hash matches. The hash is only calculated if
+    the modification time changed in which case the stored time is updated
+    after a match.
+
+    Args:
+        snapshot_dir (str): Directory containing the snapshot.
+        loc (str): Path to the CSV file from which the snapshot was made.
+
+    Returns:
+        tuple: Columns and derived arrays (dict) with memory mapped arrays or
+            None if the snapshot is missing, out of date, or was replaced while
+            loading.
+    """
+    fingerprint_path = os.path.join(snapshot_dir, SNAPSHOT_FINGERPRINT_FILE)
+    if not os.path.exists(fingerprint_path):
+        return None
+
+    with open(fingerprint_path) as f:
+        manifest = json.load(f)
+
+    if manifest.get('version', None) != SNAPSHOT_VERSION:
+        return None
+
+    stat = os.stat(loc)
+    if manifest['size'] != stat.st_size:
+        return None
+
+    if manifest['mtime_ns'] != stat.st_mtime_ns:
+        if manifest['sha256'] != get_file_hash(loc):
+            return None
+
+        manifest['mtime_ns'] = stat.st_mtime_ns
+        write_json_atomic(fingerprint_path, manifest)
+
+    generation = manifest['generation']
+
+    def load_array(name):
+        path = get_snapshot_path(snapshot_dir, name + '.npy', generation)
+        values = numpy.load(path, mmap_mode='r')
+        return values if values.size > 0 else numpy.load(path)
+
+    catalogs_path = get_snapshot_path(
+        snapshot_dir,
+        SNAPSHOT_CATALOGS_FILE,
+        generation
+    )
+
+    try:
+        with open(catalogs_path) as f:
+            catalogs = json.load(f)
+
+        return make_from_named_arrays(
+            load_array,
+            catalogs,
+            manifest['derived']
+        )
+    except FileNotFoundError:
+        return None
+
+
+def get_snapshot_path(snapshot_dir, filename, generation):
+    """Get the path of a file within one generation of a snapshot.
+
+    Args:
+        snapshot_dir (str): Directory containing the snapshot.
+        filename (str): Name of the file like wages.npy.
+        generation (str): Unique identifier of the snapshot generation.
+
+    Returns:
+        str: Path like snapshot_dir/wages.<generation>.npy.
+    """
+    base, extension = os.path.splitext(filename)
+    return os.path.join(
+        snapshot_dir,
+        '%s.%s%s' % (base, generation, extension)
+    )
+
+
+def write_json_atomic(path, value):
+    """Write a JSON file such that readers see either the old or new contents.
+
+    Args:
+        path (str): The path of the file to replace.
+        value: The value to serialize.
+    """
+    temp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    with open(temp_path, 'w') as f:
+        json.dump(value, f)
+
+    os.replace(temp_path, path)
+
+
+def remove_stale_snapshot_files(snapshot_dir, generation):
+    """Remove array and catalog files not from the current generation.
+
+    Datasets which memory mapped the removed files keep their mappings.
+
+    Args:
+        snapshot_dir (str): Directory containing the snapshot.
+        generation (str): The generation named in the current fingerprint.
+    """
+    current_suffixes = list(map(
+        lambda x: '.%s%s' % (generation, x),
+        ['.npy', '.json']
+    ))
+
+    def is_stale(filename):
+        if filename == SNAPSHOT_FINGERPRINT_FILE:
+            return False
+        elif not filename.endswith('.npy') and not filename.endswith('.json'):
+            return False
+        else:
+            return not any(map(filename.endswith, current_suffixes))
+
+    for filename in filter(is_stale, os.listdir(snapshot_dir)):
+        try:
+            os.remove(os.path.join(snapshot_dir, filename))
+        except FileNotFoundError:
+            pass
+
+
+def get_named_arrays(dataset):
+    """Get every array needed to recreate a columnar dataset by name.
+
+    Args:
+        dataset (ColumnarDataset): The dataset whose arrays should be returned.
+
+    Returns:
+        dict: Mapping from name to array for the columns and, prefixed with
+            derived_, the indexes from get_derived_arrays.
+    """
+    columns = dataset.get_columns()
+    arrays = {
+        'index': columns.get_index(),
+        'unemp': columns.get_unemp(),
+        'wage_count': columns.get_wage_count(),
+        'unemp_count': columns.get_unemp_count(),
+        'wages': columns.get_wages(),
+        'weights': columns.get_weights(),
+        'wage_offsets': columns.get_wage_offsets()
+    }
+
+    for dimension in data_model.DIMENSIONS:
+        arrays['codes_' + dimension] = columns.get_codes(dimension)
+
+    derived_arrays = dataset.get_derived_arrays()
+    for name, derived_array in derived_arrays.items():
+        arrays['derived_' + name] = derived_array
+
+    return arrays
+
+
+def get_catalogs(columns):
+    """Get the catalog of every dimension.
+
+    Args:
+        columns (Columns): The columns whose catalogs should be returned.
+
+    Returns:
+        dict: Mapping from dimension name to list of values by code.
+    """
+    return dict(map(
+        lambda x: (x, columns.get_catalog(x)),
+        data_model.DIMENSIONS
+    ))
+
+
+def make_from_named_arrays(get_array, catalogs, derived_names):
+    """Recreate the columns and indexes described by get_named_arrays.
+
+    Args:
+        get_array (callable): Function taking an array name as given by
+            get_named_arrays and returning that array.
+        catalogs (dict): Mapping from dimension name to list of values by code
+            as given by get_catalogs.
+        derived_names (list): Names of the derived arrays without prefix.
+
+    Returns:
+        tuple: Columns and derived arrays (dict) which may be passed to
+            ColumnarDataset.
+    """
+    columns = Columns(
+        get_array('index'),
+        dict(map(
+            lambda x: (x, get_array('codes_' + x)),
+            data_model.DIMENSIONS
+        )),
+        catalogs,
+        get_array('unemp'),
+        get_array('wage_count'),
+        get_array('unemp_count'),
+        get_array('wages'),
+        get_array('weights'),
+        get_array('wage_offsets')
+    )
+
+    derived_arrays = dict(map(
+        lambda x: (x, get_array('derived_' + x)),
+        derived_names
+    ))
+
+    return (columns, derived_arrays)
+
+
+def load_from_file(loc, sketch=None, chunk_size=DEFAULT_CHUNK_SIZE,
+        snapshot_dir=None, **options):
+    """Load a columnar dataset from a CSV file.
+
+    Streams rows into a ColumnsBuilder in chunks without creating InputRecords
+    or keeping the raw rows such that peak memory follows the size of the
+    resulting arrays.
+
+    Args:
+        loc (str): The location of the CSV file from which to parse records.
+        sketch (sketchingpy.Sketch2D): The sketch to use to load the file or,
+            if None, uses a regular file. Defaults to None.
+        chunk_size (int): Number of rows to parse at a time. Defaults to
+            DEFAULT_CHUNK_SIZE.
+        snapshot_dir (str): Optional directory in which to keep a binary
+            snapshot of the parsed dataset and its indexes. If a current
+            snapshot is found, it is memory mapped instead of parsing the CSV.
+            Otherwise the CSV is parsed and a new snapshot written. Ignored if
+            sketch is given. Defaults to None in which case no snapshot is
+            used.
+        **options: Keyword arguments like use_bitmaps passed to
+            ColumnarDataset.
+
+    Returns:
+        ColumnarDataset: Dataset parsed from the given location.
+    """
+    use_snapshot = snapshot_dir is not None and not sketch
+
+    if use_snapshot:
+        snapshot = load_snapshot(snapshot_dir, loc)
+        if snapshot is not None:
+            columns, derived_arrays = snapshot
+            return ColumnarDataset(
+                columns,
+                derived_arrays=derived_arrays,
+                **options
+            )
+
+        fingerprint = get_file_fingerprint(loc)
+
+    builder = ColumnsBuilder()
+
+    if sketch:
+        data_layer = sketch.get_data_layer()
+        records_raw = data_layer.get_csv(loc)
+        for chunk in data_model.iterate_chunks(records_raw, chunk_size):
+            builder.add_raw_chunk(chunk)
+    else:
+        with open(loc) as f:
+            reader = csv.DictReader(f)
+            for chunk in data_model.iterate_chunks(reader, chunk_size):
+                builder.add_raw_chunk(chunk)
+
+    dataset = ColumnarDataset(builder.build(), **options)
+
+    if use_snapshot:
+        save_snapshot(snapshot_dir, dataset, fingerprint)
+
+    return dataset
@@ -3,14 +3,63 @@
 Author: A Samuel Pottinger
 License: MIT License
 """
+import abc
+import array
+import bisect
+import collections
 import csv
 import itertools
+import numbers
+import operator
 import functools
+import heapq
+import re
+import sys
+import threading
+import time
+
+import quantile_sketch
+
+DIMENSIONS = [
+    'educ',
+    'docc03',
+    'wbhaom',
+    'female',
+    'region',
+    'age',
+    'hoursuint',
+    'citistat'
+]
+
+METRICS = [
+    'size',
+    'unemp',
+    'wageotc'
+]
+
+MEDIAN_STRATEGIES = [
+    'select',
+    'presorted'
+]
+
+DEFAULT_CACHE_SIZE = 1024
+SELECT_SORT_SIZE = 64
+COMPACT_FRACTION = 0.25
+
+EDUC_ORDER = [
+    'Less than high school',
+    'High school',
+    'Some college',
+    'College',
+    'Advanced'
+]
 
 
 class WageTuple:
     """Record representing a tuple for wage information."""
 
+    __slots__ = ('_wage', '_weight')
+
     def __init__(self, wage, weight):
         """
         Initialize the WageTuple with wage and weight.
@@ -39,8 +88,69 @@ class WageTuple:
         return self._weight
 
 
+class HistogramBin:
+    """Record describing the weight of wages within a range."""
+
+    def __init__(self, start, end, weight):
+        """Create a new bin.
+
+        Args:
+            start (float): The minimum wage in USD for this bin.
+            end (float): The maximum wage in USD for this bin.
+            weight (float): The population weight of wages in this bin.
+        """
+        self._start = start
+        self._end = end
+        self._weight = weight
+
+    def get_start(self):
+        """Get the start of the range covered by this bin.
+
+        Returns:
+            float: Minimum wage in USD (inclusive).
+        """
+        return self._start
+
+    def get_end(self):
+        """Get the end of the range covered by this bin.
+
+        Returns:
+            float: Maximum wage in USD which is exclusive except for the last
+                bin in a histogram.
+        """
+        return self._end
+
+    def get_weight(self):
+        """Get the population weight of wages in this bin.
+
+        Returns:
+            float: Sum of weights proportional to population size.
+        """
+        return self._weight
+
+
 class InputRecord:
-    """A representation of an income dataset record."""
+    """A representation of an income dataset record.
+
+    Uses slots instead of a per-instance dictionary to reduce memory as one
+    instance is kept per row.
+    """
+
+    __slots__ = (
+        '_index',
+        '_educ',
+        '_docc03',
+        '_wageotc',
+        '_unemp',
+        '_wage_count',
+        '_unemp_count',
+        '_wbhaom',
+        '_female',
+        '_region',
+        '_age',
+        '_hoursuint',
+        '_citistat'
+    )
 
     def __init__(self, index, educ, docc03, wageotc, unemp, wage_count,
             unemp_count, wbhaom, female, region, age, hoursuint, citistat):
@@ -66,7 +176,7 @@ class InputRecord:
         self._index = index
         self._educ = educ
         self._docc03 = docc03
-        self._wageotc = list(wageotc)
+        self._wageotc = tuple(wageotc)
         self._unemp = unemp
         self._wage_count = wage_count
         self._unemp_count = unemp_count
@@ -106,7 +216,7 @@ class InputRecord:
         """Get wage information.
 
         Returns:
-            List of WageTuple: Hourly wage in USD including tips, commission,
+            Tuple of WageTuple: Hourly wage in USD including tips, commission,
                 and overtime, with population weights.
         """
         return self._wageotc
@@ -193,7 +303,8 @@ class Query:
 
     This class provides a way to filter a dataset by specifying values for
     different dimensions. When a dimension is set to None, no filtering is
-    applied for that dimension.
+    applied for that dimension. In place of a single value, a dimension may be
+    set to a Predicate like OneOfFilter, NotFilter, or RangeFilter.
     """
 
     def __init__(self):
@@ -387,366 +498,3133 @@ class Query:
         """Clear the filter for citizenship status."""
         self._citistat = None
 
+    def freeze(self):
+        """Create an immutable and hashable copy of this query.
 
-class Dataset:
-    """Class to query a dataset made up of InputRecords."""
+        Returns:
+            FrozenQuery: Query with the same filters which cannot be modified.
+        """
+        return FrozenQuery(
+            educ=self._educ,
+            docc03=self._docc03,
+            wbhaom=self._wbhaom,
+            female=self._female,
+            region=self._region,
+            age=self._age,
+            hoursuint=self._hoursuint,
+            citistat=self._citistat
+        )
 
-    def __init__(self, input_records_iter):
-        """Create a new dataset.
+
+class FrozenQuery:
+    """Immutable and hashable version of Query.
+
+    Offers the same getters as Query such that it can be passed to Dataset
+    methods but cannot be changed after creation, allowing it to be used as a
+    dictionary key like for caching results.
+    """
+
+    def __init__(self, educ=None, docc03=None, wbhaom=None, female=None,
+            region=None, age=None, hoursuint=None, citistat=None):
+        """Create a new frozen query.
 
         Args:
-            iterable: Iterable over InputRecord to represent.
+            educ (str or None): The education level to filter for.
+            docc03 (str or None): The occupation to filter for.
+            wbhaom (str or None): The race/ethnicity to filter for.
+            female (bool or None): True to filter for Female and False to
+                filter for Male.
+            region (str or None): The region to filter for.
+            age (str or None): The age group to filter for.
+            hoursuint (str or None): The hours worked category to filter for.
+            citistat (str or None): The citizenship status to filter for.
+
+        All default to None meaning no filtering is applied for that dimension.
         """
-        input_records = list(input_records_iter)
-        self._records_by_id = dict(map(
-            lambda x: (x.get_index(), x),
-            input_records
-        ))
-        self._id_by_educ = self._make_index(
-            lambda x: x.get_educ(),
-            input_records
-        )
-        self._id_by_docc03 = self._make_index(
-            lambda x: x.get_docc03(),
-            input_records
-        )
-        self._id_by_wbhaom = self._make_index(
-            lambda x: x.get_wbhaom(),
-            input_records
-        )
-        self._id_by_female = self._make_index(
-            lambda x: x.get_female(),
-            input_records
-        )
-        self._id_by_region = self._make_index(
-            lambda x: x.get_region(),
-            input_records
-        )
-        self._id_by_age = self._make_index(
-            lambda x: x.get_age(),
-            input_records
-        )
-        self._id_by_hoursuint = self._make_index(
-            lambda x: x.get_hoursuint(),
-            input_records
-        )
-        self._id_by_citistat = self._make_index(
-            lambda x: x.get_citistat(),
-            input_records
+        self._values = (
+            educ,
+            docc03,
+            wbhaom,
+            female,
+            region,
+            age,
+            hoursuint,
+            citistat
         )
 
-    def get_wageotc(self, query):
-        """Get median wage for a group with overtime, tips, and comissions.
-
-        Args:
-            query (Query): A Query object describing the population for which
-                the median wage should be returned.
+    def get_educ(self):
+        """Get the education level filter.
 
         Returns:
-            float: The estimated median wage for the given population in USD.
+            str or None: The education level to filter for or None.
         """
-        subpopulation = self._get_subpopulation(query)
-        wages_nested = map(lambda x: x.get_wageotc(), subpopulation)
-        wages_iter = itertools.chain(*wages_nested)
-        wages = list(wages_iter)
+        return self._values[0]
 
-        total_count = sum(map(lambda x: x.get_weight(), wages))
-        mid_count = total_count / 2
+    def get_docc03(self):
+        """Get the occupation filter.
 
-        wages.sort(key=lambda x: x.get_wage())
-        weight_acc = 0
-        for wage in wages:
-            weight = wage.get_weight()
+        Returns:
+            str or None: The occupation to filter for or None.
+        """
+        return self._values[1]
 
-            if weight_acc + weight >= mid_count:
-                return wage.get_wage()
+    def get_wbhaom(self):
+        """Get the race/ethnicity filter.
 
-            weight_acc += wage.get_weight()
+        Returns:
+            str or None: The race/ethnicity to filter for or None.
+        """
+        return self._values[2]
 
-        raise RuntimeError('Unable to get median wage.')
+    def get_female(self):
+        """Get the gender filter.
 
-    def get_unemp(self, query):
-        """Get the overall unemployment rate for a group.
+        Returns:
+            bool or None: True to filter for Female, False to filter for Male,
+                or None.
+        """
+        return self._values[3]
 
-        Args:
-            query (Query): A Query object describing the population for which
-                the unemployemnt rate should be returned.
+    def get_region(self):
+        """Get the geographic region filter.
 
         Returns:
-            float: The estimated unemployment rate for the specified group as
-                a percentage between 0 and 100.
+            str or None: The region to filter for or None.
         """
-        subpopulation = self._get_subpopulation(query)
-        unemp_tuples = map(
-            lambda x: (x.get_unemp_count(), x.get_unemp()),
-            subpopulation
-        )
-        weighted_tuples = map(lambda x: (x[0], x[0] * x[1]), unemp_tuples)
-        reduced = functools.reduce(
-            lambda a, b: (a[0] + b[0], a[1] + b[1]),
-            weighted_tuples
-        )
-        return reduced[1] / reduced[0]
-
-    def get_size(self, query):
-        """Get the size of a population as summed census weight.
+        return self._values[4]
 
-        Args:
-            query (Query): A Query object describing the population for which
-                the size should be returned.
+    def get_age(self):
+        """Get the age group filter.
 
         Returns:
-            float: Estimated size of this population as a weight. This is
-                propotional to the size of the population represented. Note
-                that this uses the wage count though the wage and unemployemnt
-                count are often the same.
+            str or None: The age group to filter for or None.
         """
-        subpopulation = self._get_subpopulation(query)
-        wage_counts = map(lambda x: x.get_wage_count(), subpopulation)
-        return sum(wage_counts)
+        return self._values[5]
 
-    def get_max_wage(self):
-        """Get the maximum wage value across all records in the dataset.
+    def get_hoursuint(self):
+        """Get the hours worked filter.
 
         Returns:
-            float: The maximum hourly wage value in USD found in the dataset.
+            str or None: The hours worked category to filter for or None.
         """
-        records = self._records_by_id.values()
-        wages_nest = map(lambda x: x.get_wageotc(), records)
-        wages = itertools.chain(*wages_nest)
-        wages_raw = map(lambda x: x.get_wage(), wages)
-        return max(wages_raw)
+        return self._values[6]
 
-    def get_max_unemployment(self):
-        """Get the maximum unemployment rate across all records in the dataset.
+    def get_citistat(self):
+        """Get the citizenship status filter.
 
         Returns:
-            float: The maximum unemployment rate as a percentage (0-100)
-                found in the dataset.
+            str or None: The citizenship status to filter for or None.
         """
-        records = self._records_by_id.values()
-        unemployments = map(lambda x: x.get_unemp(), records)
-        return max(unemployments)
+        return self._values[7]
 
-    def get_educ_vals(self):
-        """Get all unique education level values in the dataset.
+    def freeze(self):
+        """Get an immutable version of this query.
 
         Returns:
-            list: Sorted list of education level labels.
+            FrozenQuery: This query which is already immutable.
         """
-        return sorted(self._id_by_educ.keys())
+        return self
 
-    def get_docc03_vals(self):
-        """Get all unique occupation classification values in the dataset.
+    def to_query(self):
+        """Create a mutable copy of this query.
 
         Returns:
-            list: Sorted list of occupation classification labels.
+            Query: New Query with the same filters.
         """
-        return sorted(self._id_by_docc03.keys())
+        query = Query()
 
-    def get_wbhaom_vals(self):
-        """Get all unique race and ethnicity values in the dataset.
+        for dimension, value in zip(DIMENSIONS, self._values):
+            getattr(query, 'set_' + dimension)(value)
+
+        return query
+
+    def __eq__(self, other):
+        """Determine if another frozen query has the same filters.
+
+        Args:
+            other: The object to compare.
 
         Returns:
-            list: Sorted list of race and ethnicity labels.
+            bool: True if other is a FrozenQuery with the same filters.
         """
-        return sorted(self._id_by_wbhaom.keys())
+        if not isinstance(other, FrozenQuery):
+            return False
 
-    def get_female_vals(self):
-        """Get all unique gender values in the dataset.
+        return self._values == other._values
+
+    def __hash__(self):
+        """Get a hash of the filters in this query.
 
         Returns:
-            list: Sorted list of gender values (typically [False, True]).
+            int: Hash consistent with __eq__.
         """
-        return sorted(self._id_by_female.keys())
+        return hash(self._values)
 
-    def get_region_vals(self):
-        """Get all unique geographic region values in the dataset.
+
+class Predicate(abc.ABC):
+    """Abstract base class for filters which match more than a single value.
+
+    Instances may be given to Query setters in place of a value and are
+    evaluated by combining the per-value indexes. Predicates are immutable and
+    hashable such that queries using them may be cached.
+    """
+
+    def __eq__(self, other):
+        """Determine if another predicate matches the same values.
+
+        Args:
+            other: The object to compare.
 
         Returns:
-            list: Sorted list of region labels.
+            bool: True if other is the same type of predicate with the same
+                arguments.
         """
-        return sorted(self._id_by_region.keys())
+        if type(other) is not type(self):
+            return False
 
-    def get_age_vals(self):
-        """Get all unique age group values in the dataset.
+        return self._get_key() == other._get_key()
+
+    def __hash__(self):
+        """Get a hash of the predicate's arguments.
 
         Returns:
-            list: Sorted list of age group labels.
+            int: Hash consistent with __eq__.
         """
-        return sorted(self._id_by_age.keys())
+        return hash((type(self).__name__, self._get_key()))
 
-    def get_hoursuint_vals(self):
-        """Get all unique hours worked category values in the dataset.
+    @abc.abstractmethod
+    def _get_key(self):
+        """Get the arguments describing this predicate.
 
         Returns:
-            list: Sorted list of hours worked category labels.
+            tuple: Hashable description of the predicate.
         """
-        return sorted(self._id_by_hoursuint.keys())
 
-    def get_citistat_vals(self):
-        """Get all unique citizenship status values in the dataset.
+
+class OneOfFilter(Predicate):
+    """Predicate matching any of a set of values."""
+
+    def __init__(self, values):
+        """Create a new set membership filter.
+
+        Args:
+            values (iterable): The values to allow like ['South', 'West'].
+        """
+        self._values = frozenset(values)
+
+    def get_values(self):
+        """Get the values allowed by this filter.
 
         Returns:
-            list: Sorted list of citizenship status labels.
+            frozenset: The allowed values.
         """
-        return sorted(self._id_by_citistat.keys())
+        return self._values
 
-    def _get_subpopulation(self, query):
-        """Retrieves part of the dataset based on the given query filters.
+    def _get_key(self):
+        return (self._values,)
 
-        This method filters the dataset according to the dimensions specified in
-        the query object and returns only the subset of records that match all
-        the provided filtering criteria.
+
+class NotFilter(Predicate):
+    """Predicate matching everything except a value or another predicate."""
+
+    def __init__(self, inner):
+        """Create a new negation filter.
 
         Args:
-            query (Query): A Query object containing the filter settings for
-                each dimension (e.g., education, occupation, race/ethnicity,
-                gender, etc.). Each filter can be set to None to imply no
-                filtering on that dimension.
+            inner: The value or Predicate whose matches should be excluded.
+        """
+        self._inner = inner
+
+    def get_inner(self):
+        """Get the value or predicate which is excluded.
 
         Returns:
-            map: A map object containing the records that match all the filter
-                criteria, where each record is an instance of InputRecord.
+            The excluded value or Predicate.
         """
-        def filter_value(accumulator_index, filter_index, filter_value):
-            if filter_value is None:
-                return accumulator_index
+        return self._inner
 
-            if filter_value not in filter_index:
-                filter_str = str(filter_value)
-                message = 'Cannot find the provided value: %s' % filter_str
-                raise RuntimeError(message)
+    def _get_key(self):
+        return (self._inner,)
 
-            allowed = filter_index[filter_value]
-            return allowed.intersection(accumulator_index)
 
-        ret_index = set(self._records_by_id.keys())
-        ret_index = filter_value(
-            ret_index,
-            self._id_by_educ,
-            query.get_educ()
-        )
-        ret_index = filter_value(
-            ret_index,
-            self._id_by_docc03,
-            query.get_docc03()
-        )
-        ret_index = filter_value(
-            ret_index,
-            self._id_by_wbhaom,
-            query.get_wbhaom()
-        )
-        ret_index = filter_value(
-            ret_index,
-            self._id_by_female,
-            query.get_female()
-        )
-        ret_index = filter_value(
-            ret_index,
-            self._id_by_region,
-            query.get_region()
-        )
-        ret_index = filter_value(
-            ret_index,
-            self._id_by_age,
-            query.get_age()
-        )
-        ret_index = filter_value(
-            ret_index,
-            self._id_by_hoursuint,
-            query.get_hoursuint()
-        )
-        ret_index = filter_value(
-            ret_index,
-            self._id_by_citistat,
-            query.get_citistat()
-        )
+class RangeFilter(Predicate):
+    """Predicate matching values of an ordered dimension within a range.
 
-        return map(lambda x: self._records_by_id[x], ret_index)
+    Only supported for dimensions with a natural order (age and educ) as given
+    by get_category_sort_key.
+    """
 
-    def _make_index(self, getter, records):
-        """Create an index mapping distinct attribute values to record IDs.
+    def __init__(self, start=None, end=None):
+        """Create a new range filter.
 
         Args:
-            getter (callable): A function to extract the desired attribute for
-                indexing from a record.
-            records (iterable): A collection of records to index based on the
-                extracted attribute.
+            start: The minimum value (inclusive) or None if unbounded. Must be
+                a value found in the dataset queried.
+            end: The maximum value (inclusive) or None if unbounded. Must be a
+                value found in the dataset queried.
+        """
+        self._start = start
+        self._end = end
+
+    def get_start(self):
+        """Get the lower bound of the range.
 
         Returns:
-            dict: A dictionary where each key is a distinct attribute value
-                and each value is a set of record IDs that have that attribute.
+            The minimum value (inclusive) or None if unbounded.
         """
-        index = {}
+        return self._start
 
-        for record in records:
-            value = getter(record)
-            sub_index = index.get(value, set())
-            sub_index.add(record.get_index())
-            index[value] = sub_index
+    def get_end(self):
+        """Get the upper bound of the range.
 
-        return index
+        Returns:
+            The maximum value (inclusive) or None if unbounded.
+        """
+        return self._end
 
+    def _get_key(self):
+        return (self._start, self._end)
 
-def parse_wage_otc(wage_otc_string):
-    tuple_unparsed = wage_otc_string.split(';')
-    tuple_strs = map(lambda x: x.split(' '), tuple_unparsed)
-    tuple_parsed = map(lambda x: (float(x[0]), float(x[1])), tuple_strs)
-    return map(lambda x: WageTuple(x[0], x[1]), tuple_parsed)
 
+class ResultCache:
+    """Least recently used cache of query results with hit / miss counters."""
 
-def parse_record(record_raw):
-    index = int(record_raw['index'])
-    educ = str(record_raw['educ'])
-    docc03 = str(record_raw['docc03'])
-    wageotc = parse_wage_otc(record_raw['wageotc'])
-    unemp = float(record_raw['unemp'])
-    wage_count = float(record_raw['wageCount'])
-    unemp_count = float(record_raw['unempCount'])
-    wbhaom = str(record_raw['wbhaom'])
-    female = str(record_raw['female']) == 'Female'
-    region = str(record_raw['region'])
-    age = str(record_raw['age'])
-    hoursuint = str(record_raw['hoursuint'])
-    citistat = str(record_raw['citistat'])
+    def __init__(self, capacity):
+        """Create a new empty cache.
 
-    return InputRecord(
-        index,
-        educ,
-        docc03,
-        wageotc,
-        unemp,
-        wage_count,
-        unemp_count,
-        wbhaom,
-        female,
-        region,
-        age,
-        hoursuint,
-        citistat
-    )
+        Args:
+            capacity (int): Maximum number of results to keep after which the
+                least recently used is evicted.
+        """
+        self._capacity = capacity
+        self._results = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
 
+    def get_or_calculate(self, key, calculate):
+        """Get a cached result, calculating and storing it if not present.
 
-def load_from_file(loc, sketch=None):
-    """Load a dataset from a CSV file.
+        Args:
+            key: Hashable key identifying the result.
+            calculate (callable): Function taking no arguments which returns
+                the result if it is not cached.
 
-    Args:
-        loc (str): The location of the CSV file from which to parse
-            InputRecords.
-        sketch (sketchingpy.Sketch2D): The sketch to use to load the file or,
-            if None, uses a regular file. Defaults to None.
+        Returns:
+            The cached or newly calculated result.
+        """
+        if key in self._results:
+            self._hits += 1
+            self._results.move_to_end(key)
+            return self._results[key]
 
-    Returns:
-        Dataset parsed from the given location.
-    """
-    if sketch:
-        data_layer = sketch.get_data_layer()
-        records = data_layer.get_csv(loc)
+        self._misses += 1
+        result = calculate()
+
+        self._results[key] = result
+        if len(self._results) > self._capacity:
+            self._results.popitem(last=False)
+
+        return result
+
+    def get_capacity(self):
+        """Get the maximum number of results kept.
+
+        Returns:
+            int: Capacity of this cache.
+        """
+        return self._capacity
+
+    def get_hits(self):
+        """Get the number of lookups answered from the cache.
+
+        Returns:
+            int: Count of cache hits since creation.
+        """
+        return self._hits
+
+    def get_misses(self):
+        """Get the number of lookups which required calculation.
+
+        Returns:
+            int: Count of cache misses since creation.
+        """
+        return self._misses
+
+    def clear(self):
+        """Remove all cached results without resetting counters."""
+        self._results.clear()
+
+
+class AggregateCube:
+    """Materialized data cube of weighted sums for additive metrics.
+
+    Precomputes the wage count, unemployment count, and unemployment count
+    weighted unemployment for each combination of values within sets of
+    dimensions including an "all" roll-up (None like in Query) for each
+    dimension. Queries filtering only on a materialized set of dimensions can
+    then be answered with a single lookup. Each configured set of dimensions
+    is aggregated from the records separately such that memory follows the
+    product of the cardinalities within each set rather than across all sets.
+    """
+
+    def __init__(self, records, dimension_sets):
+        """Create a new cube from a collection of records.
+
+        Args:
+            records (iterable): The InputRecords to aggregate.
+            dimension_sets (list): List of lists of dimension names to
+                materialize like [['docc03', 'female'], ['wbhaom', 'female']].
+                Every subset of each list is also materialized such that
+                queries using only some of those dimensions can be answered.
+                Pass [DIMENSIONS] for a full cube.
+        """
+        getters = list(map(get_dimension_getter, DIMENSIONS))
+
+        cuboids = set()
+        for dimension_set in dimension_sets:
+            for dimension in dimension_set:
+                get_dimension_getter(dimension)
+
+            for size in range(0, len(dimension_set) + 1):
+                combinations = itertools.combinations(dimension_set, size)
+                cuboids.update(map(frozenset, combinations))
+
+        configured = set(map(frozenset, dimension_sets))
+        base_cuboids = list(filter(
+            lambda x: not any(map(lambda y: x < y, configured)),
+            configured
+        ))
+        self._cells_by_cuboid = dict(map(lambda x: (x, {}), base_cuboids))
+
+        for record in records:
+            values = tuple(map(lambda x: x(record), getters))
+            unemp_count = record.get_unemp_count()
+            wage_count = record.get_wage_count()
+            weighted_unemp = unemp_count * record.get_unemp()
+
+            for base_cuboid in base_cuboids:
+                key = tuple(map(
+                    lambda x: x[1] if x[0] in base_cuboid else None,
+                    zip(DIMENSIONS, values)
+                ))
+                cell = self._cells_by_cuboid[base_cuboid].setdefault(
+                    key,
+                    [0, 0, 0, 0]
+                )
+                cell[0] += wage_count
+                cell[1] += unemp_count
+                cell[2] += weighted_unemp
+                cell[3] += 1
+
+        cuboids_by_size = sorted(cuboids, key=lambda x: -len(x))
+        for cuboid in cuboids_by_size:
+            if cuboid in self._cells_by_cuboid:
+                continue
+
+            self._cells_by_cuboid[cuboid] = self._roll_up(cuboid)
+
+        self._cells_by_cuboid = dict(filter(
+            lambda x: x[0] in cuboids,
+            self._cells_by_cuboid.items()
+        ))
+
+    def has_cuboid(self, dimensions):
+        """Determine if a set of filtered dimensions was materialized.
+
+        Args:
+            dimensions (iterable): Names of the dimensions being filtered.
+
+        Returns:
+            bool: True if a query filtering on exactly these dimensions can be
+                answered from this cube and False otherwise.
+        """
+        return frozenset(dimensions) in self._cells_by_cuboid
+
+    def get_cell(self, query):
+        """Get the precomputed sums for a query.
+
+        Args:
+            query (Query): The query for which sums are requested.
+
+        Returns:
+            list: Wage count sum, unemployment count sum, unemployment count
+                weighted unemployment sum, and number of records or None if no
+                records match or the query's dimensions were not materialized.
+        """
+        key = tuple(map(lambda x: get_dimension_getter(x)(query), DIMENSIONS))
+        cuboid = frozenset(map(
+            lambda x: x[0],
+            filter(lambda x: x[1] is not None, zip(DIMENSIONS, key))
+        ))
+
+        if cuboid not in self._cells_by_cuboid:
+            return None
+
+        return self._cells_by_cuboid[cuboid].get(key, None)
+
+    def _roll_up(self, cuboid):
+        """Calculate a cuboid from the smallest materialized parent.
+
+        Args:
+            cuboid (frozenset): The names of the dimensions to keep.
+
+        Returns:
+            dict: Mapping from key (tuple with None for rolled up dimensions) to
+                the sums for that cell.
+        """
+        parents = filter(
+            lambda x: cuboid < x[0],
+            self._cells_by_cuboid.items()
+        )
+        parent_cells = min(parents, key=lambda x: len(x[1]))[1]
+        keep = list(map(lambda x: x in cuboid, DIMENSIONS))
+
+        cells = {}
+        for parent_key, parent_cell in parent_cells.items():
+            key = tuple(map(
+                lambda x: x[1] if x[0] else None,
+                zip(keep, parent_key)
+            ))
+            cell = cells.setdefault(key, [0, 0, 0, 0])
+            cell[0] += parent_cell[0]
+            cell[1] += parent_cell[1]
+            cell[2] += parent_cell[2]
+            cell[3] += parent_cell[3]
+
+        return cells
+
+    def add_record(self, record):
+        """Add a record's values to every materialized cell it belongs to.
+
+        Args:
+            record (InputRecord): The record to add.
+        """
+        self._update_cells(record, 1)
+
+    def remove_record(self, record):
+        """Subtract a record's values from every cell it belongs to.
+
+        Args:
+            record (InputRecord): The record to remove which must have been
+                added to this cube.
+        """
+        self._update_cells(record, -1)
+
+    def _update_cells(self, record, sign):
+        """Add or subtract a record's values from its cells.
+
+        Cells without any remaining records are removed.
+
+        Args:
+            record (InputRecord): The record to add or subtract.
+            sign (int): 1 to add or -1 to subtract.
+        """
+        values = tuple(map(
+            lambda x: get_dimension_getter(x)(record),
+            DIMENSIONS
+        ))
+        wage_count = record.get_wage_count()
+        unemp_count = record.get_unemp_count()
+        weighted_unemp = unemp_count * record.get_unemp()
+
+        for cuboid, cells in self._cells_by_cuboid.items():
+            key = tuple(map(
+                lambda x: x[1] if x[0] in cuboid else None,
+                zip(DIMENSIONS, values)
+            ))
+            cell = cells.setdefault(key, [0, 0, 0, 0])
+            cell[0] += sign * wage_count
+            cell[1] += sign * unemp_count
+            cell[2] += sign * weighted_unemp
+            cell[3] += sign
+
+            if cell[3] == 0:
+                del cells[key]
+
+
+class WageSketchCube:
+    """Mergeable wage sketches for each combination of dimension values.
+
+    Keeps a quantile_sketch.WageSketch per cell (distinct combination of values
+    for a set of dimensions) such that approximate medians for a query can be
+    found by merging the sketches of matching cells, taking time proportional to
+    the number of cells touched instead of the number of wages.
+    """
+
+    def __init__(self, records, dimensions, relative_accuracy):
+        """Create sketches for each cell from a collection of records.
+
+        Args:
+            records (iterable): The InputRecords to sketch.
+            dimensions (list): Names of the dimensions defining cells like
+                ['docc03', 'female', 'wbhaom'].
+            relative_accuracy (float): Error bound for the sketches.
+        """
+        for dimension in dimensions:
+            get_dimension_getter(dimension)
+
+        self._dimensions = list(dimensions)
+        self._relative_accuracy = relative_accuracy
+        self._sketch_by_cell = {}
+
+        for record in records:
+            self.add_record(record)
+
+    def add_record(self, record):
+        """Add a record's wages to the sketch for its cell.
+
+        Args:
+            record (InputRecord): The record to add.
+        """
+        key = tuple(map(
+            lambda x: get_dimension_getter(x)(record),
+            self._dimensions
+        ))
+
+        if key not in self._sketch_by_cell:
+            sketch = quantile_sketch.WageSketch(self._relative_accuracy)
+            self._sketch_by_cell[key] = sketch
+
+        sketch = self._sketch_by_cell[key]
+        for wage in record.get_wageotc():
+            sketch.add(wage.get_wage(), wage.get_weight())
+
+    def remove_record(self, record):
+        """Remove a record's wages from the sketch for its cell.
+
+        Args:
+            record (InputRecord): The record to remove which must have been
+                added.
+        """
+        key = tuple(map(
+            lambda x: get_dimension_getter(x)(record),
+            self._dimensions
+        ))
+
+        sketch = self._sketch_by_cell[key]
+        for wage in record.get_wageotc():
+            sketch.remove(wage.get_wage(), wage.get_weight())
+
+    def can_answer(self, query):
+        """Determine if a query only filters on sketched dimensions.
+
+        Args:
+            query (Query): The query to check.
+
+        Returns:
+            bool: True if get_sketch can be used for the query and False
+                otherwise including if the query uses a Predicate.
+        """
+        if has_predicates(query):
+            return False
+
+        unsketched = filter(lambda x: x not in self._dimensions, DIMENSIONS)
+        return all(map(
+            lambda x: get_dimension_getter(x)(query) is None,
+            unsketched
+        ))
+
+    def get_sketch(self, query):
+        """Merge the sketches of all cells matching a query.
+
+        Args:
+            query (Query): The query for which a sketch is requested. Must only
+                filter on dimensions given at construction.
+
+        Returns:
+            quantile_sketch.WageSketch: Newly merged sketch.
+        """
+        filters = list(filter(
+            lambda x: x[1] is not None,
+            map(
+                lambda x: (x[0], get_dimension_getter(x[1])(query)),
+                enumerate(self._dimensions)
+            )
+        ))
+
+        merged = quantile_sketch.WageSketch(self._relative_accuracy)
+        for key, sketch in self._sketch_by_cell.items():
+            if all(map(lambda x: key[x[0]] == x[1], filters)):
+                merged.merge(sketch)
+
+        return merged
+
+    def get_relative_accuracy(self):
+        """Get the error bound for the sketches.
+
+        Returns:
+            float: Maximum relative error of quantiles from get_sketch.
+        """
+        return self._relative_accuracy
+
+
+class PlanStep:
+    """Record describing one filter applied while finding a subpopulation."""
+
+    def __init__(self, dimension, value, index_size, result_size):
+        """Create a new step.
+
+        Args:
+            dimension (str): Name of the dimension filtered.
+            value: The value required for the dimension or list of values
+                allowed if the filter was a Predicate matching several.
+            index_size (int): Number of records in the dataset with the value
+                or values.
+            result_size (int): Number of records remaining after this and all
+                prior steps.
+        """
+        self._dimension = dimension
+        self._value = value
+        self._index_size = index_size
+        self._result_size = result_size
+
+    def get_dimension(self):
+        """Get the dimension filtered in this step.
+
+        Returns:
+            str: Name of the dimension which is one of DIMENSIONS.
+        """
+        return self._dimension
+
+    def get_value(self):
+        """Get the value required by this step.
+
+        Returns:
+            The value like it appears on InputRecord or list of values if
+                several are allowed.
+        """
+        return self._value
+
+    def get_index_size(self):
+        """Get the number of records matching this step's filter alone.
+
+        Returns:
+            int: Count of records with the value used to order steps.
+        """
+        return self._index_size
+
+    def get_result_size(self):
+        """Get the number of records matching this and all prior steps.
+
+        Returns:
+            int: Count of records remaining after intersection.
+        """
+        return self._result_size
+
+
+class EncodedDimension:
+    """Dictionary encoded values of one dimension built outside a Dataset.
+
+    Lets loaders which already grouped records by value, such as those
+    parsing chunks in parallel, hand their encoding to a Dataset instead of
+    having it encode every record again.
+    """
+
+    def __init__(self, catalog, codes, index):
+        """Create a new record of an encoded dimension.
+
+        Args:
+            catalog (list): Sorted distinct values where each value's position
+                is its code.
+            codes (array.array): Code of each record in input order using the
+                typecode from get_code_typecode.
+            index (list): Set of record IDs for each code which is owned by
+                the Dataset after it is given.
+        """
+        self._catalog = catalog
+        self._codes = codes
+        self._index = index
+
+    def get_catalog(self):
+        """Get the sorted distinct values of the dimension.
+
+        Returns:
+            list: Values where each value's position is its code.
+        """
+        return self._catalog
+
+    def get_codes(self):
+        """Get the code of each record.
+
+        Returns:
+            array.array: Codes in input order.
+        """
+        return self._codes
+
+    def get_index(self):
+        """Get the records holding each value.
+
+        Returns:
+            list: Set of record IDs for each code.
+        """
+        return self._index
+
+
+class BatchResult:
+    """Record describing the results of Dataset.evaluate_batch."""
+
+    def __init__(self, results, duration, intersections_computed,
+            intersections_reused):
+        """Create a new batch result.
+
+        Args:
+            results (list): Dictionary from metric name to value for each query
+                in the order given.
+            duration (float): Seconds taken to evaluate the batch.
+            intersections_computed (int): Number of index intersections
+                performed.
+            intersections_reused (int): Number of times a shared intersection
+                was used instead of being recomputed.
+        """
+        self._results = results
+        self._duration = duration
+        self._intersections_computed = intersections_computed
+        self._intersections_reused = intersections_reused
+
+    def get_results(self):
+        """Get the metrics calculated for each query.
+
+        Returns:
+            list: Dictionary from metric name to value for each query in the
+                order given.
+        """
+        return self._results
+
+    def get_duration(self):
+        """Get the time taken to evaluate the batch.
+
+        Returns:
+            float: Duration in seconds.
+        """
+        return self._duration
+
+    def get_intersections_computed(self):
+        """Get the number of index intersections performed.
+
+        Returns:
+            int: Count of intersections calculated for the batch.
+        """
+        return self._intersections_computed
+
+    def get_intersections_reused(self):
+        """Get the number of intersections shared between queries.
+
+        Returns:
+            int: Count of times an intersection was reused from another query.
+        """
+        return self._intersections_reused
+
+
+class Dataset:
+    """Class to query a dataset made up of InputRecords.
+
+    Queries may be made from multiple threads including while records are
+    changed through apply_changes in which case each query sees the dataset
+    either before or after the change.
+    """
+
+    def __init__(self, input_records_iter, cube_dimension_sets=None,
+            median_strategy='select', sketch_dimensions=None,
+            sketch_accuracy=quantile_sketch.DEFAULT_RELATIVE_ACCURACY,
+            cache_size=DEFAULT_CACHE_SIZE, encodings=None,
+            cluster_dimensions=None, prebuild_dimensions=None,
+            build_in_background=False):
+        """Create a new dataset.
+
+        Args:
+            iterable: Iterable over InputRecord to represent.
+            cube_dimension_sets (list): Optional list of lists of dimensions for
+                which an AggregateCube should be materialized at load time such
+                that get_size and get_unemp can be answered by lookup. Pass
+                [DIMENSIONS] to materialize all dimensions or smaller subsets
+                to cap memory. Defaults to None in which case no cube is built.
+            median_strategy (str): How get_wageotc should find medians. Use
+                select to run a weighted quickselect over the subpopulation's
+                wages or presorted to sort all wages once at load time and then
+                scan them with a mask of the subpopulation's records. Defaults
+                to select.
+            sketch_dimensions (list): Optional list of dimensions like
+                ['docc03', 'female', 'wbhaom'] for which a WageSketchCube should
+                be built at load time to support get_wageotc_approx. Defaults
+                to None in which case get_wageotc_approx is always exact.
+            sketch_accuracy (float): Relative error bound for the sketches.
+                Defaults to quantile_sketch.DEFAULT_RELATIVE_ACCURACY.
+            cache_size (int): Maximum number of results from get_size,
+                get_unemp, get_wageotc, and group_by to keep in a least
+                recently used cache or zero to disable caching. Defaults to
+                DEFAULT_CACHE_SIZE.
+            encodings (dict): Optional mapping from each dimension in
+                DIMENSIONS to an EncodedDimension for the records in input
+                order. Used as is when already built elsewhere such as when
+                merging chunks parsed in parallel. Defaults to None in which
+                case values are dictionary encoded into integer codes from the
+                records when the dimension's index is built.
+            cluster_dimensions (list): Optional list of dimensions like
+                ['docc03', 'female', 'wbhaom'] by which to sort record storage
+                such that queries filtering on a leading part of this key
+                find their records in a contiguous range. Defaults to None in
+                which case records are kept in input order.
+            prebuild_dimensions (list): Dimensions whose indexes should be
+                built at load time like ['docc03', 'female', 'wbhaom']. Others
+                are built on first use. Defaults to None in which case all
+                indexes are built at load time.
+            build_in_background (bool): Flag indicating if indexes not
+                prebuilt should be built in a background thread after load
+                instead of waiting for first use. Defaults to False.
+        """
+        if median_strategy not in MEDIAN_STRATEGIES:
+            message = 'Unknown median strategy: %s' % median_strategy
+            raise RuntimeError(message)
+
+        input_records = list(input_records_iter)
+
+        if cluster_dimensions is not None:
+            getters = list(map(get_dimension_getter, cluster_dimensions))
+            input_records.sort(
+                key=lambda x: tuple(map(lambda y: y(x), getters))
+            )
+
+        self._records = input_records
+        self._records_by_id = dict(map(
+            lambda x: (x.get_index(), x),
+            input_records
+        ))
+
+        self._position_by_id = dict(map(
+            lambda x: (x[1].get_index(), x[0]),
+            enumerate(input_records)
+        ))
+
+        self._supplied_encodings = encodings
+        self._configured_cluster_dimensions = cluster_dimensions
+        self._lock = threading.RLock()
+        self._catalogs = {}
+        self._code_by_value = {}
+        self._codes = {}
+
+        if prebuild_dimensions is None:
+            prebuild_dimensions = DIMENSIONS
+
+        self.build_indexes(prebuild_dimensions)
+
+        self._num_removed = 0
+
+        if cluster_dimensions is None:
+            self._cluster_dimensions = None
+        else:
+            self._build_cluster_offsets(cluster_dimensions, input_records)
+
+        if cube_dimension_sets is None:
+            self._cube = None
+        else:
+            self._cube = AggregateCube(input_records, cube_dimension_sets)
+
+        self._median_strategy = median_strategy
+        if median_strategy == 'presorted':
+            self._build_presorted_wages(input_records)
+
+        if cache_size > 0:
+            self._cache = ResultCache(cache_size)
+        else:
+            self._cache = None
+
+        if sketch_dimensions is None:
+            self._sketches = None
+        else:
+            self._sketches = WageSketchCube(
+                input_records,
+                sketch_dimensions,
+                sketch_accuracy
+            )
+
+        self._max_wage = None
+        self._max_unemployment = None
+
+        if build_in_background:
+            self._index_thread = threading.Thread(
+                target=self.build_indexes,
+                daemon=True
+            )
+            self._index_thread.start()
+        else:
+            self._index_thread = None
+
+    def get_wageotc(self, query):
+        """Get median wage for a group with overtime, tips, and comissions.
+
+        Args:
+            query (Query): A Query object describing the population for which
+                the median wage should be returned.
+
+        Returns:
+            float: The estimated median wage for the given population in USD.
+        """
+        return self._get_cached(
+            ('wageotc', query.freeze()),
+            lambda: self._calculate_wageotc(self._get_subpopulation(query))
+        )
+
+    def get_wageotc_approx(self, query, exact=False):
+        """Get approximate median wage from mergeable sketches.
+
+        Args:
+            query (Query): A Query object describing the population for which
+                the median wage should be returned.
+            exact (bool): Flag indicating if the exact get_wageotc should be
+                used instead of the sketches. Defaults to False.
+
+        Returns:
+            float: The estimated median wage for the given population in USD
+                within get_wageotc_error_bound of get_wageotc. Exact if no
+                sketches were built or the query filters on dimensions which
+                were not sketched.
+        """
+        if exact or self._sketches is None:
+            return self.get_wageotc(query)
+
+        if not self._sketches.can_answer(query):
+            return self.get_wageotc(query)
+
+        with self._lock:
+            self._resolve_query(query)
+            return self._sketches.get_sketch(query).get_quantile(0.5)
+
+    def get_wageotc_error_bound(self):
+        """Get the maximum relative error from get_wageotc_approx.
+
+        Returns:
+            float: Maximum relative difference between get_wageotc_approx and
+                get_wageotc like 0.01 for 1% or zero if no sketches were built.
+        """
+        if self._sketches is None:
+            return 0
+
+        return self._sketches.get_relative_accuracy()
+
+    def get_wage_quantiles(self, query, quantiles):
+        """Get multiple weighted wage quantiles from a single ordered pass.
+
+        Args:
+            query (Query): A Query object describing the population for which
+                the quantiles should be returned.
+            quantiles (list): The quantiles to find as numbers from 0 to 1 like
+                [0.1, 0.25, 0.5, 0.75, 0.9].
+
+        Returns:
+            list: Wage in USD (float) for each quantile in the order given
+                where 0.5 matches get_wageotc.
+        """
+        check_quantiles(quantiles)
+
+        with self._lock:
+            subpopulation = self._get_subpopulation(query)
+            return self._walk_sorted_wages(
+                subpopulation,
+                lambda x, y: find_weighted_quantiles(y, x, quantiles)
+            )
+
+    def get_wage_histogram(self, query, bins):
+        """Get the weighted distribution of wages for a group.
+
+        Args:
+            query (Query): A Query object describing the population for which
+                the histogram should be returned.
+            bins: Either the number of equally sized bins (int) spanning the
+                population's minimum to maximum wage or a list of ascending bin
+                edges in USD.
+
+        Returns:
+            list: HistogramBin for each bin in ascending order where each bin
+                includes its start and excludes its end except for the last bin
+                which includes both.
+        """
+        with self._lock:
+            subpopulation = self._get_subpopulation(query)
+            wages_nested = map(lambda x: x.get_wageotc(), subpopulation)
+            wages = list(itertools.chain(*wages_nested))
+
+        return make_histogram(wages, bins)
+
+    def get_unemp(self, query):
+        """Get the overall unemployment rate for a group.
+
+        Args:
+            query (Query): A Query object describing the population for which
+                the unemployemnt rate should be returned.
+
+        Returns:
+            float: The estimated unemployment rate for the specified group as
+                a percentage between 0 and 100.
+        """
+        return self._get_cached(
+            ('unemp', query.freeze()),
+            lambda: self._find_unemp(query)
+        )
+
+    def get_size(self, query):
+        """Get the size of a population as summed census weight.
+
+        Args:
+            query (Query): A Query object describing the population for which
+                the size should be returned.
+
+        Returns:
+            float: Estimated size of this population as a weight. This is
+                propotional to the size of the population represented. Note
+                that this uses the wage count though the wage and unemployemnt
+                count are often the same.
+        """
+        return self._get_cached(
+            ('size', query.freeze()),
+            lambda: self._find_size(query)
+        )
+
+    def get_records(self, query):
+        """Get the records of a population.
+
+        Args:
+            query (Query): A Query object describing the population for which
+                records should be returned.
+
+        Returns:
+            list: The InputRecords matching the query.
+        """
+        with self._lock:
+            return list(self._get_subpopulation(query))
+
+    def group_by(self, dimensions, metrics, base_query=None):
+        """Calculate metrics for every combination of values in dimensions.
+
+        Partitions the records matching base_query in a single pass such that,
+        for example, size and unemployment for every occupation and gender can
+        be found without issuing a separate query per cell.
+
+        Args:
+            dimensions (list): Names of the dimensions by which to group like
+                ['docc03', 'female'].
+            metrics (list): Names of the metrics to calculate per group where
+                each is one of METRICS (size, unemp, or wageotc) matching the
+                get_size, get_unemp, and get_wageotc methods.
+            base_query (Query): Optional query describing the population to
+                group. Defaults to None in which case all records are grouped.
+
+        Returns:
+            dict: Mapping from tuple of dimension values (in the order given by
+                dimensions) to a dict from metric name to its value. Only
+                combinations with at least one record are included. This is a
+                copy such that modifying it does not affect the cache.
+        """
+        if base_query is None:
+            base_query = Query()
+
+        key = (
+            'group_by',
+            tuple(dimensions),
+            tuple(metrics),
+            base_query.freeze()
+        )
+        groups = self._get_cached(
+            key,
+            lambda: self._find_groups(dimensions, metrics, base_query)
+        )
+        return dict(map(lambda x: (x[0], dict(x[1])), groups.items()))
+
+    def get_sums(self, dimensions, base_query=None):
+        """Get mergeable sums for every combination of values in dimensions.
+
+        Unlike the metrics of group_by, these sums may be added across
+        datasets holding different records like shards of a larger dataset.
+
+        Args:
+            dimensions (list): Names of the dimensions by which to group like
+                ['docc03', 'female'].
+            base_query (Query): Optional query describing the population to
+                group. Defaults to None in which case all records are grouped.
+
+        Returns:
+            dict: Mapping from tuple of dimension values to tuple of summed
+                wage count, summed unemployment count, unemployment count
+                weighted sum of unemployment, and number of records. Only
+                combinations with at least one record are included.
+        """
+        if base_query is None:
+            base_query = Query()
+
+        key = ('sums', tuple(dimensions), base_query.freeze())
+        return dict(self._get_cached(
+            key,
+            lambda: self._find_sums(dimensions, base_query)
+        ))
+
+    def get_wages_by_group(self, dimensions, base_query=None):
+        """Get the wages of every combination of values in dimensions.
+
+        Args:
+            dimensions (list): Names of the dimensions by which to group like
+                ['docc03', 'female'].
+            base_query (Query): Optional query describing the population to
+                group. Defaults to None in which case all records are grouped.
+
+        Returns:
+            dict: Mapping from tuple of dimension values to list of wage and
+                weight tuples sorted by wage. Only combinations with at least
+                one record are included.
+        """
+        if base_query is None:
+            base_query = Query()
+
+        def get_wages(positions):
+            records = self._get_records_at(positions)
+            return self._walk_sorted_wages(records, lambda x, y: list(y))
+
+        with self._lock:
+            groups = self._group_positions(dimensions, base_query)
+            if self._median_strategy == 'presorted':
+                return self._route_presorted_wages(groups)
+
+            return dict(map(
+                lambda x: (x[0], get_wages(x[1])),
+                groups.items()
+            ))
+
+    def evaluate_batch(self, queries, metrics):
+        """Calculate metrics for many queries, sharing work between them.
+
+        Each query's filters are ordered with those most common across the
+        batch first such that queries differing in a single dimension share
+        the intersection of their other filters. Each distinct prefix of
+        filters is intersected once. Results go through the result cache like
+        get_size, get_unemp, and get_wageotc.
+
+        Args:
+            queries (list): The Query objects to evaluate.
+            metrics (list): Names of the metrics to calculate for each query
+                where each is one of METRICS.
+
+        Returns:
+            BatchResult: Metrics for each query with timing information.
+        """
+        start_time = time.perf_counter()
+
+        calculators = list(map(
+            lambda x: (x, self._get_calculator(x)),
+            metrics
+        ))
+
+        def get_filter_key(resolved_filter):
+            return (resolved_filter[0], tuple(resolved_filter[1]))
+
+        with self._lock:
+            resolved_keys = list(map(
+                lambda x: list(map(get_filter_key, self._resolve_query(x))),
+                queries
+            ))
+            filter_counts = collections.Counter(itertools.chain(*resolved_keys))
+
+            allowed_by_key = {}
+
+            def get_allowed(key):
+                if key not in allowed_by_key:
+                    allowed_by_key[key] = self._get_allowed_ids(key[0], key[1])
+                return allowed_by_key[key]
+
+            def get_order(key):
+                return (-filter_counts[key], len(get_allowed(key)), key)
+
+            ids_by_prefix = {(): self._records_by_id.keys()}
+            intersections_computed = 0
+            intersections_reused = 0
+
+            results = []
+            for query, keys in zip(queries, resolved_keys):
+                prefix = ()
+                ids = ids_by_prefix[prefix]
+
+                for key in sorted(keys, key=get_order):
+                    prefix = prefix + (key,)
+
+                    if prefix in ids_by_prefix:
+                        ids = ids_by_prefix[prefix]
+                        intersections_reused += 1
+                    else:
+                        allowed = get_allowed(key)
+                        if len(prefix) == 1:
+                            ids = allowed
+                        else:
+                            ids = allowed.intersection(ids)
+
+                        ids_by_prefix[prefix] = ids
+                        intersections_computed += 1
+
+                records = list(map(self._records_by_id.__getitem__, ids))
+                frozen = query.freeze()
+                results.append(dict(map(
+                    lambda x: (
+                        x[0],
+                        self._get_cached((x[0], frozen), lambda: x[1](records))
+                    ),
+                    calculators
+                )))
+
+        return BatchResult(
+            results,
+            time.perf_counter() - start_time,
+            intersections_computed,
+            intersections_reused
+        )
+
+    def explain(self, query):
+        """Describe how the records for a query are found through the indexes.
+
+        Filters are applied from the most selective (fewest matching records)
+        to the least, stopping once no records remain. Note that clustered
+        datasets scan a contiguous range instead when the query filters on the
+        leading clustering dimension.
+
+        Args:
+            query (Query): The query to describe.
+
+        Returns:
+            list: PlanStep for each filter applied in the order applied. Empty
+                if the query does not filter on any dimension.
+        """
+        steps = []
+
+        with self._lock:
+            self._get_subpopulation_ids(self._resolve_query(query), steps)
+
+        return steps
+
+    def build_indexes(self, dimensions=None):
+        """Build the indexes for dimensions which have not yet been built.
+
+        Args:
+            dimensions (list): Names of the dimensions to index. Defaults to
+                None in which case all of DIMENSIONS are built.
+        """
+        if dimensions is None:
+            dimensions = DIMENSIONS
+
+        for dimension in dimensions:
+            self._require_dimension(dimension)
+
+    def add_records(self, records):
+        """Add records to this dataset, updating indexes and aggregates.
+
+        Takes time proportional to the number of records added rather than the
+        size of the dataset. Clears the result cache and disables clustering
+        as new records are stored after existing ones until the next
+        compaction.
+
+        Args:
+            records (iterable): The InputRecords to add whose indices must not
+                already be in the dataset.
+        """
+        self.apply_changes([], records)
+
+    def remove_records(self, indices):
+        """Remove records from this dataset, updating indexes and aggregates.
+
+        Takes amortized time proportional to the number of records removed
+        rather than the size of the dataset. Clears the result cache and
+        disables clustering. Storage of removed records is reclaimed once they
+        exceed COMPACT_FRACTION of the remaining records.
+
+        Args:
+            indices (iterable): The unique integer IDs (InputRecord.get_index)
+                of the records to remove.
+        """
+        self.apply_changes(indices, [])
+
+    def apply_changes(self, removed_indices, added_records):
+        """Remove and then add records as a single atomic change.
+
+        Queries made from other threads see the dataset either before or after
+        the whole change. A record can be replaced by including its index in
+        removed_indices and its new version in added_records.
+
+        Args:
+            removed_indices (iterable): The unique integer IDs of the records
+                to remove.
+            added_records (iterable): The InputRecords to add whose indices
+                must not remain in the dataset after removal.
+        """
+        removed_indices = set(removed_indices)
+        added_records = list(added_records)
+
+        with self._lock:
+            self._check_changes(removed_indices, added_records)
+            self._prepare_for_change()
+
+            for index in removed_indices:
+                self._remove_record(index)
+
+            for record in added_records:
+                self._add_record(record)
+
+            if self._median_strategy == 'presorted':
+                self._add_presorted_wages(added_records)
+
+            num_remaining = len(self._records_by_id)
+            if self._num_removed > num_remaining * COMPACT_FRACTION:
+                self._compact()
+
+    def get_indexed_dimensions(self):
+        """Get the dimensions whose indexes have been built.
+
+        Returns:
+            list: Names of the built dimensions in the order of DIMENSIONS.
+        """
+        return list(filter(lambda x: x in self._catalogs, DIMENSIONS))
+
+    def get_cache_hits(self):
+        """Get the number of results answered from the result cache.
+
+        Returns:
+            int: Count of cache hits or zero if caching is disabled.
+        """
+        return 0 if self._cache is None else self._cache.get_hits()
+
+    def get_cache_misses(self):
+        """Get the number of results which were not found in the cache.
+
+        Returns:
+            int: Count of cache misses or zero if caching is disabled.
+        """
+        return 0 if self._cache is None else self._cache.get_misses()
+
+    def invalidate_cache(self):
+        """Remove all results from the result cache."""
+        if self._cache is not None:
+            self._cache.clear()
+
+    def _check_changes(self, removed_indices, added_records):
+        """Ensure a change can be applied before modifying anything.
+
+        Must be called while holding the lock which is held until the change
+        is applied.
+
+        Args:
+            removed_indices (set): The unique integer IDs of the records to
+                remove.
+            added_records (list): The InputRecords to add.
+        """
+        for index in removed_indices:
+            if index not in self._records_by_id:
+                message = 'Cannot find the provided record: %s' % str(index)
+                raise RuntimeError(message)
+
+        seen_ids = set()
+        for record in added_records:
+            index = record.get_index()
+            is_present = index in self._records_by_id
+            remaining = is_present and index not in removed_indices
+            if remaining or index in seen_ids:
+                message = 'Record index already present: %s' % str(index)
+                raise RuntimeError(message)
+            seen_ids.add(index)
+
+    def _add_record(self, record):
+        """Store a record and add it to indexes and aggregates.
+
+        Args:
+            record (InputRecord): The record to add.
+        """
+        position = len(self._records)
+        self._records.append(record)
+        self._records_by_id[record.get_index()] = record
+        self._position_by_id[record.get_index()] = position
+
+        for dimension in list(self._catalogs.keys()):
+            self._add_to_dimension(dimension, record)
+
+        if self._cube is not None:
+            self._cube.add_record(record)
+
+        if self._sketches is not None:
+            self._sketches.add_record(record)
+
+        self._update_maxima(record)
+
+    def _remove_record(self, index):
+        """Remove a record from storage, indexes, and aggregates.
+
+        Args:
+            index (int): The unique integer ID of the record to remove.
+        """
+        record = self._records_by_id.pop(index)
+        position = self._position_by_id.pop(index)
+        self._records[position] = None
+        self._num_removed += 1
+
+        for dimension in list(self._catalogs.keys()):
+            code = self._codes[dimension][position]
+            self._get_index(dimension)[code].discard(index)
+
+        if self._cube is not None:
+            self._cube.remove_record(record)
+
+        if self._sketches is not None:
+            self._sketches.remove_record(record)
+
+        wages = map(lambda x: x.get_wage(), record.get_wageotc())
+        if self._max_wage is not None:
+            if max(wages, default=0) >= self._max_wage:
+                self._max_wage = None
+
+        if self._max_unemployment is not None:
+            if record.get_unemp() >= self._max_unemployment:
+                self._max_unemployment = None
+
+    def _compact(self):
+        """Reclaim the storage positions left by removed records.
+
+        Rebuilds storage positions, encoded dimensions, presorted wages, and
+        clustering over the remaining records.
+        """
+        records = list(filter(lambda x: x is not None, self._records))
+
+        cluster_dimensions = self._configured_cluster_dimensions
+        if cluster_dimensions is not None:
+            getters = list(map(get_dimension_getter, cluster_dimensions))
+            records.sort(key=lambda x: tuple(map(lambda y: y(x), getters)))
+
+        self._records = records
+        self._position_by_id = dict(map(
+            lambda x: (x[1].get_index(), x[0]),
+            enumerate(records)
+        ))
+        self._num_removed = 0
+
+        for dimension in list(self._catalogs.keys()):
+            index = self._make_index(get_dimension_getter(dimension), records)
+            self._encode_dimension(dimension, index, len(records))
+
+        if self._median_strategy == 'presorted':
+            self._build_presorted_wages(records)
+
+        if cluster_dimensions is not None:
+            self._build_cluster_offsets(cluster_dimensions, records)
+
+    def _prepare_for_change(self):
+        """Drop state which cannot be maintained as records change."""
+        self.invalidate_cache()
+
+        if self._cluster_dimensions is not None:
+            self._cluster_dimensions = None
+            self._cluster_offsets = None
+            self._wage_counts = None
+            self._unemp_counts = None
+            self._unemps = None
+
+        if self._supplied_encodings is not None:
+            self.build_indexes()
+            self._supplied_encodings = None
+
+    def _add_to_dimension(self, dimension, record):
+        """Add a record which was just appended to a built dimension.
+
+        Args:
+            dimension (str): Name of the dimension which is one of DIMENSIONS.
+            record (InputRecord): The record stored at the last position.
+        """
+        value = get_dimension_getter(dimension)(record)
+        code_by_value = self._code_by_value[dimension]
+        index = self._get_index(dimension)
+
+        if value not in code_by_value:
+            code_by_value[value] = len(self._catalogs[dimension])
+            self._catalogs[dimension].append(value)
+            index.append(set())
+
+        code = code_by_value[value]
+        codes = self._codes[dimension]
+        if code >= 2 ** (8 * codes.itemsize):
+            typecode = get_code_typecode(code + 1)
+            codes = array.array(typecode, codes)
+            self._codes[dimension] = codes
+
+        codes.append(code)
+        index[code].add(record.get_index())
+
+    def _update_maxima(self, record):
+        """Update the cached maximum wage and unemployment for a new record.
+
+        Args:
+            record (InputRecord): The record added.
+        """
+        if self._max_wage is not None:
+            wages = map(lambda x: x.get_wage(), record.get_wageotc())
+            self._max_wage = max(self._max_wage, max(wages, default=0))
+
+        if self._max_unemployment is not None:
+            self._max_unemployment = max(
+                self._max_unemployment,
+                record.get_unemp()
+            )
+
+    def _get_cached(self, key, calculate):
+        """Get a result from the cache if enabled, calculating if needed.
+
+        Args:
+            key (tuple): Hashable key describing the request including a
+                FrozenQuery.
+            calculate (callable): Function taking no arguments which finds the
+                result.
+
+        Returns:
+            The result of calculate which may come from the cache.
+        """
+        with self._lock:
+            if self._cache is None:
+                return calculate()
+
+            return self._cache.get_or_calculate(key, calculate)
+
+    def _find_unemp(self, query):
+        """Find the unemployment rate for a group without the result cache.
+
+        Args:
+            query (Query): The population for which the unemployment rate
+                should be returned.
+
+        Returns:
+            float: Unemployment rate as a percentage between 0 and 100.
+        """
+        cell = self._get_cube_cell(query)
+        if cell is not None:
+            return cell[2] / cell[1]
+
+        cluster_range = self._get_cluster_range(self._resolve_query(query))
+        if cluster_range is not None and not cluster_range[2]:
+            start, end, remaining = cluster_range
+            if start < end:
+                unemp_counts = memoryview(self._unemp_counts)[start:end]
+                unemps = memoryview(self._unemps)[start:end]
+                weighted = sum(map(operator.mul, unemp_counts, unemps))
+                return weighted / sum(unemp_counts)
+
+        subpopulation = self._get_subpopulation(query)
+        return self._calculate_unemp(subpopulation)
+
+    def _find_size(self, query):
+        """Find the size of a population without the result cache.
+
+        Args:
+            query (Query): The population for which the size should be
+                returned.
+
+        Returns:
+            float: Estimated size of this population as a weight.
+        """
+        cell = self._get_cube_cell(query)
+        if cell is not None:
+            return cell[0]
+
+        cluster_range = self._get_cluster_range(self._resolve_query(query))
+        if cluster_range is not None and not cluster_range[2]:
+            start, end, remaining = cluster_range
+            return sum(memoryview(self._wage_counts)[start:end])
+
+        subpopulation = self._get_subpopulation(query)
+        return self._calculate_size(subpopulation)
+
+    def _find_groups(self, dimensions, metrics, base_query):
+        """Calculate metrics per group without the result cache.
+
+        Args:
+            dimensions (list): Names of the dimensions by which to group.
+            metrics (list): Names of the metrics to calculate per group.
+            base_query (Query): Query describing the population to group.
+
+        Returns:
+            dict: Mapping from tuple of dimension values to a dict from metric
+                name to its value as described in group_by.
+        """
+        calculators = list(map(
+            lambda x: (x, self._get_calculator(x)),
+            metrics
+        ))
+
+        groups = self._group_positions(dimensions, base_query)
+
+        if self._median_strategy == 'presorted' and 'wageotc' in metrics:
+            medians = self._find_presorted_medians(groups)
+        else:
+            medians = None
+
+        def calculate(key, positions, metric, calculator):
+            if metric == 'wageotc' and medians is not None:
+                return medians[key]
+
+            return calculator(self._get_records_at(positions))
+
+        return dict(map(
+            lambda x: (
+                x[0],
+                dict(map(
+                    lambda y: (y[0], calculate(x[0], x[1], y[0], y[1])),
+                    calculators
+                ))
+            ),
+            groups.items()
+        ))
+
+    def _find_sums(self, dimensions, base_query):
+        """Calculate mergeable sums per group without the result cache.
+
+        Args:
+            dimensions (list): Names of the dimensions by which to group.
+            base_query (Query): Query describing the population to group.
+
+        Returns:
+            dict: Mapping from tuple of dimension values to sums as described
+                in get_sums.
+        """
+        if not dimensions:
+            cell = self._get_cube_cell(base_query)
+            if cell is not None:
+                return {(): tuple(cell)}
+
+            resolved = self._resolve_query(base_query)
+            cluster_range = self._get_cluster_range(resolved)
+            if cluster_range is not None and not cluster_range[2]:
+                start, end, remaining = cluster_range
+                if start >= end:
+                    return {}
+
+                unemp_counts = memoryview(self._unemp_counts)[start:end]
+                unemps = memoryview(self._unemps)[start:end]
+                return {(): (
+                    sum(memoryview(self._wage_counts)[start:end]),
+                    sum(unemp_counts),
+                    sum(map(operator.mul, unemp_counts, unemps)),
+                    end - start
+                )}
+
+        def sum_group(positions):
+            records = self._get_records_at(positions)
+            unemp_counts = list(map(lambda x: x.get_unemp_count(), records))
+            unemps = map(lambda x: x.get_unemp(), records)
+            return (
+                sum(map(lambda x: x.get_wage_count(), records)),
+                sum(unemp_counts),
+                sum(map(operator.mul, unemp_counts, unemps)),
+                len(records)
+            )
+
+        groups = self._group_positions(dimensions, base_query)
+        return dict(map(
+            lambda x: (x[0], sum_group(x[1])),
+            groups.items()
+        ))
+
+    def _group_positions(self, dimensions, base_query):
+        """Partition the positions of records matching a query by group.
+
+        Args:
+            dimensions (list): Names of the dimensions by which to group.
+            base_query (Query): Query describing the population to group.
+
+        Returns:
+            dict: Mapping from tuple of dimension values to list of positions
+                within _records.
+        """
+        for dimension in dimensions:
+            if dimension not in DIMENSIONS:
+                raise RuntimeError('Unknown dimension: %s' % dimension)
+
+        codes = list(map(self._get_codes, dimensions))
+        catalogs = list(map(self._get_catalog, dimensions))
+
+        groups = {}
+        for position in self._get_subpopulation_positions(base_query):
+            key = tuple(map(lambda x: x[position], codes))
+            groups.setdefault(key, []).append(position)
+
+        def decode(key):
+            return tuple(map(lambda x: x[0][x[1]], zip(catalogs, key)))
+
+        return dict(map(lambda x: (decode(x[0]), x[1]), groups.items()))
+
+    def _get_records_at(self, positions):
+        """Get the records at positions within _records.
+
+        Args:
+            positions (list): Positions of live records.
+
+        Returns:
+            list: The InputRecords in the order of positions.
+        """
+        return list(map(self._records.__getitem__, positions))
+
+    def get_max_wage(self):
+        """Get the maximum wage value across all records in the dataset.
+
+        Returns:
+            float: The maximum hourly wage value in USD found in the dataset.
+        """
+        with self._lock:
+            if self._max_wage is None:
+                records = self._records_by_id.values()
+                wages_nest = map(lambda x: x.get_wageotc(), records)
+                wages = itertools.chain(*wages_nest)
+                wages_raw = map(lambda x: x.get_wage(), wages)
+                self._max_wage = max(wages_raw)
+
+            return self._max_wage
+
+    def get_max_unemployment(self):
+        """Get the maximum unemployment rate across all records in the dataset.
+
+        Returns:
+            float: The maximum unemployment rate as a percentage (0-100)
+                found in the dataset.
+        """
+        with self._lock:
+            if self._max_unemployment is None:
+                records = self._records_by_id.values()
+                unemployments = map(lambda x: x.get_unemp(), records)
+                self._max_unemployment = max(unemployments)
+
+            return self._max_unemployment
+
+    def get_educ_vals(self):
+        """Get all unique education level values in the dataset.
+
+        Returns:
+            list: Sorted list of education level labels.
+        """
+        return self._get_values('educ')
+
+    def get_docc03_vals(self):
+        """Get all unique occupation classification values in the dataset.
+
+        Returns:
+            list: Sorted list of occupation classification labels.
+        """
+        return self._get_values('docc03')
+
+    def get_wbhaom_vals(self):
+        """Get all unique race and ethnicity values in the dataset.
+
+        Returns:
+            list: Sorted list of race and ethnicity labels.
+        """
+        return self._get_values('wbhaom')
+
+    def get_female_vals(self):
+        """Get all unique gender values in the dataset.
+
+        Returns:
+            list: Sorted list of gender values (typically [False, True]).
+        """
+        return self._get_values('female')
+
+    def get_region_vals(self):
+        """Get all unique geographic region values in the dataset.
+
+        Returns:
+            list: Sorted list of region labels.
+        """
+        return self._get_values('region')
+
+    def get_age_vals(self):
+        """Get all unique age group values in the dataset.
+
+        Returns:
+            list: Sorted list of age group labels.
+        """
+        return self._get_values('age')
+
+    def get_hoursuint_vals(self):
+        """Get all unique hours worked category values in the dataset.
+
+        Returns:
+            list: Sorted list of hours worked category labels.
+        """
+        return self._get_values('hoursuint')
+
+    def get_citistat_vals(self):
+        """Get all unique citizenship status values in the dataset.
+
+        Returns:
+            list: Sorted list of citizenship status labels.
+        """
+        return self._get_values('citistat')
+
+    def _get_cube_cell(self, query):
+        """Look up the precomputed sums for a query if available.
+
+        Args:
+            query (Query): The query for which sums are requested.
+
+        Returns:
+            list: Sums from AggregateCube.get_cell or None if there is no cube,
+                the query's dimensions were not materialized, or no records
+                match in which case the query should be answered by scan.
+        """
+        if self._cube is None:
+            return None
+
+        self._resolve_query(query)
+
+        if has_predicates(query):
+            return None
+
+        return self._cube.get_cell(query)
+
+    def _resolve_query(self, query):
+        """Translate the values filtered by a query to integer codes.
+
+        Args:
+            query (Query): The query to resolve, raising a RuntimeError if it
+                contains a value not found in the dataset.
+
+        Returns:
+            list: Tuples of dimension name and list of allowed codes for each
+                dimension on which the query filters in the order of
+                DIMENSIONS. There is a single code unless the filter is a
+                Predicate.
+        """
+        resolved = []
+
+        for dimension in DIMENSIONS:
+            value = get_dimension_getter(dimension)(query)
+            if value is None:
+                continue
+
+            codes = resolve_filter(
+                dimension,
+                value,
+                self._get_catalog(dimension),
+                self._get_code_by_value(dimension)
+            )
+            resolved.append((dimension, codes))
+
+        return resolved
+
+    def _get_index(self, dimension):
+        """Get the index mapping codes of a dimension to record IDs.
+
+        Args:
+            dimension (str): Name of the dimension which is one of DIMENSIONS.
+
+        Returns:
+            list: Set of record IDs for each code in the dimension's catalog.
+        """
+        self._require_dimension(dimension)
+        return getattr(self, '_id_by_' + dimension)
+
+    def _get_values(self, dimension):
+        """Get the distinct values of a dimension held by at least one record.
+
+        Args:
+            dimension (str): Name of the dimension which is one of DIMENSIONS.
+
+        Returns:
+            list: Sorted values.
+        """
+        with self._lock:
+            catalog = self._get_catalog(dimension)
+            index = self._get_index(dimension)
+            present = filter(lambda x: len(index[x]) > 0, range(len(catalog)))
+            return sorted(map(catalog.__getitem__, present))
+
+    def _get_catalog(self, dimension):
+        """Get the sorted distinct values of a dimension.
+
+        Args:
+            dimension (str): Name of the dimension which is one of DIMENSIONS.
+
+        Returns:
+            list: Values where each value's position is its code.
+        """
+        self._require_dimension(dimension)
+        return self._catalogs[dimension]
+
+    def _get_code_by_value(self, dimension):
+        """Get the mapping from value to code for a dimension.
+
+        Args:
+            dimension (str): Name of the dimension which is one of DIMENSIONS.
+
+        Returns:
+            dict: Code for each distinct value.
+        """
+        self._require_dimension(dimension)
+        return self._code_by_value[dimension]
+
+    def _get_codes(self, dimension):
+        """Get the code of each record for a dimension.
+
+        Args:
+            dimension (str): Name of the dimension which is one of DIMENSIONS.
+
+        Returns:
+            array.array: Code for the record at each storage position.
+        """
+        self._require_dimension(dimension)
+        return self._codes[dimension]
+
+    def _require_dimension(self, dimension):
+        """Ensure the index and encoding for a dimension have been built.
+
+        Safe to call from multiple threads where only one builds a given
+        dimension.
+
+        Args:
+            dimension (str): Name of the dimension which is one of DIMENSIONS.
+        """
+        if dimension in self._catalogs:
+            return
+
+        getter = get_dimension_getter(dimension)
+
+        with self._lock:
+            if dimension in self._catalogs:
+                return
+
+            if self._supplied_encodings is None:
+                records = filter(lambda x: x is not None, self._records)
+                index = self._make_index(getter, records)
+            else:
+                encoding = self._supplied_encodings[dimension]
+                catalog = encoding.get_catalog()
+
+                if self._configured_cluster_dimensions is None:
+                    self._store_encoding(
+                        dimension,
+                        catalog,
+                        encoding.get_codes(),
+                        encoding.get_index()
+                    )
+                    return
+
+                index = dict(zip(catalog, encoding.get_index()))
+
+            self._encode_dimension(dimension, index, len(self._records))
+
+    def _encode_dimension(self, dimension, index, num_records):
+        """Dictionary encode a dimension into integer codes.
+
+        Codes are positions in the sorted list of the dimension's distinct
+        values such that they order like the values themselves. Values first
+        seen in add_records are appended to the end.
+
+        Args:
+            dimension (str): Name of the dimension which is one of DIMENSIONS.
+            index (dict): Mapping from value to set of record IDs like built by
+                _make_index.
+            num_records (int): The number of records in this dataset.
+        """
+        catalog = sorted(index.keys())
+        typecode = get_code_typecode(len(catalog))
+        codes = array.array(typecode, [0]) * num_records
+
+        for code, value in enumerate(catalog):
+            for record_id in index[value]:
+                codes[self._position_by_id[record_id]] = code
+
+        self._store_encoding(
+            dimension,
+            catalog,
+            codes,
+            list(map(index.get, catalog))
+        )
+
+    def _store_encoding(self, dimension, catalog, codes, index):
+        """Record the encoding of a dimension, marking it as built.
+
+        Args:
+            dimension (str): Name of the dimension which is one of DIMENSIONS.
+            catalog (list): Sorted distinct values of the dimension.
+            codes (array.array): Code for the record at each storage position.
+            index (list): Set of record IDs for each code.
+        """
+        self._code_by_value[dimension] = dict(map(
+            lambda x: (x[1], x[0]),
+            enumerate(catalog)
+        ))
+        self._codes[dimension] = codes
+        setattr(self, '_id_by_' + dimension, index)
+        self._catalogs[dimension] = catalog
+
+    def _get_calculator(self, metric):
+        """Get the function which calculates a metric over a set of records.
+
+        Args:
+            metric (str): Name of the metric which is one of METRICS.
+
+        Returns:
+            callable: Function taking an iterable over InputRecord and
+                returning the metric's value.
+        """
+        calculators = {
+            'size': self._calculate_size,
+            'unemp': self._calculate_unemp,
+            'wageotc': self._calculate_wageotc
+        }
+
+        if metric not in calculators:
+            raise RuntimeError('Unknown metric: %s' % metric)
+
+        return calculators[metric]
+
+    def _calculate_wageotc(self, records):
+        """Calculate median wage with overtime, tips, and comissions.
+
+        Args:
+            records (iterable): The InputRecords describing the population for
+                which the median wage should be returned.
+
+        Returns:
+            float: The estimated median wage for the population in USD.
+        """
+        if self._median_strategy == 'presorted':
+            return self._calculate_wageotc_presorted(records)
+
+        wages_nested = map(lambda x: x.get_wageotc(), records)
+        wages_iter = itertools.chain(*wages_nested)
+        return select_weighted_median(wages_iter)
+
+    def _calculate_wageotc_presorted(self, records):
+        """Calculate median wage by scanning the presorted wages.
+
+        Rather than collecting and ordering the subpopulation's wages, this
+        marks the subpopulation's records in a mask and walks the wages which
+        were sorted at load time, accumulating only those belonging to a marked
+        record until reaching half of the subpopulation's weight.
+
+        Args:
+            records (iterable): The InputRecords describing the population for
+                which the median wage should be returned.
+
+        Returns:
+            float: The estimated median wage for the population in USD.
+        """
+        def select(total_count, wages):
+            mid_count = total_count / 2
+
+            weight_acc = 0
+            for wage, weight in wages:
+                if weight_acc + weight >= mid_count:
+                    return wage
+
+                weight_acc += weight
+
+            raise RuntimeError('Unable to get median wage.')
+
+        return self._walk_sorted_wages(records, select)
+
+    def _walk_sorted_wages(self, records, consume):
+        """Give the wages of a population in ascending order to a function.
+
+        Uses the wages sorted at load time with the population's records
+        marked in a mask allocated once if using the presorted median strategy
+        or sorts the population's wages otherwise. The walk over presorted
+        wages is lazy so stops wherever consume stops reading.
+
+        Args:
+            records (iterable): The InputRecords describing the population.
+            consume (callable): Function taking the total weight of the
+                population's wages and an iterable over (wage, weight) tuples
+                in ascending order by wage.
+
+        Returns:
+            The result of consume.
+        """
+        if self._median_strategy != 'presorted':
+            wages_nested = map(lambda x: x.get_wageotc(), records)
+            wages = list(map(
+                lambda x: (x.get_wage(), x.get_weight()),
+                itertools.chain(*wages_nested)
+            ))
+            total_count = sum(map(lambda x: x[1], wages))
+            wages.sort(key=lambda x: x[0])
+            return consume(total_count, wages)
+
+        positions = list(map(
+            lambda x: self._position_by_id[x.get_index()],
+            records
+        ))
+
+        with self._lock:
+            total_counts = self._mark_presorted([positions])
+            try:
+                marks = self._presorted_marks
+                selected = map(marks.__getitem__, self._sorted_positions)
+                wages = itertools.compress(
+                    zip(self._sorted_wages, self._sorted_weights),
+                    selected
+                )
+
+                if self._added_sorted_wages:
+                    added_selected = filter(
+                        lambda x: marks[x[2]],
+                        self._added_sorted_wages
+                    )
+                    added_wages = map(lambda x: (x[0], x[1]), added_selected)
+                    wages = heapq.merge(wages, added_wages, key=lambda x: x[0])
+
+                return consume(total_counts[0], wages)
+            finally:
+                self._clear_presorted([positions])
+
+    def _find_presorted_medians(self, positions_by_key):
+        """Find the median wage of many groups in one walk over sorted wages.
+
+        Each wage sorted at load time is routed to the group of its record
+        such that the walk stops once every group reaches half of its weight
+        instead of walking once per group.
+
+        Args:
+            positions_by_key (dict): Mapping from group key to the positions of
+                the group's records which must not overlap between groups.
+
+        Returns:
+            dict: Mapping from group key to median wage matching
+                _calculate_wageotc_presorted for the group alone.
+        """
+        keys = list(positions_by_key.keys())
+        position_groups = list(map(positions_by_key.get, keys))
+        if not keys:
+            return {}
+
+        with self._lock:
+            mid_counts = list(map(
+                lambda x: x / 2,
+                self._mark_presorted(position_groups)
+            ))
+            try:
+                marks = self._presorted_marks
+                weight_accs = [0] * len(keys)
+                medians = [None] * len(keys)
+                remaining = len(keys)
+
+                for wage, weight, position in self._iterate_presorted():
+                    group = marks[position] - 1
+                    if group < 0 or medians[group] is not None:
+                        continue
+
+                    if weight_accs[group] + weight >= mid_counts[group]:
+                        medians[group] = wage
+                        remaining -= 1
+                        if remaining == 0:
+                            break
+                    else:
+                        weight_accs[group] += weight
+            finally:
+                self._clear_presorted(position_groups)
+
+        if remaining > 0:
+            raise RuntimeError('Unable to get median wage.')
+
+        return dict(zip(keys, medians))
+
+    def _route_presorted_wages(self, positions_by_key):
+        """Collect the sorted wages of many groups in one walk.
+
+        Args:
+            positions_by_key (dict): Mapping from group key to the positions of
+                the group's records which must not overlap between groups.
+
+        Returns:
+            dict: Mapping from group key to list of (wage, weight) tuples in
+                ascending order by wage.
+        """
+        keys = list(positions_by_key.keys())
+        position_groups = list(map(positions_by_key.get, keys))
+        wages_by_group = list(map(lambda x: [], keys))
+
+        with self._lock:
+            self._mark_presorted(position_groups)
+            try:
+                marks = self._presorted_marks
+                for wage, weight, position in self._iterate_presorted():
+                    group = marks[position] - 1
+                    if group >= 0:
+                        wages_by_group[group].append((wage, weight))
+            finally:
+                self._clear_presorted(position_groups)
+
+        return dict(zip(keys, wages_by_group))
+
+    def _mark_presorted(self, position_groups):
+        """Mark the records of groups in the preallocated presorted mask.
+
+        Must be followed by _clear_presorted with the same groups while
+        holding the lock.
+
+        Args:
+            position_groups (list): List of positions for each group.
+
+        Returns:
+            list: Total weight of the wages of each group.
+        """
+        total_counts = []
+        for group, positions in enumerate(position_groups):
+            total_count = 0
+            for position in positions:
+                self._presorted_marks[position] = group + 1
+                total_count += self._total_weight_by_position[position]
+            total_counts.append(total_count)
+
+        return total_counts
+
+    def _clear_presorted(self, position_groups):
+        """Unmark records marked by _mark_presorted.
+
+        Args:
+            position_groups (list): List of positions for each group.
+        """
+        for positions in position_groups:
+            for position in positions:
+                self._presorted_marks[position] = 0
+
+    def _iterate_presorted(self):
+        """Iterate over all wages sorted for the presorted strategy.
+
+        Returns:
+            iterable: Tuples of wage, weight, and record position in ascending
+                order by wage including those of added records.
+        """
+        triples = zip(
+            self._sorted_wages,
+            self._sorted_weights,
+            self._sorted_positions
+        )
+
+        if self._added_sorted_wages:
+            triples = heapq.merge(
+                triples,
+                self._added_sorted_wages,
+                key=lambda x: x[0]
+            )
+
+        return triples
+
+    def _build_presorted_wages(self, records):
+        """Sort all wages across all records for the presorted strategy.
+
+        Args:
+            records (list): The InputRecords in this dataset.
+        """
+        self._total_weight_by_position = array.array('d', map(
+            lambda x: sum(map(lambda y: y.get_weight(), x.get_wageotc())),
+            records
+        ))
+
+        triples_nested = map(
+            lambda x: map(
+                lambda y: (y.get_wage(), y.get_weight(), x[0]),
+                x[1].get_wageotc()
+            ),
+            enumerate(records)
+        )
+        triples = list(itertools.chain(*triples_nested))
+        triples.sort(key=lambda x: x[0])
+
+        self._sorted_wages = array.array('d', map(lambda x: x[0], triples))
+        self._sorted_weights = array.array('d', map(lambda x: x[1], triples))
+        self._sorted_positions = array.array(
+            'q',
+            map(lambda x: x[2], triples)
+        )
+        self._added_sorted_wages = []
+        self._presorted_marks = array.array('L', [0]) * len(records)
+
+    def _add_presorted_wages(self, records):
+        """Include the wages of newly added records for the presorted strategy.
+
+        Wages are kept in a separate sorted list which is merged with the
+        wages sorted at load time when scanned such that adding does not
+        require moving the larger arrays. Each batch is sorted once and merged
+        into that list.
+
+        Args:
+            records (list): The records just added in the order they were
+                stored.
+        """
+        triples = []
+        for record in records:
+            position = self._position_by_id[record.get_index()]
+            wages = record.get_wageotc()
+            self._total_weight_by_position.append(
+                sum(map(lambda x: x.get_weight(), wages))
+            )
+            self._presorted_marks.append(0)
+            triples.extend(map(
+                lambda x: (x.get_wage(), x.get_weight(), position),
+                wages
+            ))
+
+        triples.sort()
+        self._added_sorted_wages = list(heapq.merge(
+            self._added_sorted_wages,
+            triples
+        ))
+
+    def _calculate_unemp(self, records):
+        """Calculate the overall unemployment rate.
+
+        Args:
+            records (iterable): The InputRecords describing the population for
+                which the unemployment rate should be returned.
+
+        Returns:
+            float: The estimated unemployment rate as a percentage between 0
+                and 100.
+        """
+        unemp_tuples = map(
+            lambda x: (x.get_unemp_count(), x.get_unemp()),
+            records
+        )
+        weighted_tuples = map(lambda x: (x[0], x[0] * x[1]), unemp_tuples)
+        reduced = functools.reduce(
+            lambda a, b: (a[0] + b[0], a[1] + b[1]),
+            weighted_tuples
+        )
+        return reduced[1] / reduced[0]
+
+    def _calculate_size(self, records):
+        """Calculate the size of a population as summed census weight.
+
+        Args:
+            records (iterable): The InputRecords describing the population for
+                which the size should be returned.
+
+        Returns:
+            float: Estimated size of this population as a wage count weight.
+        """
+        wage_counts = map(lambda x: x.get_wage_count(), records)
+        return sum(wage_counts)
+
+    def _get_subpopulation(self, query):
+        """Retrieves part of the dataset based on the given query filters.
+
+        This method filters the dataset according to the dimensions specified in
+        the query object and returns only the subset of records that match all
+        the provided filtering criteria.
+
+        Args:
+            query (Query): A Query object containing the filter settings for
+                each dimension (e.g., education, occupation, race/ethnicity,
+                gender, etc.). Each filter can be set to None to imply no
+                filtering on that dimension.
+
+        Returns:
+            map: A map object containing the records that match all the filter
+                criteria, where each record is an instance of InputRecord.
+        """
+        positions = self._get_subpopulation_positions(query)
+        return map(self._records.__getitem__, positions)
+
+    def _get_subpopulation_positions(self, query):
+        """Find the storage positions of records matching a query.
+
+        The query is resolved to codes up front. If records are clustered and
+        the query filters on a leading part of the clustering key, matching
+        records are found within the contiguous range for that part with any
+        other filters checked against the codes. Otherwise each filter is a
+        lookup into the code indexed list of record ID sets.
+
+        Args:
+            query (Query): The query describing the population.
+
+        Returns:
+            iterable: Positions of the records matching all of the query's
+                filters.
+        """
+        resolved = self._resolve_query(query)
+
+        cluster_range = self._get_cluster_range(resolved)
+        if cluster_range is None:
+            ids = self._get_subpopulation_ids(resolved)
+            return map(self._position_by_id.__getitem__, ids)
+
+        start, end, remaining = cluster_range
+        positions = range(start, end)
+        for dimension, codes in remaining:
+            positions = self._filter_positions(positions, dimension, codes)
+
+        return positions
+
+    def _get_subpopulation_ids(self, resolved, steps=None):
+        """Find the IDs of records matching a resolved query.
+
+        Starts from the smallest matching index entry and intersects the others
+        in ascending order of size, stopping early if no records remain. Filters
+        allowing multiple codes use the union of the entries for those codes.
+
+        Args:
+            resolved (list): Tuples of dimension and codes from _resolve_query.
+            steps (list): Optional list to which a PlanStep is appended for
+                each intersection performed. Defaults to None.
+
+        Returns:
+            Collection of IDs of the records matching all of the query's
+            filters. This may be shared with the indexes so should not be
+            modified.
+        """
+        plan = sorted(
+            map(
+                lambda x: (x[0], x[1], self._get_allowed_ids(x[0], x[1])),
+                resolved
+            ),
+            key=lambda x: len(x[2])
+        )
+
+        if not plan:
+            return self._records_by_id.keys()
+
+        ret_index = None
+        for dimension, codes, allowed in plan:
+            if ret_index is None:
+                ret_index = allowed
+            else:
+                ret_index = allowed.intersection(ret_index)
+
+            if steps is not None:
+                catalog = self._get_catalog(dimension)
+                values = list(map(catalog.__getitem__, codes))
+                steps.append(PlanStep(
+                    dimension,
+                    values[0] if len(values) == 1 else values,
+                    len(allowed),
+                    len(ret_index)
+                ))
+
+            if not ret_index:
+                break
+
+        return ret_index
+
+    def _get_allowed_ids(self, dimension, codes):
+        """Get the IDs of records with any of the given codes in a dimension.
+
+        Args:
+            dimension (str): Name of the dimension which is one of DIMENSIONS.
+            codes (list): The codes allowed.
+
+        Returns:
+            set: IDs of matching records. This may be shared with the index so
+                should not be modified.
+        """
+        index = self._get_index(dimension)
+
+        if len(codes) == 1:
+            return index[codes[0]]
+
+        return set().union(*map(index.__getitem__, codes))
+
+    def _filter_positions(self, positions, dimension, codes):
+        """Keep only positions of records with one of the codes in a dimension.
+
+        Args:
+            positions (iterable): The positions to filter.
+            dimension (str): Name of the dimension which is one of DIMENSIONS.
+            codes (list): The codes of the values allowed.
+
+        Returns:
+            iterable: Positions whose record has one of the given codes.
+        """
+        record_codes = self._get_codes(dimension)
+
+        if len(codes) == 1:
+            code = codes[0]
+            return filter(lambda x: record_codes[x] == code, positions)
+
+        allowed = frozenset(codes)
+        return filter(lambda x: record_codes[x] in allowed, positions)
+
+    def _get_cluster_range(self, resolved):
+        """Find the range of clustered records which a query can be limited to.
+
+        Only filters requiring a single value extend the range.
+
+        Args:
+            resolved (list): Tuples of dimension and codes from _resolve_query.
+
+        Returns:
+            tuple: Start position (inclusive), end position (exclusive), and
+                list of remaining dimension and codes tuples not covered by the
+                range or None if records are not clustered or the query does
+                not filter on the first clustering dimension with one value.
+        """
+        if self._cluster_dimensions is None:
+            return None
+
+        codes_by_dimension = dict(resolved)
+
+        prefix = []
+        for dimension in self._cluster_dimensions:
+            codes = codes_by_dimension.get(dimension, [])
+            if len(codes) != 1:
+                break
+            prefix.append(codes[0])
+
+        if not prefix:
+            return None
+
+        covered = self._cluster_dimensions[:len(prefix)]
+        remaining = list(filter(lambda x: x[0] not in covered, resolved))
+
+        start, end = self._cluster_offsets.get(tuple(prefix), (0, 0))
+        return (start, end, remaining)
+
+    def _build_cluster_offsets(self, cluster_dimensions, records):
+        """Build the offset table for records sorted by a clustering key.
+
+        Args:
+            cluster_dimensions (list): The dimensions by which records were
+                sorted.
+            records (list): The InputRecords in storage order.
+        """
+        self._cluster_dimensions = list(cluster_dimensions)
+
+        cluster_codes = list(map(
+            self._get_codes,
+            self._cluster_dimensions
+        ))
+
+        self._cluster_offsets = {}
+        for position in range(len(records)):
+            key = tuple(map(lambda x: x[position], cluster_codes))
+            for prefix_length in range(1, len(key) + 1):
+                prefix = key[:prefix_length]
+                start, end = self._cluster_offsets.get(
+                    prefix,
+                    (position, position)
+                )
+                self._cluster_offsets[prefix] = (start, position + 1)
+
+        self._wage_counts = array.array(
+            'd',
+            map(lambda x: x.get_wage_count(), records)
+        )
+        self._unemp_counts = array.array(
+            'd',
+            map(lambda x: x.get_unemp_count(), records)
+        )
+        self._unemps = array.array('d', map(lambda x: x.get_unemp(), records))
+
+    def _make_index(self, getter, records):
+        """Create an index mapping distinct attribute values to record IDs.
+
+        Args:
+            getter (callable): A function to extract the desired attribute for
+                indexing from a record.
+            records (iterable): A collection of records to index based on the
+                extracted attribute.
+
+        Returns:
+            dict: A dictionary where each key is a distinct attribute value
+                and each value is a set of record IDs that have that attribute.
+        """
+        index = {}
+
+        for record in records:
+            value = getter(record)
+            sub_index = index.get(value, set())
+            sub_index.add(record.get_index())
+            index[value] = sub_index
+
+        return index
+
+
+def select_weighted_median(wage_tuples):
+    """Find the weighted median wage without sorting all wages.
+
+    Returns the smallest wage at which the cumulative weight (sorted by wage)
+    reaches half of the total weight, matching a walk over the fully sorted
+    wages. This uses a weighted quickselect which partitions around a pivot
+    and only continues into the side containing the half-weight point such
+    that expected time is linear. Once at most SELECT_SORT_SIZE wages remain,
+    they are sorted and walked in wage order like the full walk. Wages which
+    are already in sorted order are walked directly. Weights of discarded
+    partitions are summed in partition order so, like any reordering of
+    floating point sums, the result may differ from the full walk only when
+    the cumulative weight is within rounding error of half the total.
+
+    Args:
+        wage_tuples (iterable): The WageTuples over which to find the median.
+
+    Returns:
+        float: The weighted median wage.
+    """
+    candidates = list(map(
+        lambda x: (x.get_wage(), x.get_weight()),
+        wage_tuples
+    ))
+    mid_count = sum(map(lambda x: x[1], candidates)) / 2
+
+    is_sorted = all(map(
+        lambda x: x[0][0] <= x[1][0],
+        zip(candidates, itertools.islice(candidates, 1, None))
+    ))
+    if is_sorted:
+        weight_acc = 0
+        for wage, weight in candidates:
+            if weight_acc + weight >= mid_count:
+                return wage
+
+            weight_acc += weight
+
+        raise RuntimeError('Unable to get median wage.')
+
+    weight_acc = 0
+    while len(candidates) > SELECT_SORT_SIZE:
+        first = candidates[0][0]
+        middle = candidates[len(candidates) // 2][0]
+        last = candidates[-1][0]
+        pivot = sorted([first, middle, last])[1]
+
+        lesser = []
+        greater = []
+        lesser_weight = 0
+        equal_weight = 0
+        for candidate in candidates:
+            wage = candidate[0]
+            if wage < pivot:
+                lesser.append(candidate)
+                lesser_weight += candidate[1]
+            elif wage > pivot:
+                greater.append(candidate)
+            else:
+                equal_weight += candidate[1]
+
+        if lesser and weight_acc + lesser_weight >= mid_count:
+            candidates = lesser
+        elif weight_acc + lesser_weight + equal_weight >= mid_count:
+            return pivot
+        else:
+            weight_acc += lesser_weight + equal_weight
+            candidates = greater
+
+    candidates.sort(key=lambda x: x[0])
+    for wage, weight in candidates:
+        if weight_acc + weight >= mid_count:
+            return wage
+
+        weight_acc += weight
+
+    raise RuntimeError('Unable to get median wage.')
+
+
+def check_quantiles(quantiles):
+    """Ensure that requested quantiles are between 0 and 1.
+
+    Args:
+        quantiles (list): The quantiles to check.
+    """
+    for quantile in quantiles:
+        if quantile < 0 or quantile > 1:
+            raise RuntimeError('Quantile must be between 0 and 1.')
+
+
+def find_weighted_quantiles(wages, total_count, quantiles):
+    """Find multiple weighted quantiles in a single walk over sorted wages.
+
+    Args:
+        wages (iterable): Tuples of wage and weight in ascending order by wage.
+        total_count (float): The sum of all weights in wages.
+        quantiles (list): The quantiles to find as numbers from 0 to 1.
+
+    Returns:
+        list: For each quantile in the order given, the smallest wage at which
+            cumulative weight reaches that share of total_count or the largest
+            wage if rounding leaves the cumulative weight just short.
+    """
+    check_quantiles(quantiles)
+
+    targets = sorted(
+        map(lambda x: (x[1] * total_count, x[0]), enumerate(quantiles))
+    )
+    results = [None] * len(quantiles)
+
+    target_position = 0
+    weight_acc = 0
+    last_wage = None
+    for wage, weight in wages:
+        while target_position < len(targets):
+            target_count, result_position = targets[target_position]
+            if weight_acc + weight < target_count:
+                break
+
+            results[result_position] = wage
+            target_position += 1
+
+        if target_position >= len(targets):
+            return results
+
+        weight_acc += weight
+        last_wage = wage
+
+    if last_wage is None:
+        raise RuntimeError('Unable to get wage quantiles.')
+
+    for target_count, result_position in targets[target_position:]:
+        results[result_position] = last_wage
+
+    return results
+
+
+def make_histogram(wage_tuples, bins):
+    """Sum weights of wages into bins.
+
+    Args:
+        wage_tuples (list): The WageTuples to summarize.
+        bins: Either the number of equally sized bins (int) spanning the minimum
+            to maximum wage or a list of ascending bin edges in USD.
+
+    Returns:
+        list: HistogramBin for each bin in ascending order. Wages outside of the
+            edges are excluded.
+    """
+    if isinstance(bins, numbers.Integral):
+        if bins < 1:
+            raise RuntimeError('Histogram requires at least one bin.')
+
+        if not wage_tuples:
+            raise RuntimeError('Unable to get histogram for empty group.')
+
+        min_wage = min(map(lambda x: x.get_wage(), wage_tuples))
+        max_wage = max(map(lambda x: x.get_wage(), wage_tuples))
+        edges = get_histogram_edges(min_wage, max_wage, bins)
     else:
-        with open(loc) as f:
-            records = list(csv.DictReader(f))
+        edges = list(bins)
+        if len(edges) < 2:
+            raise RuntimeError('Histogram requires at least two edges.')
+
+    num_bins = len(edges) - 1
+    weights = [0] * num_bins
+    for wage_tuple in wage_tuples:
+        wage = wage_tuple.get_wage()
+        if wage < edges[0] or wage > edges[-1]:
+            continue
+
+        position = min(bisect.bisect_right(edges, wage) - 1, num_bins - 1)
+        weights[position] += wage_tuple.get_weight()
+
+    return list(map(
+        lambda x: HistogramBin(edges[x], edges[x + 1], weights[x]),
+        range(num_bins)
+    ))
+
+
+def get_histogram_edges(min_wage, max_wage, num_bins):
+    """Find the edges of equally sized bins spanning a range of wages.
+
+    Follows the rule of numpy.histogram, including widening the range by 0.5
+    on each side if all wages are equal, such that all backends agree.
+
+    Args:
+        min_wage (float): The smallest wage to include.
+        max_wage (float): The largest wage to include.
+        num_bins (int): The number of bins.
+
+    Returns:
+        list: The num_bins + 1 bin edges in ascending order.
+    """
+    if min_wage == max_wage:
+        min_wage -= 0.5
+        max_wage += 0.5
+
+    bin_width = (max_wage - min_wage) / num_bins
+    edges = list(map(lambda x: min_wage + bin_width * x, range(num_bins)))
+    edges.append(max_wage)
+    return edges
+
+
+def get_code_typecode(catalog_size):
+    """Get the smallest array typecode able to hold codes for a catalog.
+
+    Args:
+        catalog_size (int): The number of distinct values in the dimension.
+
+    Returns:
+        str: Typecode for array.array like B.
+    """
+    if catalog_size <= 2 ** 8:
+        return 'B'
+    elif catalog_size <= 2 ** 16:
+        return 'H'
+    else:
+        return 'L'
+
 
-    records_parsed = map(parse_record, records)
+def get_age_sort_key(label):
+    """Get a key which orders age group labels from youngest to oldest.
 
-    return Dataset(records_parsed)
+    Args:
+        label (str): Age group label like "<25 yr", "25-34 yr", or "65+".
+
+    Returns:
+        tuple: Sortable key using the first number in the label where labels
+            starting with < come before others with the same number.
+    """
+    match = re.search(r'\d+', label)
+    if match is None:
+        return (float('inf'), 0, label)
+
+    return (int(match.group(0)), -1 if label.startswith('<') else 0, label)
+
+
+def get_educ_sort_key(label):
+    """Get a key which orders education labels from least to most.
+
+    Args:
+        label (str): Education level label like "Some college".
+
+    Returns:
+        int: Position of the label within EDUC_ORDER.
+    """
+    if label not in EDUC_ORDER:
+        raise RuntimeError('Unknown education level: %s' % label)
+
+    return EDUC_ORDER.index(label)
+
+
+def get_category_sort_key(dimension):
+    """Get the function which orders the values of an ordered dimension.
+
+    Args:
+        dimension (str): Name of the dimension like age.
+
+    Returns:
+        callable: Function taking a value and returning a sortable key.
+    """
+    sort_keys = {
+        'age': get_age_sort_key,
+        'educ': get_educ_sort_key
+    }
+
+    if dimension not in sort_keys:
+        message = 'Ranges are not supported for dimension: %s' % dimension
+        raise RuntimeError(message)
+
+    return sort_keys[dimension]
+
+
+def resolve_filter(dimension, value, catalog, code_by_value):
+    """Find the codes of the catalog values matched by a query filter.
+
+    Args:
+        dimension (str): Name of the dimension which is one of DIMENSIONS.
+        value: The value or Predicate set on the query for the dimension.
+        catalog (list): Sorted distinct values of the dimension.
+        code_by_value (dict): Mapping from value to position in catalog.
+
+    Returns:
+        list: Ascending codes of the values matched which may be empty.
+    """
+    if isinstance(value, OneOfFilter):
+        codes_nested = map(
+            lambda x: resolve_filter(dimension, x, catalog, code_by_value),
+            value.get_values()
+        )
+        return sorted(set(itertools.chain(*codes_nested)))
+    elif isinstance(value, NotFilter):
+        excluded = set(resolve_filter(
+            dimension,
+            value.get_inner(),
+            catalog,
+            code_by_value
+        ))
+        return list(filter(
+            lambda x: x not in excluded,
+            range(len(catalog))
+        ))
+    elif isinstance(value, RangeFilter):
+        sort_key = get_category_sort_key(dimension)
+        start = value.get_start()
+        end = value.get_end()
+
+        for bound in filter(lambda x: x is not None, [start, end]):
+            if bound not in code_by_value:
+                message = 'Cannot find the provided value: %s' % str(bound)
+                raise RuntimeError(message)
+
+        start_key = None if start is None else sort_key(start)
+        end_key = None if end is None else sort_key(end)
+
+        def is_in_range(code):
+            key = sort_key(catalog[code])
+            after_start = start_key is None or key >= start_key
+            before_end = end_key is None or key <= end_key
+            return after_start and before_end
+
+        return list(filter(is_in_range, range(len(catalog))))
+    else:
+        if value not in code_by_value:
+            message = 'Cannot find the provided value: %s' % str(value)
+            raise RuntimeError(message)
+
+        return [code_by_value[value]]
+
+
+def has_predicates(query):
+    """Determine if a query filters any dimension with a Predicate.
+
+    Args:
+        query (Query): The query to check.
+
+    Returns:
+        bool: True if any filter is a Predicate instead of a single value.
+    """
+    return any(map(
+        lambda x: isinstance(get_dimension_getter(x)(query), Predicate),
+        DIMENSIONS
+    ))
+
+
+def get_dimension_getter(dimension):
+    """Get a function which reads a dimension's value from a record or query.
+
+    Args:
+        dimension (str): Name of the dimension which is one of DIMENSIONS.
+
+    Returns:
+        callable: Function taking an InputRecord or Query and returning the
+            value for the dimension like get_docc03 would.
+    """
+    if dimension not in DIMENSIONS:
+        raise RuntimeError('Unknown dimension: %s' % dimension)
+
+    getter_name = 'get_' + dimension
+    return lambda x: getattr(x, getter_name)()
+
+
+def iterate_chunks(iterable, chunk_size):
+    """Split an iterable into lists of bounded size.
+
+    Args:
+        iterable: The iterable to split which is consumed lazily.
+        chunk_size (int): Maximum number of items per chunk.
+
+    Returns:
+        iterable: Iterable over lists of up to chunk_size items.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+
+        yield chunk
+
+
+def parse_dimension(record_raw, dimension):
+    """Parse a single dimension's value from a raw CSV row.
+
+    Args:
+        record_raw (dict): The row as read from the CSV file.
+        dimension (str): Name of the dimension which is one of DIMENSIONS.
+
+    Returns:
+        The value as it would appear on an InputRecord from parse_record.
+        Strings are interned such that repeated labels share one object.
+    """
+    if dimension == 'female':
+        return str(record_raw['female']) == 'Female'
+    else:
+        return sys.intern(str(record_raw[dimension]))
+
+
+def parse_wage_otc(wage_otc_string):
+    tuple_unparsed = wage_otc_string.split(';')
+    tuple_strs = map(lambda x: x.split(' '), tuple_unparsed)
+    tuple_parsed = map(lambda x: (float(x[0]), float(x[1])), tuple_strs)
+    return map(lambda x: WageTuple(x[0], x[1]), tuple_parsed)
+
+
+def parse_wage_otc_column(wage_otc_strings):
+    """Parse many packed wageotc strings at once into flat arrays.
+
+    Splits each string into pairs exactly like parse_wage_otc, raising the
+    same errors for malformed pairs, but fills flat arrays instead of creating
+    per-pair objects.
+
+    Args:
+        wage_otc_strings (iterable): Strings like "wage weight;wage weight"
+            from the wageotc column.
+
+    Returns:
+        tuple: Wages (array.array), weights (array.array) and offsets
+            (array.array) where the pairs for record i are found from
+            offsets[i] up to offsets[i + 1].
+    """
+    wages = array.array('d')
+    weights = array.array('d')
+    offsets = array.array('q', [0])
+
+    for wage_otc_string in wage_otc_strings:
+        tuple_strs = list(map(
+            lambda x: x.split(' '),
+            wage_otc_string.split(';')
+        ))
+        wages.extend(map(lambda x: float(x[0]), tuple_strs))
+        weights.extend(map(lambda x: float(x[1]), tuple_strs))
+        offsets.append(offsets[-1] + len(tuple_strs))
+
+    return (wages, weights, offsets)
+
+
+def parse_record(record_raw):
+    index = int(record_raw['index'])
+    educ = parse_dimension(record_raw, 'educ')
+    docc03 = parse_dimension(record_raw, 'docc03')
+    wageotc = parse_wage_otc(record_raw['wageotc'])
+    unemp = float(record_raw['unemp'])
+    wage_count = float(record_raw['wageCount'])
+    unemp_count = float(record_raw['unempCount'])
+    wbhaom = parse_dimension(record_raw, 'wbhaom')
+    female = parse_dimension(record_raw, 'female')
+    region = parse_dimension(record_raw, 'region')
+    age = parse_dimension(record_raw, 'age')
+    hoursuint = parse_dimension(record_raw, 'hoursuint')
+    citistat = parse_dimension(record_raw, 'citistat')
+
+    return InputRecord(
+        index,
+        educ,
+        docc03,
+        wageotc,
+        unemp,
+        wage_count,
+        unemp_count,
+        wbhaom,
+        female,
+        region,
+        age,
+        hoursuint,
+        citistat
+    )
+
+
+def load_from_file(loc, sketch=None, dataset_factory=Dataset):
+    """Load a dataset from a CSV file.
+
+    Args:
+        loc (str): The location of the CSV file from which to parse
+            InputRecords.
+        sketch (sketchingpy.Sketch2D): The sketch to use to load the file or,
+            if None, uses a regular file. Defaults to None.
+        dataset_factory (callable): Function taking an iterable over
+            InputRecord and returning the dataset to query. Records are parsed
+            as the iterable is consumed so the factory should finish reading
+            them before returning. Defaults to Dataset but
+            columnar_model.make_dataset may be used for large files.
+
+    Returns:
+        Dataset parsed from the given location.
+    """
+    if sketch:
+        data_layer = sketch.get_data_layer()
+        records = data_layer.get_csv(loc)
+        return dataset_factory(map(parse_record, records))
+    else:
+        with open(loc) as f:
+            records_parsed = map(parse_record, csv.DictReader(f))
+            return dataset_factory(records_parsed)
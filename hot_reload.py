@@ -0,0 +1,264 @@
+"""Hot reloading of a data_model.Dataset when its CSV file changes.
+
+Long running processes can keep a single Dataset and periodically call reload
+on a ReloadingLoader. Changed files are diffed against the rows already loaded
+using a digest of each row's raw bytes such that only rows which were added
+or modified are parsed before the Dataset is patched in one atomic change.
+Requires a regular file so is not available when loading through a sketch.
+
+Author: A Samuel Pottinger
+License: MIT License
+"""
+import csv
+import hashlib
+import os
+import threading
+
+import data_model
+import parallel_load
+
+DEFAULT_WATCH_INTERVAL = 60
+DIGEST_SIZE = 16
+
+
+class ReloadSummary:
+    """Record describing the changes applied by a reload."""
+
+    def __init__(self, added, removed, modified):
+        """Create a new summary.
+
+        Args:
+            added (int): Number of rows found only in the new file.
+            removed (int): Number of rows found only in the prior file.
+            modified (int): Number of rows whose contents changed.
+        """
+        self._added = added
+        self._removed = removed
+        self._modified = modified
+
+    def get_added(self):
+        """Get the number of rows added.
+
+        Returns:
+            int: Count of new indices.
+        """
+        return self._added
+
+    def get_removed(self):
+        """Get the number of rows removed.
+
+        Returns:
+            int: Count of indices no longer present.
+        """
+        return self._removed
+
+    def get_modified(self):
+        """Get the number of rows replaced with new contents.
+
+        Returns:
+            int: Count of indices whose row changed.
+        """
+        return self._modified
+
+    def has_changes(self):
+        """Determine if the reload changed the dataset.
+
+        Returns:
+            bool: True if any row was added, removed, or modified.
+        """
+        return self._added + self._removed + self._modified > 0
+
+
+class ReloadingLoader:
+    """Loader which keeps a Dataset in sync with a CSV file."""
+
+    def __init__(self, loc, dataset_factory=data_model.Dataset):
+        """Load the dataset for the first time.
+
+        Args:
+            loc (str): The location of the CSV file.
+            dataset_factory (callable): Function taking an iterable over
+                InputRecord and returning a data_model.Dataset or a dataset
+                with the same apply_changes method. Defaults to
+                data_model.Dataset.
+        """
+        self._loc = loc
+        self._reload_lock = threading.Lock()
+        self._watch_thread = None
+        self._stop_watching = threading.Event()
+
+        fingerprint = self._get_fingerprint()
+        id_by_digest = {}
+        rows_raw = self._read_changed_rows(None, id_by_digest)
+
+        self._dataset = dataset_factory(map(data_model.parse_record, rows_raw))
+        self._id_by_digest = id_by_digest
+        self._fingerprint = fingerprint
+
+    def get_dataset(self):
+        """Get the dataset which is patched in place on reload.
+
+        Returns:
+            data_model.Dataset: The live dataset.
+        """
+        return self._dataset
+
+    def reload(self):
+        """Patch the dataset with changes to the CSV file if any.
+
+        Modified rows are removed and added again such that repeated reloads
+        rely on the dataset compacting the storage of removed records.
+
+        Returns:
+            ReloadSummary: Description of the rows changed which are all zero
+                if the file's size and modification time did not change.
+        """
+        with self._reload_lock:
+            fingerprint = self._get_fingerprint()
+            if fingerprint == self._fingerprint:
+                return ReloadSummary(0, 0, 0)
+
+            prior_id_by_digest = self._id_by_digest
+            id_by_digest = {}
+            records = list(map(
+                data_model.parse_record,
+                self._read_changed_rows(prior_id_by_digest, id_by_digest)
+            ))
+
+            ids = set(id_by_digest.values())
+            prior_ids = set(prior_id_by_digest.values())
+            removed = list(filter(
+                lambda x: x not in ids,
+                prior_id_by_digest.values()
+            ))
+            modified = list(filter(
+                lambda x: x in prior_ids,
+                map(lambda x: x.get_index(), records)
+            ))
+            added_count = len(records) - len(modified)
+
+            self._dataset.apply_changes(removed + modified, records)
+
+            self._id_by_digest = id_by_digest
+            self._fingerprint = fingerprint
+
+            return ReloadSummary(added_count, len(removed), len(modified))
+
+    def start_watching(self, interval=DEFAULT_WATCH_INTERVAL):
+        """Reload in a background thread whenever the file changes.
+
+        Args:
+            interval (float): Seconds between checks of the file's size and
+                modification time. Defaults to DEFAULT_WATCH_INTERVAL.
+        """
+        if self._watch_thread is not None:
+            return
+
+        self._stop_watching.clear()
+
+        def watch():
+            while not self._stop_watching.wait(interval):
+                self.reload()
+
+        self._watch_thread = threading.Thread(target=watch, daemon=True)
+        self._watch_thread.start()
+
+    def stop_watching(self):
+        """Stop a background thread started by start_watching."""
+        if self._watch_thread is None:
+            return
+
+        self._stop_watching.set()
+        self._watch_thread.join()
+        self._watch_thread = None
+
+    def _get_fingerprint(self):
+        """Describe the current version of the file.
+
+        Returns:
+            tuple: Size in bytes and modification time in nanoseconds.
+        """
+        stat = os.stat(self._loc)
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def _read_changed_rows(self, prior_id_by_digest, id_by_digest):
+        """Read the rows of the file which are new or changed.
+
+        Rows are matched to those already loaded by a BLAKE2 digest of their
+        raw bytes, keyed by the header such that all rows are read again if
+        the columns change. Only unmatched rows are parsed. Like
+        parallel_load.find_chunk_ranges, assumes that no quoted value contains
+        a newline.
+
+        Args:
+            prior_id_by_digest (dict): Mapping from row digest to index for the
+                rows already loaded or None to read all rows.
+            id_by_digest (dict): Empty dictionary to fill with the index of
+                every row in the file by digest.
+
+        Returns:
+            iterable: Rows which are new or changed as dictionaries like from
+                csv.DictReader which are parsed as the iterable is consumed.
+        """
+        changed = []
+
+        with open(self._loc, 'rb') as f:
+            header_raw = f.readline()
+            key = hashlib.blake2b(header_raw.rstrip(b'\r\n')).digest()
+
+            for line in f:
+                row_bytes = line.rstrip(b'\r\n')
+                if not row_bytes:
+                    continue
+
+                digest = hashlib.blake2b(
+                    row_bytes,
+                    digest_size=DIGEST_SIZE,
+                    key=key
+                ).digest()
+
+                if prior_id_by_digest and digest in prior_id_by_digest:
+                    index = prior_id_by_digest[digest]
+                    if digest in id_by_digest:
+                        message = 'Record index repeated: %s' % str(index)
+                        raise RuntimeError(message)
+
+                    id_by_digest[digest] = index
+                else:
+                    row_text = row_bytes.decode(parallel_load.ENCODING)
+                    changed.append((digest, row_text))
+
+        fieldnames = next(csv.reader(
+            [header_raw.decode(parallel_load.ENCODING)]
+        ))
+        rows_raw = csv.DictReader(
+            map(lambda x: x[1], changed),
+            fieldnames=fieldnames
+        )
+
+        known_ids = set(id_by_digest.values())
+        for (digest, row_text), row_raw in zip(changed, rows_raw):
+            index = int(row_raw['index'])
+            if index in known_ids:
+                message = 'Record index repeated: %s' % str(index)
+                raise RuntimeError(message)
+
+            known_ids.add(index)
+            id_by_digest[digest] = index
+            yield row_raw
+
+
+def load_from_file(loc, dataset_factory=data_model.Dataset):
+    """Load a dataset from a CSV file which can later be reloaded.
+
+    Args:
+        loc (str): The location of the CSV file from which to parse records.
+        dataset_factory (callable): Function taking an iterable over
+            InputRecord and returning a data_model.Dataset. Defaults to
+            data_model.Dataset.
+
+    Returns:
+        ReloadingLoader: Loader whose get_dataset returns the live dataset and
+            whose reload patches it after the file changes.
+    """
+    return ReloadingLoader(loc, dataset_factory)
@@ -0,0 +1,456 @@
+"""Parallel loading of data_model.Dataset from large CSV files.
+
+Opt-in alternative to data_model.load_from_file which splits the CSV into byte
+ranges aligned on row boundaries and parses them in a pool of processes. Each
+process returns compact columns with its range's dimensions dictionary
+encoded. These are merged directly into the encoded storage of a single
+Dataset such that the parent only creates the InputRecord objects. Requires a
+regular file so is not available when loading through a sketch.
+
+Author: A Samuel Pottinger
+License: MIT License
+"""
+import array
+import concurrent.futures
+import csv
+import io
+import itertools
+import os
+
+import data_model
+
+DEFAULT_CHUNKS_PER_WORKER = 4
+ENCODING = 'utf-8'
+
+
+class ParsedChunk:
+    """Records parsed from one byte range of a CSV file.
+
+    Holds columns instead of InputRecords such that the chunk can be passed
+    efficiently between processes. Dimensions are dictionary encoded within
+    the chunk such that each distinct value is sent only once.
+    """
+
+    def __init__(self, index, catalogs, codes, ids_by_code, unemp,
+            wage_count, unemp_count, wages, weights, wage_offsets):
+        """Create a new record of a parsed chunk.
+
+        Args:
+            index (array.array): Unique integer identifying each record.
+            catalogs (dict): Mapping from dimension name to sorted list of the
+                distinct values in this chunk like they appear on
+                InputRecord.
+            codes (dict): Mapping from dimension name to array.array of the
+                position within the catalog of each record's value.
+            ids_by_code (dict): Mapping from dimension name to list with an
+                array.array of the record IDs holding each catalog value.
+            unemp (array.array): Percent unemployment for each record.
+            wage_count (array.array): Weight of wage information per record.
+            unemp_count (array.array): Weight of unemployment information per
+                record.
+            wages (array.array): Flat wages across all records.
+            weights (array.array): Weights corresponding to wages.
+            wage_offsets (array.array): Start offset of each record's wages
+                followed by the total number of wages.
+        """
+        self._index = index
+        self._catalogs = catalogs
+        self._codes = codes
+        self._ids_by_code = ids_by_code
+        self._unemp = unemp
+        self._wage_count = wage_count
+        self._unemp_count = unemp_count
+        self._wages = wages
+        self._weights = weights
+        self._wage_offsets = wage_offsets
+
+    def get_size(self):
+        """Get the number of records in this chunk.
+
+        Returns:
+            int: Count of records.
+        """
+        return len(self._index)
+
+    def get_index(self):
+        """Get the unique ID of each record.
+
+        Returns:
+            array.array: Record IDs in file order.
+        """
+        return self._index
+
+    def get_catalog(self, dimension):
+        """Get the distinct values of a dimension within this chunk.
+
+        Args:
+            dimension (str): Name of the dimension which is one of
+                data_model.DIMENSIONS.
+
+        Returns:
+            list: Sorted values where each value's position is its code.
+        """
+        return self._catalogs[dimension]
+
+    def get_codes(self, dimension):
+        """Get the code of each record's value for a dimension.
+
+        Args:
+            dimension (str): Name of the dimension which is one of
+                data_model.DIMENSIONS.
+
+        Returns:
+            array.array: Positions within get_catalog in file order.
+        """
+        return self._codes[dimension]
+
+    def get_ids_by_code(self, dimension):
+        """Get the records holding each value of a dimension.
+
+        Args:
+            dimension (str): Name of the dimension which is one of
+                data_model.DIMENSIONS.
+
+        Returns:
+            list: Record IDs (array.array) for each code.
+        """
+        return self._ids_by_code[dimension]
+
+    def get_unemp(self):
+        """Get the percent unemployment of each record.
+
+        Returns:
+            array.array: Unemployment in file order.
+        """
+        return self._unemp
+
+    def get_wage_count(self):
+        """Get the weight of wage information of each record.
+
+        Returns:
+            array.array: Wage counts in file order.
+        """
+        return self._wage_count
+
+    def get_unemp_count(self):
+        """Get the weight of unemployment information of each record.
+
+        Returns:
+            array.array: Unemployment counts in file order.
+        """
+        return self._unemp_count
+
+    def get_wages(self):
+        """Get the wages of all records.
+
+        Returns:
+            array.array: Flat wages where get_wage_offsets gives the start of
+                each record's wages.
+        """
+        return self._wages
+
+    def get_weights(self):
+        """Get the population weight of each wage.
+
+        Returns:
+            array.array: Weights corresponding to get_wages.
+        """
+        return self._weights
+
+    def get_wage_offsets(self):
+        """Get the position at which each record's wages start.
+
+        Returns:
+            array.array: Start offset of each record's wages followed by the
+                total number of wages.
+        """
+        return self._wage_offsets
+
+
+def read_header(loc):
+    """Read the column names of a CSV file.
+
+    Args:
+        loc (str): Path to the CSV file.
+
+    Returns:
+        tuple: Field names (list) and the byte offset where rows start (int).
+    """
+    with open(loc, 'rb') as f:
+        header_raw = f.readline()
+
+    fieldnames = next(csv.reader([header_raw.decode(ENCODING)]))
+    return (fieldnames, len(header_raw))
+
+
+def find_chunk_ranges(loc, start, num_chunks):
+    """Split the rows of a CSV file into byte ranges aligned on row boundaries.
+
+    Assumes that no quoted value contains a newline which holds for the
+    preprocessed EPI data.
+
+    Args:
+        loc (str): Path to the CSV file.
+        start (int): Byte offset of the first row after the header.
+        num_chunks (int): Desired number of ranges. Fewer may be returned for
+            small files.
+
+    Returns:
+        list: Tuples of start (inclusive) and end (exclusive) byte offsets.
+    """
+    end = os.path.getsize(loc)
+    chunk_size = max((end - start) // num_chunks, 1)
+
+    boundaries = [start]
+    with open(loc, 'rb') as f:
+        for i in range(1, num_chunks):
+            target = start + i * chunk_size
+            if target <= boundaries[-1] or target >= end:
+                continue
+
+            f.seek(target - 1)
+            f.readline()
+            boundary = f.tell()
+
+            if boundary > boundaries[-1] and boundary < end:
+                boundaries.append(boundary)
+
+    boundaries.append(end)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def parse_chunk(loc, fieldnames, start, end):
+    """Parse the rows within a byte range of a CSV file.
+
+    Run within worker processes so must remain a module level function.
+
+    Args:
+        loc (str): Path to the CSV file.
+        fieldnames (list): Names of the columns from read_header.
+        start (int): Byte offset of the first row to parse.
+        end (int): Byte offset after the last row to parse.
+
+    Returns:
+        ParsedChunk: Columns and encodings for the rows in the range.
+    """
+    with open(loc, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode(ENCODING)
+
+    return parse_text(text, fieldnames)
+
+
+def parse_text(text, fieldnames):
+    """Parse CSV rows already read from a file.
+
+    Args:
+        text (str): The rows without the header.
+        fieldnames (list): Names of the columns from read_header.
+
+    Returns:
+        ParsedChunk: Columns and encodings for the rows.
+    """
+    records_raw = list(csv.DictReader(
+        io.StringIO(text, newline=''),
+        fieldnames=fieldnames
+    ))
+
+    index = array.array('q', map(lambda x: int(x['index']), records_raw))
+
+    catalogs = {}
+    codes = {}
+    ids_by_code = {}
+    for dimension in data_model.DIMENSIONS:
+        values = list(map(
+            lambda x: data_model.parse_dimension(x, dimension),
+            records_raw
+        ))
+        catalog = sorted(set(values))
+        code_by_value = dict(map(lambda x: (x[1], x[0]), enumerate(catalog)))
+        dimension_codes = array.array(
+            data_model.get_code_typecode(len(catalog)),
+            map(code_by_value.__getitem__, values)
+        )
+
+        dimension_ids = list(map(lambda x: array.array('q'), catalog))
+        for code, record_id in zip(dimension_codes, index):
+            dimension_ids[code].append(record_id)
+
+        catalogs[dimension] = catalog
+        codes[dimension] = dimension_codes
+        ids_by_code[dimension] = dimension_ids
+
+    def parse_float_column(name):
+        return array.array('d', map(lambda x: float(x[name]), records_raw))
+
+    wages, weights, wage_offsets = data_model.parse_wage_otc_column(
+        map(lambda x: x['wageotc'], records_raw)
+    )
+
+    return ParsedChunk(
+        index,
+        catalogs,
+        codes,
+        ids_by_code,
+        parse_float_column('unemp'),
+        parse_float_column('wageCount'),
+        parse_float_column('unempCount'),
+        wages,
+        weights,
+        wage_offsets
+    )
+
+
+def merge_dimension(chunks, dimension):
+    """Combine the encodings of a dimension across parsed chunks.
+
+    Only the catalogs are merged value by value. Codes are translated through
+    a table per chunk and record IDs are added to sets in bulk.
+
+    Args:
+        chunks (list): The ParsedChunks to combine in file order.
+        dimension (str): Name of the dimension which is one of
+            data_model.DIMENSIONS.
+
+    Returns:
+        data_model.EncodedDimension: Encoding of the dimension across all
+            chunks in file order.
+    """
+    catalogs = map(lambda x: x.get_catalog(dimension), chunks)
+    catalog = sorted(set(itertools.chain(*catalogs)))
+    code_by_value = dict(map(lambda x: (x[1], x[0]), enumerate(catalog)))
+    typecode = data_model.get_code_typecode(len(catalog))
+
+    codes = array.array(typecode)
+    index = list(map(lambda x: set(), catalog))
+    for chunk in chunks:
+        translation = list(map(
+            code_by_value.__getitem__,
+            chunk.get_catalog(dimension)
+        ))
+        codes.extend(array.array(
+            typecode,
+            map(translation.__getitem__, chunk.get_codes(dimension))
+        ))
+
+        record_ids_by_code = chunk.get_ids_by_code(dimension)
+        for code, record_ids in zip(translation, record_ids_by_code):
+            index[code].update(record_ids)
+
+    return data_model.EncodedDimension(catalog, codes, index)
+
+
+def merge_chunks(chunks):
+    """Combine parsed chunks into records and encodings for a Dataset.
+
+    Args:
+        chunks (list): The ParsedChunks to combine in file order.
+
+    Returns:
+        tuple: List of InputRecords and dict from dimension name to
+            data_model.EncodedDimension to pass as encodings to
+            data_model.Dataset. Records share the values held in the
+            catalogs.
+    """
+    encodings = dict(map(
+        lambda x: (x, merge_dimension(chunks, x)),
+        data_model.DIMENSIONS
+    ))
+
+    def concatenate(get_column, typecode):
+        column = array.array(typecode)
+        for chunk in chunks:
+            column.extend(get_column(chunk))
+        return column
+
+    wage_offsets = array.array('q', [0])
+    for chunk in chunks:
+        chunk_start = wage_offsets[-1]
+        chunk_offsets = itertools.islice(chunk.get_wage_offsets(), 1, None)
+        wage_offsets.extend(map(lambda x: x + chunk_start, chunk_offsets))
+
+    wage_tuples = list(map(
+        data_model.WageTuple,
+        concatenate(lambda x: x.get_wages(), 'd'),
+        concatenate(lambda x: x.get_weights(), 'd')
+    ))
+    wageotcs = map(
+        lambda x: wage_tuples[x[0]:x[1]],
+        zip(wage_offsets, itertools.islice(wage_offsets, 1, None))
+    )
+
+    def get_values(dimension):
+        encoding = encodings[dimension]
+        return map(encoding.get_catalog().__getitem__, encoding.get_codes())
+
+    records = list(map(
+        data_model.InputRecord,
+        concatenate(lambda x: x.get_index(), 'q'),
+        get_values('educ'),
+        get_values('docc03'),
+        wageotcs,
+        concatenate(lambda x: x.get_unemp(), 'd'),
+        concatenate(lambda x: x.get_wage_count(), 'd'),
+        concatenate(lambda x: x.get_unemp_count(), 'd'),
+        get_values('wbhaom'),
+        get_values('female'),
+        get_values('region'),
+        get_values('age'),
+        get_values('hoursuint'),
+        get_values('citistat')
+    ))
+
+    return (records, encodings)
+
+
+def check_unique_ids(chunks):
+    """Ensure that record IDs are not repeated across chunks.
+
+    Args:
+        chunks (list): The ParsedChunks to check.
+    """
+    seen = set()
+    total = 0
+
+    for chunk in chunks:
+        seen.update(chunk.get_index())
+        total += chunk.get_size()
+
+    if len(seen) != total:
+        raise RuntimeError('Record index values are not unique.')
+
+
+def load_from_file(loc, workers=None,
+        chunks_per_worker=DEFAULT_CHUNKS_PER_WORKER, **options):
+    """Load a dataset from a CSV file using multiple processes.
+
+    Args:
+        loc (str): The location of the CSV file from which to parse records.
+        workers (int): Number of processes to use. Defaults to None in which
+            case one per CPU is used.
+        chunks_per_worker (int): Number of byte ranges to create per process
+            to balance uneven rows. Defaults to DEFAULT_CHUNKS_PER_WORKER.
+        **options: Keyword arguments like median_strategy passed to
+            data_model.Dataset.
+
+    Returns:
+        data_model.Dataset: Dataset parsed from the given location.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    fieldnames, start = read_header(loc)
+    ranges = find_chunk_ranges(loc, start, workers * chunks_per_worker)
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = list(map(
+            lambda x: executor.submit(parse_chunk, loc, fieldnames, x[0], x[1]),
+            ranges
+        ))
+        chunks = list(map(lambda x: x.result(), futures))
+
+    check_unique_ids(chunks)
+
+    records, encodings = merge_chunks(chunks)
+    return data_model.Dataset(records, encodings=encodings, **options)
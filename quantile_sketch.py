@@ -0,0 +1,272 @@
+"""Mergeable sketches for approximate weighted wage quantiles.
+
+Author: A Samuel Pottinger
+License: MIT License
+"""
+import itertools
+import math
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+
+
+class WageSketch:
+    """Weighted histogram over logarithmically sized buckets.
+
+    Each bucket covers wages from gamma ^ (i - 1) up to gamma ^ i where gamma
+    is chosen such that the midpoint reported for a bucket is within the
+    relative accuracy of any wage in that bucket. Sketches with the same
+    accuracy can be merged by adding bucket weights such that quantiles for a
+    population can be estimated from sketches of its parts without revisiting
+    individual wages. Wages are expected to be non-negative and those of zero
+    are tracked separately.
+    """
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        """Create a new empty sketch.
+
+        Args:
+            relative_accuracy (float): Maximum relative error of estimated
+                quantiles like 0.01 for within 1%. Defaults to
+                DEFAULT_RELATIVE_ACCURACY.
+        """
+        if relative_accuracy <= 0 or relative_accuracy >= 1:
+            raise RuntimeError('Relative accuracy must be between 0 and 1.')
+
+        self._relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._weight_by_bucket = {}
+        self._count_by_bucket = {}
+        self._zero_weight = 0
+        self._zero_count = 0
+        self._total_weight = 0
+        self._count = 0
+
+    def get_relative_accuracy(self):
+        """Get the error bound for quantiles estimated by this sketch.
+
+        Returns:
+            float: Maximum relative error between an estimated quantile and the
+                exact weighted quantile.
+        """
+        return self._relative_accuracy
+
+    def get_total_weight(self):
+        """Get the total population weight added to this sketch.
+
+        Returns:
+            float: Sum of weights added directly or through merge.
+        """
+        return self._total_weight
+
+    def add(self, wage, weight):
+        """Add a wage to this sketch.
+
+        Args:
+            wage (float): The non-negative wage to add.
+            weight (float): The population weight associated with the wage.
+        """
+        if wage <= 0:
+            self._zero_weight += weight
+            self._zero_count += 1
+        else:
+            bucket = self._get_bucket(wage)
+            prior = self._weight_by_bucket.get(bucket, 0)
+            self._weight_by_bucket[bucket] = prior + weight
+            prior_count = self._count_by_bucket.get(bucket, 0)
+            self._count_by_bucket[bucket] = prior_count + 1
+
+        self._total_weight += weight
+        self._count += 1
+
+    def add_sorted(self, wages):
+        """Add many wages given in ascending order.
+
+        Equivalent to calling add for each wage but finds the bucket once per
+        distinct wage.
+
+        Args:
+            wages (iterable): Tuples of non-negative wage and population weight
+                sorted by wage.
+        """
+        for wage, run in itertools.groupby(wages, key=lambda x: x[0]):
+            run_weights = list(map(lambda x: x[1], run))
+            run_weight = sum(run_weights)
+            run_count = len(run_weights)
+
+            if wage <= 0:
+                self._zero_weight += run_weight
+                self._zero_count += run_count
+            else:
+                bucket = self._get_bucket(wage)
+                prior = self._weight_by_bucket.get(bucket, 0)
+                self._weight_by_bucket[bucket] = prior + run_weight
+                prior_count = self._count_by_bucket.get(bucket, 0)
+                self._count_by_bucket[bucket] = prior_count + run_count
+
+            self._total_weight += run_weight
+            self._count += run_count
+
+    def remove(self, wage, weight):
+        """Remove a wage previously added to this sketch.
+
+        Args:
+            wage (float): The wage to remove which must have been added.
+            weight (float): The population weight given when it was added.
+        """
+        if wage <= 0:
+            if self._zero_count == 0:
+                raise RuntimeError('Cannot remove wage not in sketch.')
+
+            self._zero_weight -= weight
+            self._zero_count -= 1
+        else:
+            bucket = self._get_bucket(wage)
+            if bucket not in self._count_by_bucket:
+                raise RuntimeError('Cannot remove wage not in sketch.')
+
+            remaining_count = self._count_by_bucket[bucket] - 1
+            if remaining_count == 0:
+                del self._weight_by_bucket[bucket]
+                del self._count_by_bucket[bucket]
+            else:
+                self._weight_by_bucket[bucket] -= weight
+                self._count_by_bucket[bucket] = remaining_count
+
+        self._total_weight -= weight
+        self._count -= 1
+
+    def merge(self, other):
+        """Add all of the weights from another sketch into this one.
+
+        Args:
+            other (WageSketch): Sketch with the same relative accuracy whose
+                weights should be added to this sketch. Not modified.
+        """
+        if other.get_relative_accuracy() != self._relative_accuracy:
+            raise RuntimeError('Cannot merge sketches of different accuracy.')
+
+        for bucket, weight in other._weight_by_bucket.items():
+            prior = self._weight_by_bucket.get(bucket, 0)
+            self._weight_by_bucket[bucket] = prior + weight
+
+        for bucket, count in other._count_by_bucket.items():
+            prior_count = self._count_by_bucket.get(bucket, 0)
+            self._count_by_bucket[bucket] = prior_count + count
+
+        self._zero_weight += other._zero_weight
+        self._zero_count += other._zero_count
+        self._total_weight += other._total_weight
+        self._count += other._count
+
+    def get_quantile(self, quantile):
+        """Estimate a weighted quantile.
+
+        Args:
+            quantile (float): The quantile to estimate from 0 to 1 like 0.5 for
+                the median.
+
+        Returns:
+            float: Estimated wage at which cumulative weight reaches the given
+                share of the total weight.
+        """
+        bucket, weight_below = self.get_quantile_bucket(quantile)
+
+        if bucket is None:
+            return 0.0
+
+        return self._get_bucket_value(bucket)
+
+    def get_quantile_bucket(self, quantile):
+        """Find the bucket containing a weighted quantile.
+
+        Args:
+            quantile (float): The quantile to find from 0 to 1 like 0.5 for the
+                median.
+
+        Returns:
+            tuple: The bucket (int or None for wages of zero) as given by
+                get_bucket in which cumulative weight reaches the given share
+                of the total weight and the weight of all buckets before it
+                (float).
+        """
+        if quantile < 0 or quantile > 1:
+            raise RuntimeError('Quantile must be between 0 and 1.')
+
+        if self._count == 0:
+            raise RuntimeError('Unable to get quantile of empty sketch.')
+
+        target_count = self._total_weight * quantile
+
+        weight_acc = self._zero_weight
+        if self._zero_count > 0 and weight_acc >= target_count:
+            return (None, 0)
+
+        if not self._weight_by_bucket:
+            return (None, 0)
+
+        for bucket in sorted(self._weight_by_bucket.keys()):
+            bucket_weight = self._weight_by_bucket[bucket]
+            if weight_acc + bucket_weight >= target_count:
+                return (bucket, weight_acc)
+
+            weight_acc += bucket_weight
+
+        last_bucket = max(self._weight_by_bucket.keys())
+        last_weight = self._weight_by_bucket[last_bucket]
+        return (last_bucket, weight_acc - last_weight)
+
+    def get_next_bucket(self, bucket):
+        """Find the first bucket holding wages after a bucket.
+
+        Args:
+            bucket (int): The bucket as given by get_bucket or None for wages
+                of zero.
+
+        Returns:
+            int: Index of the next bucket holding wages or None if there is no
+                later bucket.
+        """
+        later = filter(
+            lambda x: bucket is None or x > bucket,
+            self._weight_by_bucket.keys()
+        )
+        return min(later, default=None)
+
+    def get_bucket(self, wage):
+        """Get the bucket into which a wage is added.
+
+        Args:
+            wage (float): The wage to look up.
+
+        Returns:
+            int: Index of the bucket or None if the wage is tracked with those
+                of zero.
+        """
+        if wage <= 0:
+            return None
+
+        return self._get_bucket(wage)
+
+    def _get_bucket(self, wage):
+        """Get the index of the bucket containing a wage.
+
+        Args:
+            wage (float): The positive wage.
+
+        Returns:
+            int: Index of the bucket.
+        """
+        return math.ceil(math.log(wage) / self._log_gamma)
+
+    def _get_bucket_value(self, bucket):
+        """Get the value reported for wages in a bucket.
+
+        Args:
+            bucket (int): The index of the bucket.
+
+        Returns:
+            float: Value within the relative accuracy of all wages in the
+                bucket.
+        """
+        return 2 * math.pow(self._gamma, bucket) / (self._gamma + 1)
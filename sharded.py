@@ -0,0 +1,816 @@
+"""Map-reduce query execution across shards held by worker processes.
+
+A ShardedDataset splits the records of a CSV file into shards, either by byte
+range of the file or by the value of a dimension like region, and loads each
+shard into a data_model.Dataset within its own process. When partitioning by
+dimension, the coordinator reads the file once to split its rows such that
+each worker parses only its own. Queries are sent to
+every shard which returns mergeable partial aggregates: weight sums for sizes,
+weighted sums for unemployment, and wage sketches for medians. The coordinator
+combines them and, for exact medians, asks each shard for only the wages
+falling within the sketch bucket which holds the combined median. Requires a
+regular file so is not available when loading through a sketch.
+
+Author: A Samuel Pottinger
+License: MIT License
+"""
+import csv
+import multiprocessing
+import os
+import threading
+import zlib
+
+import data_model
+import parallel_load
+import quantile_sketch
+import streaming
+
+DEFAULT_PARTITION = 'range'
+MATCH_ALL = object()
+MATCH_NONE = object()
+
+
+class ShardWorker:
+    """Query handler for one shard running within a worker process.
+
+    Partial aggregates are found through the shard Dataset's indexes, cubes,
+    and result cache. The wages of each group found by get_partials are kept
+    sorted until the following get_median_candidates call.
+    """
+
+    def __init__(self, dataset, relative_accuracy):
+        """Create a new handler.
+
+        Args:
+            dataset (data_model.Dataset): The shard's records or None if the
+                shard is empty.
+            relative_accuracy (float): Accuracy of the wage sketches returned
+                in partial aggregates.
+        """
+        self._dataset = dataset
+        self._relative_accuracy = relative_accuracy
+        self._wages_by_key = {}
+
+        if dataset is None:
+            self._values_by_dimension = dict(map(
+                lambda x: (x, []),
+                data_model.DIMENSIONS
+            ))
+        else:
+            self._values_by_dimension = dict(map(
+                lambda x: (x, getattr(dataset, 'get_%s_vals' % x)()),
+                data_model.DIMENSIONS
+            ))
+
+        self._value_sets_by_dimension = dict(map(
+            lambda x: (x[0], set(x[1])),
+            self._values_by_dimension.items()
+        ))
+
+    def get_values(self):
+        """Get the distinct values of each dimension within this shard.
+
+        Returns:
+            dict: Mapping from dimension name to list of values.
+        """
+        return self._values_by_dimension
+
+    def get_maxima(self):
+        """Get the largest wage and unemployment rate within this shard.
+
+        Returns:
+            tuple: Maximum wage and unemployment rate or None if the shard is
+                empty.
+        """
+        if self._dataset is None:
+            return None
+
+        return (
+            self._dataset.get_max_wage(),
+            self._dataset.get_max_unemployment()
+        )
+
+    def get_partials(self, dimensions, base_query, needs_wages):
+        """Calculate partial aggregates per group within this shard.
+
+        Args:
+            dimensions (list): Names of the dimensions by which to group.
+            base_query (Query): Query describing the population to group.
+            needs_wages (bool): Flag indicating if wage sketches are required.
+                If so, the wages of each group are kept for
+                get_median_candidates.
+
+        Returns:
+            dict: Mapping from tuple of dimension values to
+                streaming.GroupAccumulator.
+        """
+        self._wages_by_key = {}
+
+        restricted = self._restrict_query(base_query)
+        if restricted is None:
+            return {}
+
+        relative_accuracy = self._relative_accuracy if needs_wages else None
+
+        accumulators = {}
+        sums_by_key = self._dataset.get_sums(dimensions, restricted)
+        for key, sums in sums_by_key.items():
+            accumulator = streaming.GroupAccumulator(relative_accuracy)
+            accumulator.add_sums(*sums)
+            accumulators[key] = accumulator
+
+        if needs_wages:
+            self._wages_by_key = self._dataset.get_wages_by_group(
+                dimensions,
+                restricted
+            )
+            for key, wages in self._wages_by_key.items():
+                accumulators[key].add_sorted_wages(wages)
+
+        return accumulators
+
+    def get_median_candidates(self, bucket_by_key):
+        """Find the wages within each group's median bucket in this shard.
+
+        Uses the wages kept by the prior get_partials call which are then
+        released.
+
+        Args:
+            bucket_by_key (dict): Mapping from tuple of dimension values to
+                tuple of the sketch bucket holding that group's combined median
+                and the first bucket holding wages after it or None.
+
+        Returns:
+            dict: Mapping from tuple of dimension values to the result of
+                streaming.select_sorted_bucket_wages for the group.
+        """
+        sketch = quantile_sketch.WageSketch(self._relative_accuracy)
+
+        candidates_by_key = {}
+        for key, wages in self._wages_by_key.items():
+            bucket, next_bucket = bucket_by_key[key]
+            candidates_by_key[key] = streaming.select_sorted_bucket_wages(
+                sketch,
+                bucket,
+                next_bucket,
+                wages
+            )
+
+        self._wages_by_key = {}
+        return candidates_by_key
+
+    def _restrict_query(self, query):
+        """Rewrite a query to name only values present in this shard.
+
+        Args:
+            query (Query): Query which may name values absent from this shard.
+
+        Returns:
+            Query: Equivalent query for the shard's Dataset or None if no
+                record in this shard can match.
+        """
+        if self._dataset is None:
+            return None
+
+        return restrict_query(query, self._value_sets_by_dimension)
+
+
+class ShardedDataset:
+    """Coordinator combining partial aggregates from worker processes.
+
+    Offers the get_size, get_unemp, get_wageotc, and group_by methods of
+    data_model.Dataset with matching results. Queries from multiple threads
+    take turns as each runs through the same pipes. Call close when finished
+    to stop the worker processes.
+    """
+
+    def __init__(self, loc, num_shards=None, partition=DEFAULT_PARTITION,
+            relative_accuracy=quantile_sketch.DEFAULT_RELATIVE_ACCURACY,
+            **options):
+        """Load the shards of a CSV file in worker processes.
+
+        Args:
+            loc (str): The location of the CSV file from which to parse records.
+            num_shards (int): Number of worker processes. Defaults to None in
+                which case one per CPU is used. Fewer may be used for small
+                files when partitioning by range.
+            partition (str): Either "range" to give each shard a contiguous
+                range of rows or the name of a dimension like "region" such
+                that all records sharing a value are in the same shard. The
+                latter holds the rows of the file in memory while splitting
+                them. Defaults to DEFAULT_PARTITION.
+            relative_accuracy (float): Accuracy of the wage sketches used to
+                find median buckets which affects only how many wages are sent
+                back from shards. Defaults to
+                quantile_sketch.DEFAULT_RELATIVE_ACCURACY.
+            **options: Keyword arguments like median_strategy passed to the
+                data_model.Dataset of each shard.
+        """
+        if num_shards is None:
+            num_shards = os.cpu_count() or 1
+
+        if partition == 'range':
+            fieldnames, start = parallel_load.read_header(loc)
+            ranges = parallel_load.find_chunk_ranges(loc, start, num_shards)
+            loads = list(map(
+                lambda x: (load_range_shard, (loc, fieldnames, x[0], x[1])),
+                ranges
+            ))
+        elif partition in data_model.DIMENSIONS:
+            fieldnames, texts = split_by_dimension(loc, partition, num_shards)
+            loads = list(map(
+                lambda x: (load_text_shard, (x, fieldnames)),
+                texts
+            ))
+        else:
+            raise RuntimeError('Unknown partition: %s' % partition)
+
+        self._lock = threading.Lock()
+        self._connections = []
+        self._processes = []
+        for load, load_args in loads:
+            connection, child_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=run_worker,
+                args=(child_connection, load, load_args, options,
+                    relative_accuracy),
+                daemon=True
+            )
+            process.start()
+            child_connection.close()
+
+            self._connections.append(connection)
+            self._processes.append(process)
+
+        try:
+            with self._lock:
+                values_by_shard = self._call_all('get_values')
+                maxima_by_shard = self._call_all('get_maxima')
+        except RuntimeError:
+            self.close()
+            raise
+
+        self._values_by_dimension = {}
+        for dimension in data_model.DIMENSIONS:
+            values = set()
+            for values_by_dimension in values_by_shard:
+                values.update(values_by_dimension[dimension])
+            self._values_by_dimension[dimension] = sorted(values)
+
+        maxima = list(filter(lambda x: x is not None, maxima_by_shard))
+        self._max_wage = max(map(lambda x: x[0], maxima), default=0)
+        self._max_unemployment = max(map(lambda x: x[1], maxima), default=0)
+
+    def get_num_shards(self):
+        """Get the number of worker processes holding shards.
+
+        Returns:
+            int: Count of shards.
+        """
+        return len(self._processes)
+
+    def get_wageotc(self, query):
+        """Get median wage for a group with overtime, tips, and comissions.
+
+        Args:
+            query (Query): A Query object describing the population for which
+                the median wage should be returned.
+
+        Returns:
+            float: The estimated median wage for the given population in USD.
+        """
+        groups = self._find_groups([], ['wageotc'], query)
+        return self._get_single_group(groups)['wageotc']
+
+    def get_unemp(self, query):
+        """Get the overall unemployment rate for a group.
+
+        Args:
+            query (Query): A Query object describing the population for which
+                the unemployemnt rate should be returned.
+
+        Returns:
+            float: The estimated unemployment rate for the specified group as
+                a percentage between 0 and 100.
+        """
+        groups = self._find_groups([], ['unemp'], query)
+        return self._get_single_group(groups)['unemp']
+
+    def get_size(self, query):
+        """Get the size of a population as summed census weight.
+
+        Args:
+            query (Query): A Query object describing the population for which
+                the size should be returned.
+
+        Returns:
+            float: Estimated size of this population as a wage count weight.
+        """
+        groups = self._find_groups([], ['size'], query)
+        if not groups:
+            return 0
+
+        return self._get_single_group(groups)['size']
+
+    def group_by(self, dimensions, metrics, base_query=None):
+        """Calculate metrics for every combination of values in dimensions.
+
+        Args:
+            dimensions (list): Names of the dimensions by which to group like
+                ['docc03', 'female'].
+            metrics (list): Names of the metrics to calculate per group where
+                each is one of data_model.METRICS.
+            base_query (Query): Optional query describing the population to
+                group. Defaults to None in which case all records are grouped.
+
+        Returns:
+            dict: Mapping from tuple of dimension values (in the order given by
+                dimensions) to a dict from metric name to its value like
+                data_model.Dataset.group_by.
+        """
+        for dimension in dimensions:
+            if dimension not in data_model.DIMENSIONS:
+                raise RuntimeError('Unknown dimension: %s' % dimension)
+
+        for metric in metrics:
+            if metric not in data_model.METRICS:
+                raise RuntimeError('Unknown metric: %s' % metric)
+
+        if base_query is None:
+            base_query = data_model.Query()
+
+        return self._find_groups(dimensions, metrics, base_query)
+
+    def close(self):
+        """Stop the worker processes including any which already exited."""
+        with self._lock:
+            self._stop_workers()
+
+    def get_max_wage(self):
+        """Get the maximum wage across all shards.
+
+        Returns:
+            float: Maximum wage value.
+        """
+        return self._max_wage
+
+    def get_max_unemployment(self):
+        """Get the maximum unemployment rate across all shards.
+
+        Returns:
+            float: Maximum unemployment rate value.
+        """
+        return self._max_unemployment
+
+    def get_educ_vals(self):
+        """Get all unique education level values across shards.
+
+        Returns:
+            list: Sorted list of education level labels.
+        """
+        return self._values_by_dimension['educ']
+
+    def get_docc03_vals(self):
+        """Get all unique occupation values across shards.
+
+        Returns:
+            list: Sorted list of occupation labels.
+        """
+        return self._values_by_dimension['docc03']
+
+    def get_wbhaom_vals(self):
+        """Get all unique race/ethnicity values across shards.
+
+        Returns:
+            list: Sorted list of race/ethnicity labels.
+        """
+        return self._values_by_dimension['wbhaom']
+
+    def get_female_vals(self):
+        """Get all unique gender values across shards.
+
+        Returns:
+            list: Sorted list of boolean values indicating female or not.
+        """
+        return self._values_by_dimension['female']
+
+    def get_region_vals(self):
+        """Get all unique region values across shards.
+
+        Returns:
+            list: Sorted list of geographic region labels.
+        """
+        return self._values_by_dimension['region']
+
+    def get_age_vals(self):
+        """Get all unique age group values across shards.
+
+        Returns:
+            list: Sorted list of age group labels.
+        """
+        return self._values_by_dimension['age']
+
+    def get_hoursuint_vals(self):
+        """Get all unique hours worked values across shards.
+
+        Returns:
+            list: Sorted list of hours worked labels.
+        """
+        return self._values_by_dimension['hoursuint']
+
+    def get_citistat_vals(self):
+        """Get all unique citizenship status values across shards.
+
+        Returns:
+            list: Sorted list of citizenship status labels.
+        """
+        return self._values_by_dimension['citistat']
+
+    def _get_single_group(self, groups):
+        """Get the metrics for an ungrouped population.
+
+        Args:
+            groups (dict): Result of _find_groups without dimensions.
+
+        Returns:
+            dict: Mapping from metric name to value.
+        """
+        if not groups:
+            raise RuntimeError('Unable to find records for query.')
+
+        return groups[()]
+
+    def _find_groups(self, dimensions, metrics, base_query):
+        """Combine partial aggregates from all shards.
+
+        Args:
+            dimensions (list): Names of the dimensions by which to group.
+            metrics (list): Names of the metrics to calculate per group.
+            base_query (Query): Query describing the population to group.
+
+        Returns:
+            dict: Mapping from tuple of dimension values to a dict from metric
+                name to its value.
+        """
+        self._check_values(base_query)
+
+        with self._lock:
+            accumulators = self._gather_accumulators(
+                dimensions,
+                'wageotc' in metrics,
+                base_query
+            )
+
+        return dict(map(
+            lambda x: (
+                x[0],
+                dict(map(
+                    lambda metric: (metric, x[1].get_metric(metric, True)),
+                    metrics
+                ))
+            ),
+            accumulators.items()
+        ))
+
+    def _gather_accumulators(self, dimensions, needs_wages, base_query):
+        """Merge the partial aggregates of every shard while holding the lock.
+
+        Shards keep the wages found by get_partials until the following
+        get_median_candidates so both requests must be made under one hold of
+        the lock.
+
+        Args:
+            dimensions (list): Names of the dimensions by which to group.
+            needs_wages (bool): Flag indicating if exact medians are needed.
+            base_query (Query): Query describing the population to group.
+
+        Returns:
+            dict: Mapping from tuple of dimension values to the group's
+                streaming.GroupAccumulator.
+        """
+        partials_by_shard = self._call_all(
+            'get_partials',
+            dimensions,
+            base_query,
+            needs_wages
+        )
+
+        accumulators = {}
+        for partials in partials_by_shard:
+            for key, partial in partials.items():
+                if key in accumulators:
+                    accumulators[key].merge(partial)
+                else:
+                    accumulators[key] = partial
+
+        if needs_wages:
+            for accumulator in accumulators.values():
+                accumulator.start_median_selection()
+
+            bucket_by_key = dict(map(
+                lambda x: (
+                    x[0],
+                    (x[1].get_median_bucket(), x[1].get_next_bucket())
+                ),
+                accumulators.items()
+            ))
+            candidates_by_shard = self._call_all(
+                'get_median_candidates',
+                bucket_by_key
+            )
+
+            for candidates in candidates_by_shard:
+                for key, candidate in candidates.items():
+                    weight_by_wage, next_wage = candidate
+                    accumulators[key].merge_median_candidates(
+                        weight_by_wage,
+                        next_wage
+                    )
+
+        return accumulators
+
+    def _check_values(self, query):
+        """Ensure values named by a query are found in at least one shard.
+
+        Args:
+            query (Query): The query to check.
+        """
+        for dimension in data_model.DIMENSIONS:
+            value_filter = data_model.get_dimension_getter(dimension)(query)
+            if value_filter is None:
+                continue
+
+            known_values = self._values_by_dimension[dimension]
+            for value in streaming.get_plain_values(value_filter):
+                if value not in known_values:
+                    message = 'Cannot find the provided value: %s' % str(value)
+                    raise RuntimeError(message)
+
+    def _stop_workers(self):
+        """Stop the worker processes while holding the lock."""
+        for connection in self._connections:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+
+            connection.close()
+
+        for process in self._processes:
+            process.join()
+
+        self._connections = []
+        self._processes = []
+
+    def _call_all(self, method_name, *args):
+        """Call a ShardWorker method in every shard in parallel.
+
+        Replies are read from every shard before any error is raised such that
+        each pipe stays in step with its worker. The caller must hold the lock
+        for the whole exchange so that requests from other threads do not
+        interleave on the pipes.
+
+        Args:
+            method_name (str): Name of the ShardWorker method to call.
+            *args: Arguments to pass to the method.
+
+        Returns:
+            list: Result from each shard in shard order.
+        """
+        for connection in self._connections:
+            try:
+                connection.send((method_name, args))
+            except OSError:
+                pass
+
+        responses = list(map(receive_response, self._connections))
+
+        for status, result in responses:
+            if status == 'error':
+                raise RuntimeError(result)
+
+        return list(map(lambda x: x[1], responses))
+
+
+def run_worker(connection, load, load_args, options, relative_accuracy):
+    """Load a shard and answer requests until told to stop.
+
+    Run within worker processes so must remain a module level function.
+
+    Args:
+        connection (multiprocessing.connection.Connection): Pipe to the
+            coordinator which sends tuples of ShardWorker method name and
+            arguments or None to stop.
+        load (callable): Function like load_range_shard returning the shard's
+            InputRecords and optional encodings.
+        load_args (tuple): Arguments to pass to load.
+        options (dict): Keyword arguments for data_model.Dataset.
+        relative_accuracy (float): Accuracy of wage sketches to return.
+    """
+    records, encodings = load(*load_args)
+    if records:
+        dataset = data_model.Dataset(records, encodings=encodings, **options)
+    else:
+        dataset = None
+
+    worker = ShardWorker(dataset, relative_accuracy)
+
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+
+        method_name, args = message
+        try:
+            result = getattr(worker, method_name)(*args)
+            connection.send(('ok', result))
+        except Exception as e:
+            connection.send(('error', str(e)))
+
+    connection.close()
+
+
+def receive_response(connection):
+    """Read a worker's reply to a request.
+
+    Args:
+        connection (multiprocessing.connection.Connection): Pipe to the
+            worker.
+
+    Returns:
+        tuple: Status of "ok" or "error" and the result or error message. An
+            error is returned if the worker exited before replying.
+    """
+    try:
+        return connection.recv()
+    except (EOFError, OSError):
+        return ('error', 'Shard worker exited unexpectedly.')
+
+
+def load_range_shard(loc, fieldnames, start, end):
+    """Parse the records within a byte range of a CSV file.
+
+    Args:
+        loc (str): Path to the CSV file.
+        fieldnames (list): Names of the columns from read_header.
+        start (int): Byte offset of the first row to parse.
+        end (int): Byte offset after the last row to parse.
+
+    Returns:
+        tuple: List of InputRecords and encodings for data_model.Dataset.
+    """
+    chunk = parallel_load.parse_chunk(loc, fieldnames, start, end)
+    return parallel_load.merge_chunks([chunk])
+
+
+def load_text_shard(text, fieldnames):
+    """Parse the rows assigned to a shard by split_by_dimension.
+
+    Args:
+        text (str): The shard's rows without the header.
+        fieldnames (list): Names of the columns from read_header.
+
+    Returns:
+        tuple: List of InputRecords and encodings for data_model.Dataset.
+    """
+    chunk = parallel_load.parse_text(text, fieldnames)
+    return parallel_load.merge_chunks([chunk])
+
+
+def split_by_dimension(loc, dimension, num_shards):
+    """Read a CSV file once and split its rows by shard of a dimension value.
+
+    Only the columns of each row are split here as the rows are parsed into
+    records within the workers. Like parallel_load.find_chunk_ranges, assumes
+    that no quoted value contains a newline.
+
+    Args:
+        loc (str): Path to the CSV file.
+        dimension (str): Name of the dimension by which to partition.
+        num_shards (int): Total number of shards.
+
+    Returns:
+        tuple: Field names (list) and the rows assigned to each shard in file
+            order (list of str).
+    """
+    fieldnames, start = parallel_load.read_header(loc)
+    with open(loc, 'rb') as f:
+        f.seek(start)
+        lines = f.read().decode(parallel_load.ENCODING).splitlines(True)
+
+    column = fieldnames.index(dimension)
+    lines_by_shard = list(map(lambda x: [], range(num_shards)))
+    for line, row in zip(lines, csv.reader(lines)):
+        if not row:
+            continue
+
+        record_raw = {dimension: row[column]}
+        value = data_model.parse_dimension(record_raw, dimension)
+        lines_by_shard[get_shard(value, num_shards)].append(line)
+
+    return (fieldnames, list(map(lambda x: ''.join(x), lines_by_shard)))
+
+
+def get_shard(value, num_shards):
+    """Assign a dimension value to a shard consistently across processes.
+
+    Args:
+        value: The dimension value like a region label.
+        num_shards (int): Total number of shards.
+
+    Returns:
+        int: Position of the shard from zero.
+    """
+    value_bytes = str(value).encode(parallel_load.ENCODING)
+    return zlib.crc32(value_bytes) % num_shards
+
+
+def restrict_query(query, value_sets_by_dimension):
+    """Rewrite a query to name only values present in a shard.
+
+    Args:
+        query (Query): The query which may name values absent from the shard.
+        value_sets_by_dimension (dict): Mapping from dimension name to the set
+            of values present in the shard.
+
+    Returns:
+        Query: Equivalent query for the shard or None if no record in the
+            shard can match.
+    """
+    restricted = data_model.Query()
+
+    for dimension in data_model.DIMENSIONS:
+        value_filter = data_model.get_dimension_getter(dimension)(query)
+        if value_filter is None:
+            continue
+
+        known_values = value_sets_by_dimension[dimension]
+        restricted_filter = restrict_filter(
+            dimension,
+            value_filter,
+            known_values
+        )
+
+        if restricted_filter is MATCH_NONE:
+            return None
+        elif restricted_filter is not MATCH_ALL:
+            getattr(restricted, 'set_' + dimension)(restricted_filter)
+
+    return restricted
+
+
+def restrict_filter(dimension, value_filter, known_values):
+    """Rewrite a query filter to name only known values.
+
+    Args:
+        dimension (str): Name of the dimension which is one of DIMENSIONS.
+        value_filter: The value or Predicate set on a query for a dimension.
+        known_values (set): Values of the dimension present in the shard.
+
+    Returns:
+        The equivalent value or Predicate, MATCH_ALL if every value matches, or
+        MATCH_NONE if no value matches.
+    """
+    if isinstance(value_filter, data_model.OneOfFilter):
+        restricted = list(map(
+            lambda x: restrict_filter(dimension, x, known_values),
+            value_filter.get_values()
+        ))
+
+        if any(map(lambda x: x is MATCH_ALL, restricted)):
+            return MATCH_ALL
+
+        remaining = list(filter(lambda x: x is not MATCH_NONE, restricted))
+        if not remaining:
+            return MATCH_NONE
+
+        return data_model.OneOfFilter(remaining)
+    elif isinstance(value_filter, data_model.NotFilter):
+        inner = restrict_filter(
+            dimension,
+            value_filter.get_inner(),
+            known_values
+        )
+
+        if inner is MATCH_ALL:
+            return MATCH_NONE
+        elif inner is MATCH_NONE:
+            return MATCH_ALL
+        else:
+            return data_model.NotFilter(inner)
+    elif isinstance(value_filter, data_model.RangeFilter):
+        matched = list(filter(
+            lambda x: streaming.matches_filter(dimension, value_filter, x),
+            known_values
+        ))
+
+        if not matched:
+            return MATCH_NONE
+        elif len(matched) == len(known_values):
+            return MATCH_ALL
+        else:
+            return data_model.OneOfFilter(matched)
+    elif value_filter in known_values:
+        return value_filter
+    else:
+        return MATCH_NONE
@@ -0,0 +1,579 @@
+"""Columnar datasets held in shared memory for multi-process readers.
+
+The arrays and indexes of a columnar_model.ColumnarDataset are copied once
+into a single multiprocessing.shared_memory segment. Other processes attach to
+the segment through a small picklable SharedDatasetHandle and build read-only
+NumPy views over it such that additional readers neither parse the CSV nor
+copy the arrays. Queries are made through SharedDataset which keeps the views
+private such that they cannot outlive the mapping. Unlike data_model.Dataset,
+there are no per-record Python objects whose reference counts would defeat
+copy-on-write sharing after fork.
+
+Author: A Samuel Pottinger
+License: MIT License
+"""
+import os
+import threading
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+
+import numpy
+
+import columnar_model
+
+ALIGNMENT = 64
+
+
+class SharedArrayLayout:
+    """Record describing where one array lives within a shared segment."""
+
+    def __init__(self, name, dtype, shape, offset):
+        """Create a new layout record.
+
+        Args:
+            name (str): Name of the array as given by
+                columnar_model.get_named_arrays.
+            dtype (str): NumPy dtype string like "<f8".
+            shape (tuple): Shape of the array.
+            offset (int): Byte offset of the array within the segment.
+        """
+        self._name = name
+        self._dtype = dtype
+        self._shape = shape
+        self._offset = offset
+
+    def get_name(self):
+        """Get the name of the array.
+
+        Returns:
+            str: Name like wages or codes_region.
+        """
+        return self._name
+
+    def get_dtype(self):
+        """Get the type of the array's elements.
+
+        Returns:
+            str: NumPy dtype string.
+        """
+        return self._dtype
+
+    def get_shape(self):
+        """Get the dimensions of the array.
+
+        Returns:
+            tuple: Shape of the array.
+        """
+        return self._shape
+
+    def get_offset(self):
+        """Get where the array starts within the segment.
+
+        Returns:
+            int: Byte offset aligned to ALIGNMENT.
+        """
+        return self._offset
+
+
+class SharedDatasetHandle:
+    """Picklable description of a dataset published to shared memory."""
+
+    def __init__(self, segment_name, layouts, catalogs, derived_names,
+            options, tracker_id):
+        """Create a new handle.
+
+        Args:
+            segment_name (str): Name of the shared memory segment.
+            layouts (list): SharedArrayLayout for each array in the segment.
+            catalogs (dict): Mapping from dimension name to list of values by
+                code.
+            derived_names (list): Names of the derived indexes in the segment
+                without prefix.
+            options (dict): Keyword arguments like use_bitmaps used to create
+                the published ColumnarDataset.
+            tracker_id (tuple): Identity of the publisher's resource tracker
+                from get_tracker_id.
+        """
+        self._segment_name = segment_name
+        self._layouts = layouts
+        self._catalogs = catalogs
+        self._derived_names = derived_names
+        self._options = options
+        self._tracker_id = tracker_id
+
+    def get_segment_name(self):
+        """Get the name by which to attach to the shared memory segment.
+
+        Returns:
+            str: Segment name.
+        """
+        return self._segment_name
+
+    def get_layouts(self):
+        """Get the location of each array within the segment.
+
+        Returns:
+            list: SharedArrayLayout per array.
+        """
+        return self._layouts
+
+    def get_catalogs(self):
+        """Get the values of each dimension by code.
+
+        Returns:
+            dict: Mapping from dimension name to list of values.
+        """
+        return self._catalogs
+
+    def get_derived_names(self):
+        """Get the names of the prebuilt indexes in the segment.
+
+        Returns:
+            list: Names like sorted_wages or bitmap_region.
+        """
+        return self._derived_names
+
+    def get_options(self):
+        """Get the options used to create the published dataset.
+
+        Returns:
+            dict: Keyword arguments for columnar_model.ColumnarDataset.
+        """
+        return self._options
+
+    def get_tracker_id(self):
+        """Get the identity of the resource tracker watching the segment.
+
+        Returns:
+            tuple: Identity from get_tracker_id in the publishing process.
+        """
+        return self._tracker_id
+
+
+class SharedDataset:
+    """A columnar dataset backed by a shared memory segment.
+
+    Offers the query methods of columnar_model.ColumnarDataset by forwarding
+    them to a dataset over views into the segment. The views are never handed
+    out such that, after close unmaps the segment, queries raise a
+    RuntimeError instead of reading unmapped memory. Queries from multiple
+    threads run concurrently as the lock guards only whether the segment is
+    open.
+    """
+
+    def __init__(self, handle, segment, dataset, is_owner):
+        """Create a new record of a published or attached dataset.
+
+        Args:
+            handle (SharedDatasetHandle): Description of the segment.
+            segment (shared_memory.SharedMemory): The open segment which must
+                stay open while the dataset is queried.
+            dataset (columnar_model.ColumnarDataset): Dataset whose arrays are
+                views into the segment. Must not be referenced elsewhere.
+            is_owner (bool): Flag indicating if this process published the
+                segment and should remove it on close.
+        """
+        self._handle = handle
+        self._segment = segment
+        self._dataset = dataset
+        self._is_owner = is_owner
+        self._lock = threading.Lock()
+        self._queries_finished = threading.Condition(self._lock)
+        self._active_queries = 0
+
+    def get_handle(self):
+        """Get the handle to pass to other processes for attach.
+
+        Returns:
+            SharedDatasetHandle: Picklable description of the segment.
+        """
+        return self._handle
+
+    def is_closed(self):
+        """Determine if close has been called.
+
+        Returns:
+            bool: True if the segment is no longer mapped by this object.
+        """
+        return self._segment is None
+
+    def get_wageotc(self, query):
+        """Get median wage for a group with overtime, tips, and comissions.
+
+        Args:
+            query (data_model.Query): A Query object describing the population
+                for which the median wage should be returned.
+
+        Returns:
+            float: The estimated median wage for the given population in USD.
+        """
+        return self._call('get_wageotc', query)
+
+    def get_wage_quantiles(self, query, quantiles):
+        """Get multiple weighted wage quantiles.
+
+        Args:
+            query (data_model.Query): A Query object describing the population
+                for which the quantiles should be returned.
+            quantiles (list): The quantiles to find as numbers from 0 to 1.
+
+        Returns:
+            list: Wage in USD (float) for each quantile in the order given.
+        """
+        return self._call('get_wage_quantiles', query, quantiles)
+
+    def get_wage_histogram(self, query, bins):
+        """Get the weighted distribution of wages for a group.
+
+        Args:
+            query (data_model.Query): A Query object describing the population
+                for which the histogram should be returned.
+            bins: Either the number of equally sized bins (int) or a list of
+                ascending bin edges in USD.
+
+        Returns:
+            list: data_model.HistogramBin for each bin in ascending order.
+        """
+        return self._call('get_wage_histogram', query, bins)
+
+    def get_unemp(self, query):
+        """Get the overall unemployment rate for a group.
+
+        Args:
+            query (data_model.Query): A Query object describing the population
+                for which the unemployemnt rate should be returned.
+
+        Returns:
+            float: The estimated unemployment rate for the specified group as
+                a percentage between 0 and 100.
+        """
+        return self._call('get_unemp', query)
+
+    def get_size(self, query):
+        """Get the size of a population as summed census weight.
+
+        Args:
+            query (data_model.Query): A Query object describing the population
+                for which the size should be returned.
+
+        Returns:
+            float: Estimated size of this population as a wage count weight.
+        """
+        return self._call('get_size', query)
+
+    def group_by(self, dimensions, metrics, base_query=None):
+        """Calculate metrics for every combination of values in dimensions.
+
+        Args:
+            dimensions (list): Names of the dimensions by which to group.
+            metrics (list): Names of the metrics to calculate per group where
+                each is one of data_model.METRICS.
+            base_query (data_model.Query): Optional query describing the
+                population to group. Defaults to None in which case all records
+                are grouped.
+
+        Returns:
+            dict: Mapping from tuple of dimension values to a dict from metric
+                name to its value like data_model.Dataset.group_by.
+        """
+        return self._call('group_by', dimensions, metrics, base_query)
+
+    def get_max_wage(self):
+        """Get the maximum wage in the dataset.
+
+        Returns:
+            float: Maximum wage value.
+        """
+        return self._call('get_max_wage')
+
+    def get_max_unemployment(self):
+        """Get the maximum unemployment rate in the dataset.
+
+        Returns:
+            float: Maximum unemployment rate value.
+        """
+        return self._call('get_max_unemployment')
+
+    def get_educ_vals(self):
+        """Get all unique education level values in the dataset.
+
+        Returns:
+            list: Sorted list of education level labels.
+        """
+        return self._call('get_educ_vals')
+
+    def get_docc03_vals(self):
+        """Get all unique occupation values in the dataset.
+
+        Returns:
+            list: Sorted list of occupation labels.
+        """
+        return self._call('get_docc03_vals')
+
+    def get_wbhaom_vals(self):
+        """Get all unique race/ethnicity values in the dataset.
+
+        Returns:
+            list: Sorted list of race/ethnicity labels.
+        """
+        return self._call('get_wbhaom_vals')
+
+    def get_female_vals(self):
+        """Get all unique gender values in the dataset.
+
+        Returns:
+            list: Sorted list of boolean values indicating female or not.
+        """
+        return self._call('get_female_vals')
+
+    def get_region_vals(self):
+        """Get all unique region values in the dataset.
+
+        Returns:
+            list: Sorted list of geographic region labels.
+        """
+        return self._call('get_region_vals')
+
+    def get_age_vals(self):
+        """Get all unique age group values in the dataset.
+
+        Returns:
+            list: Sorted list of age group labels.
+        """
+        return self._call('get_age_vals')
+
+    def get_hoursuint_vals(self):
+        """Get all unique hours worked values in the dataset.
+
+        Returns:
+            list: Sorted list of hours worked labels.
+        """
+        return self._call('get_hoursuint_vals')
+
+    def get_citistat_vals(self):
+        """Get all unique citizenship status values in the dataset.
+
+        Returns:
+            list: Sorted list of citizenship status labels.
+        """
+        return self._call('get_citistat_vals')
+
+    def close(self):
+        """Detach from the segment, removing it if this process published it.
+
+        Waits for queries in progress in other threads. Later queries raise a
+        RuntimeError.
+        """
+        with self._lock:
+            if self._segment is None:
+                return
+
+            self._dataset = None
+            self._queries_finished.wait_for(lambda: self._active_queries == 0)
+            self._segment.close()
+
+            if self._is_owner:
+                self._segment.unlink()
+
+            self._segment = None
+
+    def _call(self, method_name, *args):
+        """Forward a query to the dataset over the segment if still open.
+
+        Args:
+            method_name (str): Name of the ColumnarDataset method to call.
+            *args: Arguments to pass to the method.
+
+        Returns:
+            The result of the method which does not reference the segment.
+        """
+        with self._lock:
+            if self._dataset is None:
+                raise RuntimeError('Shared dataset is closed.')
+
+            dataset = self._dataset
+            self._active_queries += 1
+
+        try:
+            return getattr(dataset, method_name)(*args)
+        finally:
+            dataset = None
+
+            with self._lock:
+                self._active_queries -= 1
+                self._queries_finished.notify_all()
+
+
+def publish(dataset, **options):
+    """Copy a columnar dataset into a new shared memory segment.
+
+    Args:
+        dataset (columnar_model.ColumnarDataset): The dataset to share.
+        **options: Keyword arguments like use_bitmaps with which the dataset
+            was created such that attached readers use the same indexes.
+
+    Returns:
+        SharedDataset: The published dataset which should be closed by this
+            process once readers have finished.
+    """
+    arrays = columnar_model.get_named_arrays(dataset)
+
+    layouts = []
+    size = 0
+    for name, values in arrays.items():
+        values = numpy.ascontiguousarray(values)
+        offset = align(size)
+        layouts.append(SharedArrayLayout(
+            name,
+            values.dtype.str,
+            values.shape,
+            offset
+        ))
+        size = offset + values.nbytes
+
+    segment = shared_memory.SharedMemory(create=True, size=max(size, 1))
+
+    for layout in layouts:
+        target = numpy.ndarray(
+            layout.get_shape(),
+            dtype=numpy.dtype(layout.get_dtype()),
+            buffer=segment.buf,
+            offset=layout.get_offset()
+        )
+        target[...] = arrays[layout.get_name()]
+
+    handle = SharedDatasetHandle(
+        segment.name,
+        layouts,
+        columnar_model.get_catalogs(dataset.get_columns()),
+        sorted(dataset.get_derived_arrays().keys()),
+        options,
+        get_tracker_id()
+    )
+
+    return SharedDataset(handle, segment, make_dataset(handle, segment), True)
+
+
+def attach(handle):
+    """Open a dataset published by another process without copying it.
+
+    Opening a segment by name registers it with the resource tracker of this
+    process as if it had been created here. Processes started through
+    multiprocessing by the publisher share its tracker but any other process
+    has its own which would remove the segment for every other reader once
+    this process exits, so that registration is undone.
+
+    Args:
+        handle (SharedDatasetHandle): The handle from the publishing process.
+
+    Returns:
+        SharedDataset: The attached dataset which should be closed when no
+            longer needed.
+    """
+    segment = shared_memory.SharedMemory(name=handle.get_segment_name())
+    if get_tracker_id() != handle.get_tracker_id():
+        resource_tracker.unregister(segment._name, 'shared_memory')
+
+    return SharedDataset(handle, segment, make_dataset(handle, segment), False)
+
+
+def get_tracker_id():
+    """Identify the resource tracker of this process, starting it if needed.
+
+    Returns:
+        tuple: Device and inode of the pipe to the tracker which are shared by
+            processes using the same tracker.
+    """
+    stat = os.fstat(resource_tracker.getfd())
+    return (stat.st_dev, stat.st_ino)
+
+
+def make_dataset(handle, segment):
+    """Create a columnar dataset over the arrays in a shared segment.
+
+    Args:
+        handle (SharedDatasetHandle): Description of the segment.
+        segment (shared_memory.SharedMemory): The open segment.
+
+    Returns:
+        columnar_model.ColumnarDataset: Dataset using read-only views into the
+            segment and its prebuilt indexes.
+    """
+    views = dict(map(
+        lambda x: (x.get_name(), make_view(segment, x)),
+        handle.get_layouts()
+    ))
+
+    columns, derived_arrays = columnar_model.make_from_named_arrays(
+        views.__getitem__,
+        handle.get_catalogs(),
+        handle.get_derived_names()
+    )
+
+    return columnar_model.ColumnarDataset(
+        columns,
+        derived_arrays=derived_arrays,
+        **handle.get_options()
+    )
+
+
+def make_view(segment, layout):
+    """Create a read-only NumPy view of one array in a shared segment.
+
+    Args:
+        segment (shared_memory.SharedMemory): The open segment.
+        layout (SharedArrayLayout): Location of the array.
+
+    Returns:
+        numpy.ndarray: View into the segment without copying.
+    """
+    values = numpy.ndarray(
+        layout.get_shape(),
+        dtype=numpy.dtype(layout.get_dtype()),
+        buffer=segment.buf,
+        offset=layout.get_offset()
+    )
+    values.flags.writeable = False
+    return values
+
+
+def align(offset):
+    """Round a byte offset up to the next multiple of ALIGNMENT.
+
+    Args:
+        offset (int): The unaligned offset.
+
+    Returns:
+        int: The aligned offset.
+    """
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def load_from_file(loc, use_bitmaps=False, median_strategy='select',
+        **options):
+    """Load a columnar dataset from a CSV file and publish it.
+
+    Args:
+        loc (str): The location of the CSV file from which to parse records.
+        use_bitmaps (bool): Flag indicating if bitmap indexes should be built
+            and shared. Defaults to False.
+        median_strategy (str): One of data_model.MEDIAN_STRATEGIES where
+            presorted wages are built once and shared. Defaults to select.
+        **options: Other keyword arguments like snapshot_dir passed to
+            columnar_model.load_from_file.
+
+    Returns:
+        SharedDataset: The published dataset whose get_handle may be sent to
+            worker processes for attach.
+    """
+    dataset = columnar_model.load_from_file(
+        loc,
+        use_bitmaps=use_bitmaps,
+        median_strategy=median_strategy,
+        **options
+    )
+    return publish(
+        dataset,
+        use_bitmaps=use_bitmaps,
+        median_strategy=median_strategy
+    )
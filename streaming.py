@@ -0,0 +1,629 @@
+"""Out-of-core aggregation over CSV files which do not fit in memory.
+
+Rather than materializing InputRecords, a StreamingDataset answers each call
+with passes over the CSV file in chunks of bounded size, keeping only running
+sums and wage sketches per group. Exact medians additionally keep the summed
+weight of each distinct wage within the sketch bucket holding the group's
+median. A bucket spans wages within a factor of about 1 + 2 * relative
+accuracy so, for wages recorded to the cent, this is at most about
+2 * relative_accuracy * wage * 100 + 1 wages per group (around 100 at $50 with
+the default accuracy). Wages with more precision may instead grow this with
+the number of rows in the bucket. Sizes and unemployment rates take a single
+pass. Weighted medians take one pass to
+find the sketch bucket holding the median and a second pass to select the
+exact median from the wages within that bucket. They may alternatively be
+estimated in a single pass. Requires a regular file so is not available when
+loading through a sketch.
+
+Author: A Samuel Pottinger
+License: MIT License
+"""
+import csv
+import itertools
+import math
+
+import data_model
+import quantile_sketch
+
+DEFAULT_CHUNK_SIZE = 10000
+
+
+class StreamingDataset:
+    """Dataset which reads its CSV file again for each call.
+
+    Offers the get_size, get_unemp, get_wageotc, get_wageotc_approx, and
+    group_by methods of data_model.Dataset with matching results but memory
+    use which does not grow with the size of the file.
+    """
+
+    def __init__(self, loc, chunk_size=DEFAULT_CHUNK_SIZE,
+            relative_accuracy=quantile_sketch.DEFAULT_RELATIVE_ACCURACY):
+        """Create a new dataset over a CSV file.
+
+        Args:
+            loc (str): The location of the CSV file from which to read records.
+            chunk_size (int): Maximum number of rows held in memory at once.
+                Defaults to DEFAULT_CHUNK_SIZE.
+            relative_accuracy (float): Maximum relative error of wage sketches
+                used by get_wageotc_approx. Defaults to
+                quantile_sketch.DEFAULT_RELATIVE_ACCURACY.
+        """
+        self._loc = loc
+        self._chunk_size = chunk_size
+        self._relative_accuracy = relative_accuracy
+
+    def get_wageotc(self, query):
+        """Get exact median wage for a group in two passes over the file.
+
+        Args:
+            query (Query): A Query object describing the population for which
+                the median wage should be returned.
+
+        Returns:
+            float: The estimated median wage for the given population in USD
+                matching data_model.Dataset.get_wageotc.
+        """
+        groups = self._find_groups([], ['wageotc'], query, True)
+        return self._get_single_group(groups)['wageotc']
+
+    def get_wageotc_approx(self, query):
+        """Get approximate median wage for a group in one pass over the file.
+
+        Args:
+            query (Query): A Query object describing the population for which
+                the median wage should be returned.
+
+        Returns:
+            float: The estimated median wage for the given population in USD
+                within get_wageotc_error_bound of get_wageotc.
+        """
+        groups = self._find_groups([], ['wageotc'], query, False)
+        return self._get_single_group(groups)['wageotc']
+
+    def get_wageotc_error_bound(self):
+        """Get the maximum relative error from get_wageotc_approx.
+
+        Returns:
+            float: Maximum relative difference between get_wageotc_approx and
+                get_wageotc like 0.01 for 1%.
+        """
+        return self._relative_accuracy
+
+    def get_unemp(self, query):
+        """Get the overall unemployment rate for a group in one pass.
+
+        Args:
+            query (Query): A Query object describing the population for which
+                the unemployemnt rate should be returned.
+
+        Returns:
+            float: The estimated unemployment rate for the specified group as
+                a percentage between 0 and 100.
+        """
+        groups = self._find_groups([], ['unemp'], query, False)
+        return self._get_single_group(groups)['unemp']
+
+    def get_size(self, query):
+        """Get the size of a population as summed census weight in one pass.
+
+        Args:
+            query (Query): A Query object describing the population for which
+                the size should be returned.
+
+        Returns:
+            float: Estimated size of this population as a wage count weight.
+        """
+        groups = self._find_groups([], ['size'], query, False)
+        if not groups:
+            return 0
+
+        return self._get_single_group(groups)['size']
+
+    def group_by(self, dimensions, metrics, base_query=None, exact=True):
+        """Calculate metrics for every combination of values in dimensions.
+
+        Sizes and unemployment rates for all groups are found in a single pass
+        over the file. Exact median wages require a second pass.
+
+        Args:
+            dimensions (list): Names of the dimensions by which to group like
+                ['docc03', 'female'].
+            metrics (list): Names of the metrics to calculate per group where
+                each is one of data_model.METRICS.
+            base_query (Query): Optional query describing the population to
+                group. Defaults to None in which case all records are grouped.
+            exact (bool): Flag indicating if median wages should be exact
+                instead of estimated from sketches. Defaults to True.
+
+        Returns:
+            dict: Mapping from tuple of dimension values (in the order given by
+                dimensions) to a dict from metric name to its value like
+                data_model.Dataset.group_by.
+        """
+        for dimension in dimensions:
+            if dimension not in data_model.DIMENSIONS:
+                raise RuntimeError('Unknown dimension: %s' % dimension)
+
+        for metric in metrics:
+            if metric not in data_model.METRICS:
+                raise RuntimeError('Unknown metric: %s' % metric)
+
+        if base_query is None:
+            base_query = data_model.Query()
+
+        return self._find_groups(dimensions, metrics, base_query, exact)
+
+    def _get_single_group(self, groups):
+        """Get the metrics for an ungrouped population.
+
+        Args:
+            groups (dict): Result of _find_groups without dimensions.
+
+        Returns:
+            dict: Mapping from metric name to value.
+        """
+        if not groups:
+            raise RuntimeError('Unable to find records for query.')
+
+        return groups[()]
+
+    def _find_groups(self, dimensions, metrics, base_query, exact):
+        """Calculate metrics per group with one or two passes.
+
+        Args:
+            dimensions (list): Names of the dimensions by which to group.
+            metrics (list): Names of the metrics to calculate per group.
+            base_query (Query): Query describing the population to group.
+            exact (bool): Flag indicating if median wages should be exact.
+
+        Returns:
+            dict: Mapping from tuple of dimension values to a dict from metric
+                name to its value.
+        """
+        needs_wages = 'wageotc' in metrics
+        accumulators = {}
+
+        for key, record_raw in self._iterate_matching(base_query, dimensions):
+            accumulator = accumulators.get(key, None)
+            if accumulator is None:
+                accumulator = GroupAccumulator(
+                    self._relative_accuracy if needs_wages else None
+                )
+                accumulators[key] = accumulator
+
+            accumulator.add(record_raw)
+
+        if needs_wages and exact:
+            self._find_exact_medians(dimensions, base_query, accumulators)
+
+        return dict(map(
+            lambda x: (
+                x[0],
+                dict(map(
+                    lambda metric: (metric, x[1].get_metric(metric, exact)),
+                    metrics
+                ))
+            ),
+            accumulators.items()
+        ))
+
+    def _find_exact_medians(self, dimensions, base_query, accumulators):
+        """Make a second pass collecting wages in each group's median bucket.
+
+        Args:
+            dimensions (list): Names of the dimensions by which to group.
+            base_query (Query): Query describing the population to group.
+            accumulators (dict): Mapping from group key to GroupAccumulator
+                after the first pass which are updated in place.
+        """
+        for accumulator in accumulators.values():
+            accumulator.start_median_selection()
+
+        for key, record_raw in self._iterate_matching(base_query, dimensions):
+            accumulators[key].add_median_candidates(record_raw)
+
+    def _iterate_matching(self, query, dimensions):
+        """Read the rows matching a query in chunks of bounded size.
+
+        Args:
+            query (Query): Query whose filters the rows must match.
+            dimensions (list): Names of the dimensions whose values form the
+                group key yielded with each row.
+
+        Returns:
+            iterable: Tuples of group key (tuple of dimension values) and raw
+                row (dict) which are read as the iterable is consumed. Raises
+                a RuntimeError after the last row if the query filters on a
+                value not found in the file like data_model.Dataset.
+        """
+        filters = list(filter(
+            lambda x: x[1] is not None,
+            map(
+                lambda x: (x, data_model.get_dimension_getter(x)(query)),
+                data_model.DIMENSIONS
+            )
+        ))
+        seen_by_dimension = dict(map(lambda x: (x[0], set()), filters))
+
+        def matches(record_raw):
+            matched = True
+            for dimension, value_filter in filters:
+                value = data_model.parse_dimension(record_raw, dimension)
+                seen_by_dimension[dimension].add(value)
+                if not matches_filter(dimension, value_filter, value):
+                    matched = False
+
+            return matched
+
+        def get_key(record_raw):
+            return tuple(map(
+                lambda x: data_model.parse_dimension(record_raw, x),
+                dimensions
+            ))
+
+        with open(self._loc) as f:
+            chunks = data_model.iterate_chunks(
+                csv.DictReader(f),
+                self._chunk_size
+            )
+            for chunk in chunks:
+                for record_raw in filter(matches, chunk):
+                    yield (get_key(record_raw), record_raw)
+
+        for dimension, value_filter in filters:
+            for value in get_plain_values(value_filter):
+                if value not in seen_by_dimension[dimension]:
+                    message = 'Cannot find the provided value: %s' % str(value)
+                    raise RuntimeError(message)
+
+
+class GroupAccumulator:
+    """Running totals for one group of rows within a pass over a file."""
+
+    def __init__(self, relative_accuracy):
+        """Create a new empty accumulator.
+
+        Args:
+            relative_accuracy (float): Accuracy of the wage sketch to keep or
+                None if median wages are not needed.
+        """
+        self._wage_count = 0
+        self._unemp_count = 0
+        self._unemp_weighted = 0
+        self._count = 0
+
+        if relative_accuracy is None:
+            self._sketch = None
+        else:
+            self._sketch = quantile_sketch.WageSketch(relative_accuracy)
+
+        self._median_bucket = None
+        self._next_bucket = None
+        self._weight_below = None
+        self._weight_by_wage = None
+        self._next_wage = None
+
+    def add(self, record_raw):
+        """Add a row to the running totals.
+
+        Args:
+            record_raw (dict): The row as read from the CSV file.
+        """
+        self.add_values(
+            float(record_raw['wageCount']),
+            float(record_raw['unempCount']),
+            float(record_raw['unemp']),
+            data_model.parse_wage_otc(record_raw['wageotc'])
+        )
+
+    def add_values(self, wage_count, unemp_count, unemp, wage_tuples):
+        """Add the values of one record to the running totals.
+
+        Args:
+            wage_count (float): Weight of wage information for the record.
+            unemp_count (float): Weight of unemployment information.
+            unemp (float): Percent unemployment for the record.
+            wage_tuples (iterable): The record's WageTuples.
+        """
+        self.add_sums(wage_count, unemp_count, unemp_count * unemp, 1)
+
+        if self._sketch is not None:
+            for wage_tuple in wage_tuples:
+                self._sketch.add(wage_tuple.get_wage(), wage_tuple.get_weight())
+
+    def add_sums(self, wage_count, unemp_count, unemp_weighted, count):
+        """Add totals already summed over some records of this group.
+
+        Args:
+            wage_count (float): Summed weight of wage information.
+            unemp_count (float): Summed weight of unemployment information.
+            unemp_weighted (float): Unemployment count weighted sum of percent
+                unemployment.
+            count (int): Number of records summed.
+        """
+        self._wage_count += wage_count
+        self._unemp_count += unemp_count
+        self._unemp_weighted += unemp_weighted
+        self._count += count
+
+    def add_sorted_wages(self, wages):
+        """Add wages to the sketch of this group.
+
+        Args:
+            wages (iterable): Tuples of wage and weight sorted by wage.
+        """
+        self._sketch.add_sorted(wages)
+
+    def merge(self, other):
+        """Add the running totals of another accumulator into this one.
+
+        Args:
+            other (GroupAccumulator): Accumulator for another part of the same
+                group created with the same relative accuracy. Not modified.
+        """
+        self._wage_count += other._wage_count
+        self._unemp_count += other._unemp_count
+        self._unemp_weighted += other._unemp_weighted
+        self._count += other._count
+
+        if self._sketch is not None:
+            self._sketch.merge(other._sketch)
+
+    def start_median_selection(self):
+        """Find the sketch bucket holding the median before a second pass."""
+        median_bucket, weight_below = self._sketch.get_quantile_bucket(0.5)
+        self._median_bucket = median_bucket
+        self._next_bucket = self._sketch.get_next_bucket(median_bucket)
+        self._weight_below = weight_below
+        self._weight_by_wage = {}
+        self._next_wage = None
+
+    def get_median_bucket(self):
+        """Get the bucket found by start_median_selection.
+
+        Returns:
+            int: Bucket holding the median as given by
+                quantile_sketch.WageSketch.get_bucket or None for wages of zero.
+        """
+        return self._median_bucket
+
+    def get_next_bucket(self):
+        """Get the first bucket holding wages after the median's bucket.
+
+        Returns:
+            int: Bucket as given by quantile_sketch.WageSketch.get_bucket or
+                None if the median's bucket is the last.
+        """
+        return self._next_bucket
+
+    def add_median_candidates(self, record_raw):
+        """Keep the wages of a row which fall in the median's bucket.
+
+        Args:
+            record_raw (dict): The row as read from the CSV file which must
+                have been given to add in the first pass.
+        """
+        weight_by_wage, next_wage = select_bucket_wages(
+            self._sketch,
+            self._median_bucket,
+            self._next_bucket,
+            data_model.parse_wage_otc(record_raw['wageotc'])
+        )
+        self.merge_median_candidates(weight_by_wage, next_wage)
+
+    def merge_median_candidates(self, weight_by_wage, next_wage):
+        """Keep wages within the median's bucket found elsewhere.
+
+        Args:
+            weight_by_wage (dict): Mapping from wage to summed weight for wages
+                in the bucket given by get_median_bucket.
+            next_wage (float): Smallest wage found in the bucket given by
+                get_next_bucket or None if none was found.
+        """
+        for wage, weight in weight_by_wage.items():
+            prior = self._weight_by_wage.get(wage, 0)
+            self._weight_by_wage[wage] = prior + weight
+
+        if next_wage is not None:
+            if self._next_wage is None or next_wage < self._next_wage:
+                self._next_wage = next_wage
+
+    def get_metric(self, metric, exact):
+        """Get the value of a metric for this group.
+
+        Args:
+            metric (str): One of data_model.METRICS.
+            exact (bool): Flag indicating if the median wage should be exact
+                which requires start_median_selection and a second pass.
+
+        Returns:
+            float: The size, unemployment rate, or median wage.
+        """
+        if metric == 'size':
+            return self._wage_count
+        elif metric == 'unemp':
+            if self._unemp_count == 0:
+                raise RuntimeError('Unable to get unemployment rate.')
+
+            return self._unemp_weighted / self._unemp_count
+        elif metric == 'wageotc':
+            if exact:
+                return self._get_exact_median()
+            else:
+                return self._sketch.get_quantile(0.5)
+        else:
+            raise RuntimeError('Unknown metric: %s' % metric)
+
+    def _get_exact_median(self):
+        """Select the median from the wages kept in the median's bucket.
+
+        Weight before the median's bucket is summed bucket by bucket and
+        weight within it wage by wage. As floating point sums depend on their
+        order, this may differ from data_model.Dataset.get_wageotc, which sums
+        wage by wage in sorted order, when the cumulative weight at a wage is
+        within rounding error of half of the total weight.
+
+        Returns:
+            float: The smallest wage at which cumulative weight reaches half of
+                the total weight. If rounding leaves the cumulative weight
+                just short at the end of the median's bucket, this is the first
+                wage of the next bucket or, if there is none, the largest wage
+                as in data_model.find_weighted_quantiles.
+        """
+        if not self._weight_by_wage:
+            raise RuntimeError('Unable to get median wage.')
+
+        mid_count = self._sketch.get_total_weight() / 2
+
+        weight_acc = self._weight_below
+        sorted_wages = sorted(self._weight_by_wage.keys())
+        for wage in sorted_wages:
+            weight = self._weight_by_wage[wage]
+            if weight_acc + weight >= mid_count:
+                return wage
+
+            weight_acc += weight
+
+        if self._next_wage is not None:
+            return self._next_wage
+        elif self._next_bucket is None:
+            return sorted_wages[-1]
+        else:
+            raise RuntimeError('Unable to get median wage.')
+
+
+def select_bucket_wages(sketch, bucket, next_bucket, wage_tuples):
+    """Sum the weights of wages falling within a sketch bucket.
+
+    Args:
+        sketch (quantile_sketch.WageSketch): Sketch whose buckets to use.
+        bucket (int): The bucket as given by get_bucket or None for wages of
+            zero.
+        next_bucket (int): The first bucket holding wages after bucket or None
+            if there is none.
+        wage_tuples (iterable): The WageTuples to consider.
+
+    Returns:
+        tuple: Mapping from wage to summed weight for wages in the bucket
+            (dict) and the smallest wage in next_bucket (float) or None if
+            there is none.
+    """
+    weight_by_wage = {}
+    next_wage = None
+
+    for wage_tuple in wage_tuples:
+        wage = wage_tuple.get_wage()
+        wage_bucket = sketch.get_bucket(wage)
+        if wage_bucket == bucket:
+            prior = weight_by_wage.get(wage, 0)
+            weight_by_wage[wage] = prior + wage_tuple.get_weight()
+        elif next_bucket is not None and wage_bucket == next_bucket:
+            if next_wage is None or wage < next_wage:
+                next_wage = wage
+
+    return (weight_by_wage, next_wage)
+
+
+def select_sorted_bucket_wages(sketch, bucket, next_bucket, wages):
+    """Sum the weights of wages falling within a sketch bucket.
+
+    Like select_bucket_wages but finds the bucket's wages by binary search as
+    buckets do not decrease with wage.
+
+    Args:
+        sketch (quantile_sketch.WageSketch): Sketch whose buckets to use.
+        bucket (int): The bucket as given by get_bucket or None for wages of
+            zero.
+        next_bucket (int): The first bucket holding wages after bucket or None
+            if there is none.
+        wages (list): Tuples of wage and weight sorted by wage.
+
+    Returns:
+        tuple: Mapping from wage to summed weight for wages in the bucket
+            (dict) and the smallest wage in next_bucket (float) or None if
+            there is none.
+    """
+    def get_rank(wage_bucket):
+        return -math.inf if wage_bucket is None else wage_bucket
+
+    bucket_rank = get_rank(bucket)
+
+    def find_first(is_after):
+        low = 0
+        high = len(wages)
+        while low < high:
+            middle = (low + high) // 2
+            if is_after(get_rank(sketch.get_bucket(wages[middle][0]))):
+                high = middle
+            else:
+                low = middle + 1
+
+        return low
+
+    start = find_first(lambda x: x >= bucket_rank)
+    end = find_first(lambda x: x > bucket_rank)
+
+    weight_by_wage = {}
+    for wage, weight in wages[start:end]:
+        weight_by_wage[wage] = weight_by_wage.get(wage, 0) + weight
+
+    next_wage = None
+    if next_bucket is not None and end < len(wages):
+        if sketch.get_bucket(wages[end][0]) == next_bucket:
+            next_wage = wages[end][0]
+
+    return (weight_by_wage, next_wage)
+
+
+def matches_filter(dimension, value_filter, value):
+    """Determine if a record's value is matched by a query filter.
+
+    Args:
+        dimension (str): Name of the dimension which is one of DIMENSIONS.
+        value_filter: The value or Predicate set on the query for the
+            dimension.
+        value: The record's value for the dimension.
+
+    Returns:
+        bool: True if the filter matches the value like resolve_filter would.
+    """
+    if isinstance(value_filter, data_model.OneOfFilter):
+        return any(map(
+            lambda x: matches_filter(dimension, x, value),
+            value_filter.get_values()
+        ))
+    elif isinstance(value_filter, data_model.NotFilter):
+        return not matches_filter(dimension, value_filter.get_inner(), value)
+    elif isinstance(value_filter, data_model.RangeFilter):
+        sort_key = data_model.get_category_sort_key(dimension)
+        start = value_filter.get_start()
+        end = value_filter.get_end()
+        key = sort_key(value)
+        after_start = start is None or key >= sort_key(start)
+        before_end = end is None or key <= sort_key(end)
+        return after_start and before_end
+    else:
+        return value == value_filter
+
+
+def get_plain_values(value_filter):
+    """Get the values which a query filter requires to exist.
+
+    Args:
+        value_filter: The value or Predicate set on the query for a dimension.
+
+    Returns:
+        list: Values named directly, within OneOfFilter and NotFilter, or as
+            RangeFilter bounds which data_model.resolve_filter would reject if
+            missing.
+    """
+    if isinstance(value_filter, data_model.OneOfFilter):
+        values_nested = map(get_plain_values, value_filter.get_values())
+        return list(itertools.chain(*values_nested))
+    elif isinstance(value_filter, data_model.NotFilter):
+        return get_plain_values(value_filter.get_inner())
+    elif isinstance(value_filter, data_model.RangeFilter):
+        bounds = [value_filter.get_start(), value_filter.get_end()]
+        return list(filter(lambda x: x is not None, bounds))
+    else:
+        return [value_filter]